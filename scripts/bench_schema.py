@@ -0,0 +1,42 @@
+#!/usr/bin/python
+"""Time the validation of a USSD POST /health-workers payload
+
+  PYTHONPATH=src/web DJANGO_SETTINGS_MODULE=sb.settings python scripts/bench_schema.py [count]
+
+The payload has no facility or specialties, so no query is timed.
+"""
+import json
+import sys
+import timeit
+
+import django
+
+PAYLOAD = json.dumps({
+  "name": "Asha",
+  "surname": "Mwakyusa",
+  "vodacom_phone": "+255754000001",
+  "language": "sw",
+  "mct_registration_number": "F1234",
+  "mct_payroll_number": "9876543",
+  "birthdate": {"year": 1980, "month": 4, "day": 12},
+  "email": None,
+  "address": None,
+  "country": "TZ",
+  "other_phone": None,
+  "facility": None,
+  "specialties": []})
+
+def main(count):
+  django.setup()
+  from sb.healthworker import views
+  data = json.loads(PAYLOAD)
+  result, error = views.parse_healthworker_input(data)
+  if error:
+    raise SystemExit("payload is invalid: %r" % (error, ))
+  for name, f in [("parse", lambda: views.parse_healthworker_input(data)),
+                  ("validate", lambda: views._health_worker_input.validate(data))]:
+    seconds = min(timeit.repeat(f, number=count, repeat=3))
+    print "%s: %.2f us per payload, %.0f payloads/s" % (name, seconds / count * 1e6, count / seconds)
+
+if __name__ == "__main__":
+  main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,31 @@
+#!/usr/bin/python
+"""Time stripping common phrases from facility queries, trie against regex
+
+  PYTHONPATH=src/web python scripts/bench_stopwords.py [count]
+"""
+import sys
+import timeit
+
+from sb.healthworker import stopwords
+
+QUERIES = [
+  u"Hospitali ya Wilaya ya Mbeya",
+  u"Zahanati ya Kijiji Igawa",
+  u"Afya Post la Kigoma",
+  u"Anglikani Askofu CRCT wa Tanga",
+  u"Bugando Medical Centre",
+  u"kituo cha afya Mwananyamala"]
+
+def main(count):
+  pattern = stopwords.get_facility_pattern()
+  trie = stopwords.get_facility_trie()
+  for q in QUERIES:
+    if stopwords.fix_query(q, [trie]) != stopwords.fix_query(q, [pattern]):
+      raise SystemExit("trie and regex differ on %r" % (q, ))
+  for name, p in [("regex", pattern), ("trie", trie)]:
+    f = lambda: [stopwords.fix_query(q, [p]) for q in QUERIES]
+    seconds = min(timeit.repeat(f, number=count, repeat=3)) / len(QUERIES)
+    print "%s: %.2f us per query, %.0f queries/s" % (name, seconds / count * 1e6, count / seconds)
+
+if __name__ == "__main__":
+  main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -50,13 +50,18 @@ def export_as_csv_action(description="CSV Export", fields=[], header=True):
 
 class RegionAdmin(admin.ModelAdmin):
   list_display = ["title", "type", "parent_region", "created_at", "updated_at", "subregions"]
-  search_fields = ["title"]
+  list_select_related = ["type", "parent_region"]
+  search_fields = ["title", "alternative_names"]
+
+  def get_queryset(self, request):
+    query_set = super(RegionAdmin, self).get_queryset(request)
+    return query_set.prefetch_related("region_set")
 
   def parent_title(self, o):
     return o.parent_region.title
 
   def subregions(self, o):
-    return ', '.join(m.title for m in models.Region.objects.filter(parent_region=o).all())
+    return ', '.join(m.title for m in o.region_set.all())
 
 class FacilityAdmin(admin.ModelAdmin):
   list_display = ["title", "address", "owner", "msisdn", "is_user_submitted", "type", "show_region_url", "created_at", "updated_at"]
@@ -72,9 +77,13 @@ class FacilityAdmin(admin.ModelAdmin):
   show_region_url.short_description = 'Region'
 
 class SpecialtyAdmin(admin.ModelAdmin):
-  list_display = ["title", "msisdn", "is_user_submitted", "created_at", "updated_at"]
+  list_display = ["title", "cadre", "msisdn", "is_user_submitted", "created_at", "updated_at"]
   search_fields = ["title", "msisdn"]
 
+  def cadre(self, specialty):
+    cadre = models.specialty_tree.get().cadre(specialty.id)
+    return cadre.title if cadre is not None and cadre.id != specialty.id else u''
+
 class MCTPayrollAdmin(admin.ModelAdmin):
   list_display = ["name", "last_name", "designation", "birthdate", "check_number", "district", "health_worker", "specialty", "facility",  "region"]
   search_fields = ["name", "last_name", "designation", "birthdate", "check_number", "district"]
@@ -92,6 +101,10 @@ class NGORegistrationAdmin(admin.ModelAdmin):
   search_fields = ["ngo__name", "list_num", "name", "phone_number", "registration_number", "check_number", "cadre", "city", "district", "region"]
 
 class HealthWorkerAdmin(AjaxSelectAdmin):
+  def get_queryset(self, request):
+    query_set = super(HealthWorkerAdmin, self).get_queryset(request)
+    return query_set.prefetch_related("specialties")
+
   def specialty_names(self, hw):
     return u', '.join([s.title for s in hw.specialties.all()])
 
@@ -102,8 +115,8 @@ class HealthWorkerAdmin(AjaxSelectAdmin):
     return hw.facility.title if hw.facility else u''
 
   def cadre(self, hw):
-    specialties = hw.specialties.filter(parent_specialty__isnull=True)
-    return specialties.all()[0].abbreviation if specialties.count() > 0 else u''
+    cadres = [s for s in hw.specialties.all() if s.parent_specialty_id is None]
+    return cadres[0].abbreviation if cadres else u''
 
   def district(self, hw):
     return hw.facility.title if hw.facility else u''
@@ -0,0 +1,215 @@
+# Copyright 2013 Switchboard, Inc
+"""Candidate generation (blocking) for name verification
+
+Scoring a worker's name against every row of a registry table is
+O(workers x rows).  Blocking narrows each name down to a small set of
+candidate rows with cheap exact keys before any similarity is computed.
+
+Every token of a registry name is filed under one key per key function in
+NAME_BLOCKING_KEYS:
+
+  soundex_digits --- the digits of the token's Soundex code, which survive
+                     most misspellings, including of the first letter
+                     (catherine/katherine, mwakyusa/nwakyusa)
+  soundex --- the token's whole Soundex code, a narrower key that misses
+              misspellings of the first letter
+  prefix --- the token's first three letters, which survives misspellings
+             later in long tokens
+
+A name match pairs every query token with a similar row token.  The
+candidates of a query are the rows sharing a key with its rarest token.  The
+keys don't catch every similar pair of tokens: a token misspelled at its
+start and again in a later consonant can share no key with the token it's
+similar to, and then blocked search misses a match that the full search
+finds.  Use measure_recall() to check how many of the unblocked matches the
+blocked search still finds.
+"""
+
+import threading
+import time
+
+from django.conf import settings
+
+from sb.healthworker import fuzzy
+from sb.healthworker import registry_index
+
+_soundex_codes = {}
+for _letters, _code in [("bfpv", "1"), ("cgjkqsxz", "2"), ("dt", "3"),
+                        ("l", "4"), ("mn", "5"), ("r", "6")]:
+  for _letter in _letters:
+    _soundex_codes[_letter] = _code
+
+def soundex(token):
+  "American Soundex code of a token, like 'B216' for 'bickford'"
+  token = token.lower()
+  result = [token[0].upper()]
+  last = _soundex_codes.get(token[0])
+  for c in token[1:]:
+    code = _soundex_codes.get(c)
+    if code is not None and code != last:
+      result.append(code)
+    # h and w don't separate letters with the same code, vowels do
+    if c not in u"hw":
+      last = code
+  return (u"".join(result) + u"000")[:4]
+
+def soundex_digits(token):
+  "The digits of a token's Soundex code, like '365' for 'catherine'"
+  return soundex(token)[1:]
+
+def prefix(token):
+  return token[:3]
+
+KEY_FUNCTIONS = {
+  "soundex": soundex,
+  "soundex_digits": soundex_digits,
+  "prefix": prefix,
+}
+
+BLOCKING_KEYS = getattr(settings, "NAME_BLOCKING_KEYS", ("soundex_digits", "prefix"))
+
+def token_keys(token, keys=None):
+  "The blocking keys of a token"
+  return [(k, KEY_FUNCTIONS[k](token)) for k in (keys or BLOCKING_KEYS)]
+
+class BlockIndex(registry_index.RegistryIndex):
+  "Blocking key postings over the name column of a registry table"
+  def __init__(self, model, field="name", keys=None):
+    super(BlockIndex, self).__init__(model)
+    self.field = field
+    self.keys = tuple(keys or BLOCKING_KEYS)
+    self._clear()
+
+  def _clear(self):
+    self._postings = None
+    self._row_keys = None
+
+  def _load(self):
+    self._postings = {}
+    self._row_keys = {}
+    for row_id, name in self.model.objects.values_list("id", self.field).iterator():
+      self._add(row_id, name)
+
+  def _add(self, row_id, name):
+    row_keys = set()
+    for token in fuzzy.tokens(name):
+      row_keys.update(token_keys(token, self.keys))
+    for key in row_keys:
+      self._postings.setdefault(key, set()).add(row_id)
+    if row_keys:
+      self._row_keys[row_id] = tuple(row_keys)
+
+  def _discard(self, row_id):
+    for key in self._row_keys.pop(row_id, ()):
+      ids = self._postings[key]
+      ids.discard(row_id)
+      if not ids:
+        del self._postings[key]
+
+  def candidates(self, query):
+    "The ids of rows sharing a blocking key with the rarest query token"
+    best = None
+    with self._lock:
+      self._ensure_built()
+      for token in set(fuzzy.tokens(query)):
+        ids = set()
+        for key in token_keys(token, self.keys):
+          ids.update(self._postings.get(key, ()))
+        if best is None or len(ids) < len(best):
+          best = ids
+    return best or set()
+
+  def size(self):
+    with self._lock:
+      self._ensure_built()
+      return len(self._row_keys)
+
+  def update(self, instance):
+    "Re-index a saved row"
+    with self._lock:
+      if self.is_built():
+        self._discard(instance.id)
+        self._add(instance.id, getattr(instance, self.field))
+
+  def claim(self, row_id):
+    # Claimed rows stay blocked; NameIndex.search filters them
+    pass
+
+  def discard(self, row_id):
+    "Drop a deleted row"
+    with self._lock:
+      if self.is_built():
+        self._discard(row_id)
+
+def block_index(model, field="name"):
+  "Get the BlockIndex over a registry model's name field"
+  return registry_index.get_index(model, ("block", field),
+                                  lambda: BlockIndex(model, field))
+
+class Stats(object):
+  "Counters for tuning the blocking stage"
+  def __init__(self):
+    self._lock = threading.Lock()
+    self.reset()
+
+  def reset(self):
+    self.queries = 0
+    self.rows = 0
+    self.candidates = 0
+    self.matches = 0
+    self.blocking_seconds = 0.0
+    self.scoring_seconds = 0.0
+
+  def add(self, rows, candidates, matches, blocking_seconds, scoring_seconds):
+    with self._lock:
+      self.queries += 1
+      self.rows += rows
+      self.candidates += candidates
+      self.matches += matches
+      self.blocking_seconds += blocking_seconds
+      self.scoring_seconds += scoring_seconds
+
+  def lines(self):
+    queries = self.queries or 1
+    seconds = (self.blocking_seconds + self.scoring_seconds) or 1e-9
+    yield "Blocked searches: %d" % self.queries
+    yield "Mean candidates per search: %.1f" % (float(self.candidates) / queries)
+    yield "Comparisons avoided: %.2f%%" % (
+      100.0 * (1 - float(self.candidates) / (self.rows or 1)))
+    yield "Mean matches per search: %.2f" % (float(self.matches) / queries)
+    yield "Blocking time: %.3fs, scoring time: %.3fs" % (self.blocking_seconds,
+                                                         self.scoring_seconds)
+    yield "Throughput: %.1f searches/s" % (self.queries / seconds)
+
+stats = Stats()
+
+def search(model, query, unclaimed_only=True):
+  """Fuzzy name search of a registry model, scoring only blocked candidates
+
+  Returns a list of (id, score) pairs, best score first.
+  """
+  blocks = block_index(model)
+  start = time.time()
+  candidates = blocks.candidates(query)
+  blocked = time.time()
+  matches = registry_index.name_index(model).search(
+    query, unclaimed_only=unclaimed_only, candidates=candidates)
+  stats.add(blocks.size(), len(candidates), len(matches),
+            blocked - start, time.time() - blocked)
+  return matches
+
+def measure_recall(model, queries):
+  """Compare blocked search with a full index search
+
+  Returns (matches found by both, matches found by the full search).
+  """
+  names = registry_index.name_index(model)
+  blocks = block_index(model)
+  found = 0
+  total = 0
+  for query in queries:
+    full = set(i for i, s in names.search(query))
+    blocked = set(i for i, s in names.search(query, candidates=blocks.candidates(query)))
+    found += len(full & blocked)
+    total += len(full)
+  return found, total
@@ -0,0 +1,270 @@
+# Copyright 2013 Switchboard, Inc
+"""Queries and response parsers for the Care Services Discovery (CSD) service
+
+The region, facility and health worker indexes come from stored functions of
+a remote CSD directory.  A Query names a stored function of a CSD document
+with its request parameters and the parser that turns the response into
+entry dicts.  See sb.healthworker.csdcache for how responses are cached.
+
+Requests go through a shared CSDClient, which keeps a pool of keep-alive
+connections to the service, sends request parameters as in-memory multipart
+uploads and records the latency of each stored function.  Responses are
+parsed incrementally as they stream in, see iter_elements().
+"""
+
+import cStringIO
+import logging
+import threading
+import time
+from xml.etree import ElementTree as ET
+
+from django.conf import settings
+import requests
+import requests.adapters
+
+_log = logging.getLogger("sb.healthworker.csd")
+
+BASE_URL = getattr(settings, "CSD_BASE_URL", 'http://46.51.196.92:8984/CSD/csr/')
+BASE_URL_SUFFIX = '/careServicesRequest/'
+CONNECT_TIMEOUT = getattr(settings, "CSD_CONNECT_TIMEOUT", 5)
+READ_TIMEOUT = getattr(settings, "CSD_READ_TIMEOUT", 60)
+POOL_SIZE = getattr(settings, "CSD_POOL_SIZE", 10)
+
+NS = "{urn:ihe:iti:csd:2013}"
+
+DEFAULT_DOCUMENT = 'CSD-HNP'
+ORGANIZATION_SEARCH = 'urn:ihe:iti:csd:2014:stored-function:organization-search'
+FACILITY_SEARCH = 'urn:ihe:iti:csd:2014:stored-function:facility-search'
+PROVIDER_SEARCH = 'urn:ihe:iti:csd:2014:stored-function:provider-search'
+
+region_types = {
+  "1": "Country",
+  "2": "Region",
+  "3": "District",
+  "4": "Division",
+  "5": "Village",
+  "6": "Ward",
+}
+
+def is_none(element, attribute=''):
+  if element is None:
+    return "null"
+  else:
+    if attribute == '':
+      return element.text
+    else:
+      return element.get(attribute)
+
+def iter_elements(source, tag):
+  """Incrementally parse XML, yielding each element with the given tag
+
+  source is a file-like object or a string.  Each element is dropped from
+  the tree once the caller has seen it, so memory use doesn't grow with the
+  size of the document.
+  """
+  if isinstance(source, basestring):
+    source = cStringIO.StringIO(source)
+  parents = []
+  for event, elem in ET.iterparse(source, events=("start", "end")):
+    if event == "start":
+      parents.append(elem)
+      continue
+    parents.pop()
+    if elem.tag == tag:
+      yield elem
+      if parents:
+        parents[-1].remove(elem)
+      elem.clear()
+
+def parse_regions(source):
+  for region in iter_elements(source, NS + 'organization'):
+    yield {
+      'parent_region_id':is_none(region.find(NS + 'parent'), 'entityID'),
+      'title':is_none(region.find(NS + 'primaryName'), ),
+      'created_at':is_none(region.find(NS + 'record'), 'created'),
+      "updated_at":is_none(region.find(NS + 'record'), 'updated'),
+      "type":region_types[region.find(NS + 'codedType').get('code')],
+      'id':is_none(region.find(NS + 'otherID'), 'code')}
+
+def parse_facilities(source):
+  for facility in iter_elements(source, NS + 'facility'):
+    yield {
+      'parent_facility_id':is_none(facility.find(NS + 'parent'), 'entityID'),
+      'title':is_none(facility.find(NS + 'primaryName')),
+      'created_at':is_none(facility.find(NS + 'record'), 'created'),
+      "updated_at":is_none(facility.find(NS + 'record'), 'updated'),
+      "serial_number":is_none(facility.find(NS + 'otherID[@assigningAuthorityName="HNP:facility:serial_number"]'), 'code'),
+      'id':is_none(facility.find(NS + 'otherID[@assigningAuthorityName="HNP:facility:id"]'), 'code')}
+
+def parse_providers(source):
+  for healthworker in iter_elements(source, NS + 'provider'):
+    yield {
+      "name":is_none(healthworker.find(NS + "demographic/" + NS + "name/" + NS + "commonName")),
+      "id":is_none(healthworker.find(NS + 'otherID[@assigningAuthorityName="HNP:health_worker_id"]', "code")),
+      "language":"",
+      "vodacom_phone":"",
+      "created_at":is_none(healthworker.find(NS + 'record'), 'created'),
+      "updated_at":is_none(healthworker.find(NS + 'record'), 'updated'),
+      "birthdate":"",
+      "email":"",
+      "mct_payroll_num":is_none(healthworker.find(NS + 'otherID[@assigningAuthorityName="HNP:MCT:payroll:check_number"]', "code")),
+      "mct_registration_num":is_none(healthworker.find(NS + 'credential/' + NS + 'number')),
+      "verification_state":"",
+      "other_phone":"",
+      "address":"",
+      "specialties":[],
+      "country":"TZ",
+    }
+
+class Query(object):
+  """A stored function call on a CSD document
+
+  params is the csd:requestParams XML sent to the function, parse turns a
+  response body, a file-like object or string, into a generator of entry
+  dicts with "id" and "updated_at" keys.
+  """
+  def __init__(self, name, document, function, params, parse):
+    self.name = name
+    self.document = document
+    self.function = function
+    self.params = params
+    self.parse = parse
+
+  def updated_since(self, updated):
+    "The same query restricted to entries updated since a record@updated time"
+    record = '<csd:record updated="%s"/>' % (updated, )
+    params = self.params.replace('</csd:requestParams>', record + '</csd:requestParams>')
+    return Query(self.name, self.document, self.function, params, self.parse)
+
+  def key(self):
+    return (self.document, self.function, self.params)
+
+REGIONS = Query(
+  "regions", DEFAULT_DOCUMENT, ORGANIZATION_SEARCH,
+  '<csd:requestParams xmlns:csd="urn:ihe:iti:csd:2013"><csd:codedType codingScheme="2.25.220237170085002235066132143088055219024007198012" /></csd:requestParams>',
+  parse_regions)
+
+FACILITIES = Query(
+  "facilities", DEFAULT_DOCUMENT, FACILITY_SEARCH,
+  '<csd:requestParams xmlns:csd="urn:ihe:iti:csd:2013"><csd:facility><csd:codedType codingScheme="2.25.065073125158126083079071176122160207089182210156" /></csd:facility></csd:requestParams>',
+  parse_facilities)
+
+PROVIDERS = Query(
+  "providers", DEFAULT_DOCUMENT, PROVIDER_SEARCH,
+  '<csd:requestParams xmlns:csd="urn:ihe:iti:csd:2013"><csd:provider><csd:id entityID="2.25.065073125158126083079071176122160207089182210156">2.25.065073125158126083079071176122160207089182210156</csd:id></csd:provider></csd:requestParams>',
+  parse_providers)
+
+class Metrics(object):
+  "Request counts and latencies of each stored function"
+  def __init__(self):
+    self._lock = threading.Lock()
+    self.reset()
+
+  def reset(self):
+    with self._lock:
+      # function -> [requests, failures, total seconds, max seconds]
+      self._functions = {}
+
+  def add(self, function, seconds, failed):
+    with self._lock:
+      stats = self._functions.setdefault(function, [0, 0, 0.0, 0.0])
+      stats[0] += 1
+      stats[1] += 1 if failed else 0
+      stats[2] += seconds
+      stats[3] = max(stats[3], seconds)
+
+  def snapshot(self):
+    "A dict of function -> {requests, failures, mean_seconds, max_seconds}"
+    with self._lock:
+      return dict((function, {"requests": n,
+                              "failures": failures,
+                              "mean_seconds": total / n,
+                              "max_seconds": longest})
+                  for function, (n, failures, total, longest) in self._functions.items())
+
+  def lines(self):
+    for function, stats in sorted(self.snapshot().items()):
+      yield "%s: %d requests, %d failed, mean %.3fs, max %.3fs" % (
+        function.rsplit(":", 1)[-1], stats["requests"], stats["failures"],
+        stats["mean_seconds"], stats["max_seconds"])
+
+class CSDClient(object):
+  "Runs stored functions over a pool of keep-alive connections"
+  def __init__(self, base_url=None, connect_timeout=None, read_timeout=None,
+               pool_size=None):
+    self.base_url = base_url or BASE_URL
+    self.timeout = (connect_timeout or CONNECT_TIMEOUT, read_timeout or READ_TIMEOUT)
+    pool_size = pool_size or POOL_SIZE
+    self.session = requests.Session()
+    for prefix in ("http://", "https://"):
+      self.session.mount(prefix, requests.adapters.HTTPAdapter(pool_connections=1,
+                                                               pool_maxsize=pool_size))
+    self.metrics = Metrics()
+
+  def url(self, document, function):
+    return self.base_url + document + BASE_URL_SUFFIX + function
+
+  def post(self, document, function, params):
+    "Call a stored function, returning the response body or None on failure"
+    file_set = {'file': ('query.xml', params, 'text/xml', {'Expires': '0'})}
+    start = time.time()
+    content = None
+    try:
+      r = self.session.post(self.url(document, function), files=file_set,
+                            timeout=self.timeout)
+      if r.status_code == 200:
+        content = r.content
+      else:
+        _log.warning("CSD %s failed, response code: %d", function, r.status_code)
+    except requests.RequestException, err:
+      _log.warning("CSD %s failed: %s", function, err)
+    self.metrics.add(function, time.time() - start, content is None)
+    return content
+
+  def run(self, query):
+    "Run a Query, returning the response body or None on failure"
+    return self.post(query.document, query.function, query.params)
+
+  def entries(self, query):
+    """Run a Query, parsing the response as it is received
+
+    Returns the list of entries, or None on failure.
+    """
+    file_set = {'file': ('query.xml', query.params, 'text/xml', {'Expires': '0'})}
+    start = time.time()
+    entries = None
+    try:
+      r = self.session.post(self.url(query.document, query.function), files=file_set,
+                            timeout=self.timeout, stream=True)
+      try:
+        if r.status_code == 200:
+          r.raw.decode_content = True
+          entries = list(query.parse(r.raw))
+        else:
+          _log.warning("CSD %s failed, response code: %d", query.function, r.status_code)
+      finally:
+        r.close()
+    except requests.RequestException, err:
+      _log.warning("CSD %s failed: %s", query.function, err)
+    except ET.ParseError, err:
+      _log.warning("CSD %s returned invalid XML: %s", query.function, err)
+    self.metrics.add(query.function, time.time() - start, entries is None)
+    return entries
+
+_client = None
+_client_lock = threading.Lock()
+
+def client():
+  "The CSDClient shared by this process"
+  global _client
+  with _client_lock:
+    if _client is None:
+      _client = CSDClient()
+    return _client
+
+def fetch(query):
+  "Run a query with the shared client, returning its entries or None"
+  return client().entries(query)
+
+# The reference data served by the API, see csdcache.refresh_all()
+REFERENCE_QUERIES = [REGIONS, FACILITIES, PROVIDERS]
@@ -0,0 +1,219 @@
+# Copyright 2013 Switchboard, Inc
+"""Cache of parsed CSD query results
+
+The region, facility and health worker directories change rarely but are
+thousands of entries each, so the views serve them from this cache instead
+of querying the CSD service on every request.  Results are keyed by CSD
+document, stored function and request parameters, and kept in two tiers:
+
+  memory --- an LRU of parsed entries in each process
+  files --- optional JSON files under settings.CSD_CACHE_ROOT, shared by the
+            processes of a host
+
+An entry older than CSD_CACHE_TTL is still served while a background thread
+revalidates it.  Revalidation asks only for the records updated since the
+newest record@updated already cached and merges them in by id; every
+CSD_CACHE_FULL_REFRESH seconds the whole result is fetched again so that
+deleted records drop out.  Only a result that was never fetched makes a
+request wait on the CSD service.  The refresh_csd_cache command refreshes
+every reference query, and can be run from cron to keep the file tier warm.
+"""
+
+import collections
+import errno
+import hashlib
+import json
+import logging
+import os
+import os.path
+import threading
+import time
+
+from django.conf import settings
+
+from sb.healthworker import csd
+
+_log = logging.getLogger("sb.healthworker.csdcache")
+
+TTL = getattr(settings, "CSD_CACHE_TTL", 300)
+FULL_REFRESH = getattr(settings, "CSD_CACHE_FULL_REFRESH", 24 * 3600)
+MAX_ENTRIES = getattr(settings, "CSD_CACHE_MAX_ENTRIES", 64)
+CACHE_ROOT = getattr(settings, "CSD_CACHE_ROOT", None)
+
+class Entry(object):
+  "The parsed result of a query"
+  def __init__(self, entries, fetched_at, loaded_at):
+    self.entries = entries
+    # When the entry was last revalidated
+    self.fetched_at = fetched_at
+    # When the whole result was last fetched
+    self.loaded_at = loaded_at
+    self.updated = _max_updated(entries)
+
+  def to_json(self):
+    return {"entries": self.entries,
+            "fetched_at": self.fetched_at,
+            "loaded_at": self.loaded_at}
+
+  @classmethod
+  def from_json(cls, data):
+    return cls(data["entries"], data["fetched_at"], data["loaded_at"])
+
+def _max_updated(entries):
+  "The newest record@updated time of a list of entries"
+  times = [i["updated_at"] for i in entries if i.get("updated_at") not in (None, "null")]
+  return max(times) if times else None
+
+def _merge(entries, changed):
+  "Replace entries by id with changed entries, appending new ones"
+  changed_by_id = collections.OrderedDict((i["id"], i) for i in changed)
+  result = []
+  for entry in entries:
+    result.append(changed_by_id.pop(entry["id"], entry))
+  result.extend(changed_by_id.values())
+  return result
+
+class LRU(object):
+  "A thread-safe dict holding at most size items, dropping the least recently used"
+  def __init__(self, size):
+    self.size = size
+    self._items = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def get(self, key):
+    with self._lock:
+      value = self._items.pop(key, None)
+      if value is not None:
+        self._items[key] = value
+      return value
+
+  def put(self, key, value):
+    with self._lock:
+      self._items.pop(key, None)
+      self._items[key] = value
+      while len(self._items) > self.size:
+        self._items.popitem(last=False)
+
+  def clear(self):
+    with self._lock:
+      self._items.clear()
+
+_memory = LRU(MAX_ENTRIES)
+
+def _cache_key(query):
+  return hashlib.sha1("\n".join(query.key())).hexdigest()
+
+def _file_path(key):
+  return os.path.join(CACHE_ROOT, key + ".json")
+
+def _read_file(key):
+  if not CACHE_ROOT:
+    return None
+  try:
+    with open(_file_path(key), "r") as a_file:
+      return Entry.from_json(json.load(a_file))
+  except IOError, err:
+    if err.errno != errno.ENOENT:
+      raise
+    return None
+  except ValueError:
+    _log.warning("ignoring corrupt CSD cache file %s", _file_path(key))
+    return None
+
+def _write_file(key, entry):
+  if not CACHE_ROOT:
+    return
+  try:
+    os.makedirs(CACHE_ROOT)
+  except OSError, err:
+    if err.errno != errno.EEXIST:
+      raise
+  path = _file_path(key)
+  tmp_path = "%s.%d.%d.tmp" % (path, os.getpid(), threading.current_thread().ident)
+  with open(tmp_path, "w") as a_file:
+    json.dump(entry.to_json(), a_file)
+  os.rename(tmp_path, path)
+
+def refresh(query, entry=None):
+  """Fetch a query, or only its changes since a cached entry
+
+  Returns the new Entry, or None if the CSD service failed.
+  """
+  now = time.time()
+  if entry is not None and entry.updated and now - entry.loaded_at < FULL_REFRESH:
+    changed = csd.fetch(query.updated_since(entry.updated))
+    if changed is None:
+      return None
+    entries = _merge(entry.entries, changed) if changed else entry.entries
+    new_entry = Entry(entries, now, entry.loaded_at)
+  else:
+    entries = csd.fetch(query)
+    if entries is None:
+      return None
+    new_entry = Entry(entries, now, now)
+  key = _cache_key(query)
+  _memory.put(key, new_entry)
+  _write_file(key, new_entry)
+  return new_entry
+
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+
+def _refresh_in_background(query, entry):
+  key = _cache_key(query)
+  with _refreshing_lock:
+    if key in _refreshing:
+      return
+    _refreshing.add(key)
+  def run():
+    try:
+      refresh(query, entry)
+    except Exception:
+      _log.exception("failed to refresh CSD query %s", query.name)
+    finally:
+      with _refreshing_lock:
+        _refreshing.discard(key)
+  thread = threading.Thread(target=run)
+  thread.daemon = True
+  thread.start()
+
+def get(query):
+  """Get the entries of a query, possibly stale
+
+  Returns None if the query was never fetched and the CSD service failed.
+  """
+  key = _cache_key(query)
+  now = time.time()
+  entry = _memory.get(key)
+  if entry is None or now - entry.fetched_at > TTL:
+    # Another process may have refreshed the file tier
+    shared = _read_file(key)
+    if shared is not None and (entry is None or shared.fetched_at > entry.fetched_at):
+      entry = shared
+      _memory.put(key, entry)
+  if entry is None:
+    entry = refresh(query)
+    return entry.entries if entry is not None else None
+  if now - entry.fetched_at > TTL:
+    _refresh_in_background(query, entry)
+  return entry.entries
+
+def invalidate():
+  "Drop every cached result, so the next get() of each query fetches it"
+  _memory.clear()
+  if CACHE_ROOT and os.path.isdir(CACHE_ROOT):
+    for name in os.listdir(CACHE_ROOT):
+      if name.endswith(".json"):
+        os.remove(os.path.join(CACHE_ROOT, name))
+
+def refresh_all(full=False):
+  "Refresh the reference queries, returns the names of the queries that failed"
+  failed = []
+  for query in csd.REFERENCE_QUERIES:
+    entry = None
+    if not full:
+      key = _cache_key(query)
+      entry = _memory.get(key) or _read_file(key)
+    if refresh(query, entry) is None:
+      failed.append(query.name)
+  return failed
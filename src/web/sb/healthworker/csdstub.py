@@ -0,0 +1,78 @@
+# Copyright 2013 Switchboard, Inc
+"""A local stand-in for the CSD service, for tests
+
+StubCSDServer answers careServicesRequest POSTs on a free local port with
+canned response bodies, and records the requests it receives:
+
+  server = StubCSDServer({csd.ORGANIZATION_SEARCH: regions_xml})
+  server.start()
+  client = csd.CSDClient(base_url=server.base_url)
+  ...
+  server.stop()
+"""
+
+import BaseHTTPServer
+import cgi
+import threading
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+  protocol_version = "HTTP/1.1"
+
+  def do_POST(self):
+    # /CSD/csr/<document>/careServicesRequest/<function>
+    parts = self.path.strip("/").split("/")
+    if len(parts) != 5 or parts[3] != "careServicesRequest":
+      self._respond(404, "")
+      return
+    document, function = parts[2], parts[4]
+    form = cgi.FieldStorage(fp=self.rfile, headers=self.headers,
+                            environ={"REQUEST_METHOD": "POST",
+                                     "CONTENT_TYPE": self.headers["Content-Type"]})
+    params = form.getvalue("file")
+    self.server.stub.requests.append((document, function, params))
+    body = self.server.stub.responses.get(function)
+    if callable(body):
+      body = body(document, params)
+    if body is None:
+      self._respond(500, "")
+    else:
+      self._respond(200, body)
+
+  def _respond(self, status, body):
+    self.send_response(status)
+    self.send_header("Content-Type", "text/xml")
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    pass
+
+class StubCSDServer(object):
+  """Serves responses, a dict of stored function -> body
+
+  A body may also be a function of (document, params) returning the body, or
+  None for a server error.
+  """
+  def __init__(self, responses):
+    self.responses = responses
+    self.requests = []
+    self._server = None
+    self._thread = None
+
+  @property
+  def base_url(self):
+    return "http://127.0.0.1:%d/CSD/csr/" % (self._server.server_port, )
+
+  def start(self):
+    self._server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), _Handler)
+    self._server.stub = self
+    self._thread = threading.Thread(target=self._server.serve_forever)
+    self._thread.daemon = True
+    self._thread.start()
+    return self
+
+  def stop(self):
+    self._server.shutdown()
+    self._server.server_close()
+    self._thread.join()
@@ -0,0 +1,290 @@
+# Copyright 2013 Switchboard, Inc
+"""Bulk closed user group (CUG) membership updates
+
+The /cug page uploads a CSV file with a "phone" column.  The file is spooled
+to disk and queued as a job, which the process_cug_jobs command imports:
+rows are parsed as they are read, phone numbers are normalized and applied a
+batch at a time with bulk UPDATEs, and each batch's channel log entries and
+SMS jobs are written together.  The job's progress is kept in a small JSON
+file under settings.CUG_JOB_ROOT so that any web worker can report it.
+
+An importing process holds a lock on the spooled upload, so a job left
+"running" by a process that died is unlocked, and is resumed from the offset
+after the last batch saved.  The batch being imported when the process died
+may be applied again, which changes no worker that it already changed.
+"""
+
+import csv
+import errno
+import fcntl
+import itertools
+import json
+import logging
+import os
+import os.path
+import re
+import time
+import uuid
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from sb.healthworker import models
+import sb.logchan
+import sb.smsqueue
+
+_log = logging.getLogger("sb.healthworker.cug")
+
+JOB_ROOT = getattr(settings, "CUG_JOB_ROOT", "cug-jobs")
+BATCH_SIZE = 500
+
+_job_id_pat = re.compile(r"^[0-9a-f]{32}$")
+
+# The states of a job that's waiting to be imported or being imported
+PENDING_STATES = ("queued", "running")
+
+def normalize_tz_phone(phone_number):
+  if phone_number.startswith('255'):
+    return '+' + phone_number
+  elif phone_number.startswith('07'):
+    return '+255' + phone_number[1:]
+  elif phone_number.startswith('7'):
+    return '+255' + phone_number
+  else:
+    return phone_number
+
+_eol_pat = re.compile(r"\r\n|\r|\n")
+
+def iter_line_ends(chunks, offset=0):
+  """Split a stream of byte chunks into lines, yielding (line, end) pairs
+
+  end is the offset just after the line and its line break, counting from
+  offset, the offset of the first chunk.
+  """
+  buf = ""
+  for chunk in chunks:
+    buf += chunk
+    start = 0
+    while True:
+      match = _eol_pat.search(buf, start)
+      # A trailing \r may be the first half of a \r\n
+      if match is None or match.end() == len(buf) and match.group() == "\r":
+        break
+      yield buf[start:match.start()], offset + match.end()
+      start = match.end()
+    buf = buf[start:]
+    offset += start
+  end = offset + len(buf)
+  if buf.endswith("\r"):
+    buf = buf[:-1]
+  if buf:
+    yield buf, end
+
+def iter_lines(chunks):
+  "Split a stream of byte chunks into lines ending with \\r\\n, \\r or \\n"
+  for line, end in iter_line_ends(chunks):
+    yield line
+
+def iter_phones(lines):
+  "Yield the phone column of a CSV file"
+  for entry in csv.DictReader(lines):
+    phone = entry.get("phone")
+    if phone:
+      yield phone
+
+def _batches(items, size):
+  batch = []
+  for item in items:
+    batch.append(item)
+    if len(batch) >= size:
+      yield batch
+      batch = []
+  if batch:
+    yield batch
+
+def set_closed_user_group(phones, in_group):
+  """Bulk HealthWorker.set_closed_user_group for the workers with these phones
+
+  Returns the number of workers changed.
+  """
+  in_group = bool(in_group)
+  with transaction.atomic():
+    workers = models.HealthWorker.objects.filter(vodacom_phone__in=phones)
+    workers = workers.exclude(is_closed_user_group=in_group)
+    # Concurrent jobs with the same phones wait here, and then find the
+    # workers they were waiting for already changed
+    workers = workers.select_for_update().order_by("id")
+    changed = list(workers.values_list("id", "vodacom_phone", "language"))
+    if not changed:
+      return 0
+    models.HealthWorker.objects.filter(id__in=[i[0] for i in changed]).update(
+      is_closed_user_group=in_group,
+      added_to_closed_user_group_at=timezone.now() if in_group else None)
+  sb.smsqueue.enqueue_many([(phone, models.closed_user_group_sms(language, in_group))
+                            for _, phone, language in changed])
+  sb.logchan.write_many("closed-user-group-change",
+                        [{"phone": phone, "change": in_group, "id": worker_id}
+                         for worker_id, phone, _ in changed])
+  return len(changed)
+
+def _job_dir():
+  try:
+    os.makedirs(JOB_ROOT)
+  except OSError, err:
+    if err.errno != errno.EEXIST:
+      raise
+  return JOB_ROOT
+
+def _job_path(job_id, ext):
+  return os.path.join(_job_dir(), job_id + ext)
+
+def _save_job(job):
+  path = _job_path(job["id"], ".json")
+  tmp_path = path + ".tmp"
+  with open(tmp_path, "w") as a_file:
+    json.dump(job, a_file)
+  os.rename(tmp_path, path)
+
+def get_job(job_id):
+  "Get a job's progress, or None if there's no such job"
+  if not _job_id_pat.match(job_id):
+    return None
+  try:
+    with open(_job_path(job_id, ".json"), "r") as a_file:
+      return json.load(a_file)
+  except IOError, err:
+    if err.errno != errno.ENOENT:
+      raise
+    return None
+
+class _LineOffsets(object):
+  "The lines of (line, end) pairs, keeping the end of the last line read"
+  def __init__(self, lines, offset):
+    self._lines = lines
+    self.offset = offset
+
+  def __iter__(self):
+    return self
+
+  def next(self):
+    line, self.offset = next(self._lines)
+    return line
+
+def _read_lines(a_file, offset):
+  a_file.seek(offset)
+  return iter_line_ends(iter(lambda: a_file.read(64 * 1024), ""), offset)
+
+def _save_progress(job):
+  job["heartbeat_at"] = time.time()
+  _save_job(job)
+
+def _import_rows(job, a_file):
+  "Import the rows after job's bytes_read, saving progress after every batch"
+  header = next(_read_lines(a_file, 0), None)
+  if header is None:
+    return
+  header_line, header_end = header
+  job["bytes_read"] = max(job["bytes_read"], header_end)
+  # csv reads a row's lines only when asked for the row, so rows.offset is
+  # the end of the last row read
+  rows = _LineOffsets(_read_lines(a_file, job["bytes_read"]), job["bytes_read"])
+  for batch in _batches(iter_phones(itertools.chain([header_line], rows)), BATCH_SIZE):
+    phones = [normalize_tz_phone(i) for i in batch]
+    job["added"] += set_closed_user_group(phones, True)
+    job["phones"] += len(phones)
+    job["bytes_read"] = rows.offset
+    _save_progress(job)
+  job["bytes_read"] = rows.offset
+
+def _lock(a_file):
+  "Lock a spooled upload until it's closed, False if another process has it"
+  try:
+    fcntl.flock(a_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+  except IOError, err:
+    if err.errno not in (errno.EAGAIN, errno.EACCES):
+      raise
+    return False
+  return True
+
+def run_import(job_id):
+  """Import a queued job's spooled upload, or resume an abandoned one
+
+  Returns the job, or None if it's done or another process is importing it.
+  """
+  path = _job_path(job_id, ".csv")
+  try:
+    a_file = open(path, "rb")
+  except IOError, err:
+    if err.errno != errno.ENOENT:
+      raise
+    return None
+  with a_file:
+    if not _lock(a_file):
+      return None
+    # Another process may have finished the job before it was locked
+    job = get_job(job_id)
+    if job is None or job["state"] not in PENDING_STATES:
+      return None
+    job["state"] = "running"
+    job["pid"] = os.getpid()
+    _save_progress(job)
+    try:
+      _import_rows(job, a_file)
+    except Exception, err:
+      _log.exception("CUG import %s failed", job["id"])
+      job["state"] = "failed"
+      job["error"] = unicode(err)
+    else:
+      job["state"] = "done"
+    job["finished_at"] = time.time()
+    _save_job(job)
+    os.remove(path)
+  return job
+
+def pending_job_ids():
+  "The ids of the jobs queued or running, oldest first"
+  jobs = []
+  for name in os.listdir(_job_dir()):
+    if name.endswith(".json"):
+      job = get_job(name[:-len(".json")])
+      if job is not None and job["state"] in PENDING_STATES:
+        jobs.append(job)
+  jobs.sort(key=lambda job: job["started_at"])
+  return [job["id"] for job in jobs]
+
+def run_pending():
+  "Import the queued jobs and resume the abandoned ones, returns those jobs"
+  jobs = []
+  for job_id in pending_job_ids():
+    job = run_import(job_id)
+    if job is not None:
+      jobs.append(job)
+  return jobs
+
+def start_import(uploaded_file, background=True):
+  """Spool an uploaded members file and queue its import
+
+  Returns the job id.  The process_cug_jobs command imports queued jobs;
+  with background=False the import runs before returning.
+  """
+  job = {
+    "id": uuid.uuid4().hex,
+    "state": "queued",
+    "bytes": uploaded_file.size,
+    "bytes_read": 0,
+    "phones": 0,
+    "added": 0,
+    "error": None,
+    "pid": None,
+    "started_at": time.time(),
+    "heartbeat_at": None,
+    "finished_at": None}
+  # The upload is complete before the job is visible
+  with open(_job_path(job["id"], ".csv"), "wb") as a_file:
+    for chunk in uploaded_file.chunks():
+      a_file.write(chunk)
+  _save_job(job)
+  if not background:
+    run_import(job["id"])
+  return job["id"]
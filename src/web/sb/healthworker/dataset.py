@@ -1,15 +1,47 @@
+"""Runs the dataset modules in sb/healthworker/datasets
+
+A dataset module has a run() function and may declare:
+
+  SOURCES --- the names of the files in datasets/ it reads
+  DEPENDS --- the datasets that must be imported before it; without
+              DEPENDS it waits for every dataset before it
+
+A dataset is imported when it has no DataSet row.  The imports are not
+idempotent (they delete and recreate rows, and drop the links of registry
+records to health workers), so a dataset whose SOURCES changed since it was
+imported, by their SHA-1, is only reported, and imported again only when
+forced.  Datasets whose dependencies are met are run in parallel worker
+processes.
+"""
+
+import hashlib
+import multiprocessing
 import os
 import os.path
 import re
+import time
+import traceback
 
-from django.db import transaction
+from django.conf import settings
+from django.db import connections
+from django.utils import timezone
 
 from sb.healthworker import models
+from sb.healthworker.datasets import _bulk
+
+JOBS = getattr(settings, "DATASET_JOBS", 4)
 
 _dataset_dir = os.path.join(os.path.split(__file__)[0], "datasets")
 
 _module_pattern = re.compile(r"^([^_]\w+)[.]py$")
 
+# Actions of a plan
+RUN_NEW = "new"
+RUN_FORCED = "forced"
+SKIP_CHANGED = "changed, import it again with --force"
+SKIP_UNCHANGED = "unchanged"
+SKIP_NOT_SELECTED = "not selected"
+
 def get_datasets():
   paths = os.listdir(_dataset_dir)
   matches = filter(None, map(_module_pattern.match, paths))
@@ -19,15 +51,145 @@ def get_datasets():
 def _import(path):
   return reduce(getattr, path.split(".")[1:], __import__(path))
 
-def import_all_datasets():
-  datasets = get_datasets()
-  # FIXME: add natural sort
-  datasets.sort()
-  for dataset in datasets:
-    if not models.DataSet.objects.filter(key=dataset).count():
-      module = _import("sb.healthworker.datasets." + dataset)
-      module.run()
-      row = models.DataSet()
-      row.key = dataset
-      row.save()
+def _import_dataset(name):
+  return _import("sb.healthworker.datasets." + name)
+
+def content_hash(name):
+  "The SHA-1 of the source files of a dataset"
+  paths = getattr(_import_dataset(name), "SOURCES", [])
+  digest = hashlib.sha1()
+  for path in paths:
+    digest.update(path + "\0")
+    with open(os.path.join(_dataset_dir, path), "rb") as f:
+      for block in iter(lambda: f.read(1 << 20), ""):
+        digest.update(block)
+  return digest.hexdigest()
+
+def dependencies(name, names):
+  "The datasets of names that name must wait for"
+  depends = getattr(_import_dataset(name), "DEPENDS", None)
+  if depends is None:
+    return [i for i in names if i < name]
+  return [i for i in depends if i in names]
+
+def plan(only=None, force=False):
+  """Get (dataset, action, content hash) for every dataset, in order
+
+  With force, the selected datasets are imported again whether or not they
+  changed.  A dataset imported before hashes were recorded is taken to be
+  unchanged.
+  """
+  rows = {}
+  for row in models.DataSet.objects.order_by("-id"):
+    rows[row.key] = row
+  result = []
+  for name in sorted(get_datasets()):
+    if only and name not in only:
+      result.append((name, SKIP_NOT_SELECTED, None))
+      continue
+    digest = content_hash(name)
+    row = rows.get(name)
+    if row is None:
+      action = RUN_NEW
+    elif force:
+      action = RUN_FORCED
+    elif row.content_hash is None or row.content_hash == digest:
+      action = SKIP_UNCHANGED
+    else:
+      action = SKIP_CHANGED
+    result.append((name, action, digest))
+  return result
+
+def _run(name):
+  "Run a dataset, returns (seconds, Stats of its loaders)"
+  _bulk.take_stats()
+  started_at = time.time()
+  _import_dataset(name).run()
+  return time.time() - started_at, _bulk.take_stats()
+
+def _run_in_worker(name):
+  try:
+    return True, _run(name)
+  except Exception:
+    return False, traceback.format_exc()
+  finally:
+    connections.close_all()
+
+def _record(name, digest, seconds, stats):
+  row = models.DataSet.objects.filter(key=name).order_by("id").first()
+  if row is None:
+    row = models.DataSet(key=name)
+  else:
+    row.updated_at = timezone.now()
+  row.content_hash = digest
+  row.duration = seconds
+  row.rows = sum(i.rows for i in stats)
+  row.save()
+
+def import_all_datasets(only=None, dry_run=False, jobs=None, report=None, force=False):
+  """Import the new datasets
+
+  only limits the run to the named datasets, force imports them again (see
+  plan).  report is called with each line of progress.  Returns the names of
+  the datasets that failed.
+  """
+  if report is None:
+    report = lambda line: None
+  jobs = jobs or JOBS
+  steps = plan(only, force)
+  for name, action, _ in steps:
+    if action not in (RUN_NEW, RUN_FORCED) or dry_run:
+      report("%s: %s" % (name, action))
+  if dry_run:
+    return []
 
+  digests = dict((name, digest) for name, action, digest in steps
+                 if action in (RUN_NEW, RUN_FORCED))
+  pending = sorted(digests)
+  depends = dict((name, dependencies(name, pending)) for name in pending)
+  total = len(pending)
+  finished = 0
+  failed = []
+  while pending:
+    blocked = [i for i in pending if set(depends[i]) & set(failed)]
+    for name in blocked:
+      report("%s: not run, a dependency failed" % (name, ))
+      failed.append(name)
+      pending.remove(name)
+    ready = [i for i in pending if not set(depends[i]) & set(pending)]
+    if not ready:
+      for name in pending:
+        report("%s: not run, its dependencies form a cycle" % (name, ))
+      failed.extend(pending)
+      break
+    for name in ready:
+      pending.remove(name)
+    if jobs > 1 and len(ready) > 1:
+      # Workers must not share the parent's database connection
+      connections.close_all()
+      pool = multiprocessing.Pool(min(jobs, len(ready)))
+      try:
+        results = [(name, pool.apply_async(_run_in_worker, (name, ))) for name in ready]
+        outcomes = [(name, result.get()) for name, result in results]
+      finally:
+        pool.close()
+        pool.join()
+    else:
+      outcomes = []
+      for name in ready:
+        try:
+          outcomes.append((name, (True, _run(name))))
+        except Exception:
+          outcomes.append((name, (False, traceback.format_exc())))
+    for name, (ok, outcome) in outcomes:
+      finished += 1
+      if not ok:
+        report("[%d/%d] %s: failed\n%s" % (finished, total, name, outcome))
+        failed.append(name)
+        continue
+      seconds, stats = outcome
+      _record(name, digests[name], seconds, stats)
+      report("[%d/%d] %s: %.1fs" % (finished, total, name, seconds))
+      for i in stats:
+        report("  " + i.line())
+  return failed
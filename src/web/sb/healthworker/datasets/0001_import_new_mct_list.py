@@ -3,22 +3,26 @@ import re
 
 from django.db import transaction
 
+from sb.healthworker.datasets import _bulk
 from sb.healthworker.datasets import _helpers
-from sb.healthworker.models import MCTRegistration, Specialty
+from sb.healthworker.models import MCTRegistration, specialty_tree
+
+SOURCES = ['mct-20130307-individual.csv']
+DEPENDS = []
 
 def remove_unlinked_registration_entries():
   MCTRegistration.objects.filter(health_worker__isnull=True).delete()
 
-def import_new_entry(item):
+def import_new_entry(item, tree, loader):
   worker = MCTRegistration()
   worker.registration_type, worker.registration_number = parse_registration_number(item["Registration No"])
   worker.address = item["Address"]
   worker.birthdate = parse_dob(item["DOB"])
-  worker.save()
+  specialty_ids = []
   cadre = None
   if item["Cadre"]:
-    for cadre in Specialty.objects.filter(abbreviation=item["Cadre"]).all():
-      worker.specialties.add(cadre)
+    for cadre in tree.by_abbreviation(item["Cadre"]):
+      specialty_ids.append(cadre.id)
   worker.country = "TZ" if item["Nationality"] == "Tanzanian" else None
   worker.cadre = item["Cadre"]
   worker.category = item["Category"]
@@ -35,13 +39,11 @@ def import_new_entry(item):
   worker.qualification_specialization_2 = item["Specialization 2"]
   worker.specialty = item["Specialty"]
   if cadre and item["Specialty"]:
-    specialties = Specialty.objects.filter(title__iexact=item["Specialty"])
-    for s in specialties:
-      if s.is_child_of(cadre):
-        worker.specialties.add(s)
+    for s in tree.by_title(item["Specialty"]):
+      if tree.is_child_of(s.id, cadre.id):
+        specialty_ids.append(s.id)
         worker.specialty_duration = item["DUR"]
-        worker.save()
-  worker.save()
+  loader.create(worker, many={"specialties": specialty_ids})
 
 def parse_dob(s):
   """Parse the date of birth column
@@ -68,11 +70,13 @@ def parse_registration_number(reg_number):
 
 def run():
   path = _helpers.get_path('mct-20130307-individual.csv')
-  mct_rows = _helpers.read_csv(path)
-  with transaction.commit_on_success():
+  tree = specialty_tree.get()
+  with transaction.atomic():
     remove_unlinked_registration_entries()
-    for mct_row in mct_rows:
-      import_new_entry(mct_row)
+    loader = _bulk.BulkLoader(MCTRegistration, "mct registrations")
+    for mct_row in _helpers.iter_csv(path):
+      import_new_entry(mct_row, tree, loader)
+    loader.finish()
 
 if __name__ == '__main__':
   run()
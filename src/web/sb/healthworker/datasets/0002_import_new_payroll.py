@@ -7,11 +7,12 @@ import sys
 from django.db import transaction
 
 from sb.healthworker import models
+from sb.healthworker import verification
+from sb.healthworker.datasets import _bulk
 from sb.healthworker.datasets import _helpers
 
-def _first(x):
-  for i in x:
-    return i
+SOURCES = ['payroll_payroll 1 Mar 2013.csv']
+DEPENDS = ['0001_import_new_mct_list']
 
 # swahili months
 _months = {
@@ -62,35 +63,58 @@ def _parse_birth_date(s):
       except ValueError:
         pass
 
-def import_new_payroll(item):
-  pr = _first(models.MCTPayroll.objects.filter(check_number=item["check_number"]).all())
-  if pr is None:
-    pr = models.MCTPayroll()
-  pr.last_name = item["last_name"]
-  pr.name = item["full_name"]
-  pr.designation = item["designation"]
-  if item["designation"]:
-    pr.specialty = _first(models.Specialty.objects.filter(title__iexact=item["designation"]).all())
-  if item["district"]:
-    pr.facility = _first(models.Facility.objects.filter(title__iexact=item["district"]).all())
-    pr.region = _first(models.Region.objects.filter(title__iexact=item["district"]).all())
-  pr.birthdate = _parse_birth_date(item["date_of_birth"])
-  pr.check_number = item["check_number"]
-  pr.district = item["district"]
-  pr.save()
+class PayrollImport(object):
+  "Loads payroll rows, updating the existing rows with the same check numbers"
+  fields = ["last_name", "name", "designation", "specialty", "facility",
+            "region", "birthdate", "check_number", "district"]
+
+  def __init__(self):
+    self.loader = _bulk.BulkLoader(models.MCTPayroll, "mct payroll", update_fields=self.fields)
+    self.specialties = _bulk.Lookup(models.Specialty.objects, "title")
+    self.facilities = _bulk.Lookup(models.Facility.objects, "title")
+    self.regions = _bulk.Lookup(models.Region.objects, "title")
+    # check number -> existing row, the first with each check number
+    self.existing = {}
+    rows = models.MCTPayroll.objects.order_by("-id")
+    for row in rows.only("id", "check_number", "specialty", "facility", "region").iterator():
+      self.existing[row.check_number] = row
+    # check number -> row created by this import
+    self.new = {}
+
+  def add(self, item):
+    pr = self.new.get(item["check_number"])
+    is_new = pr is None and item["check_number"] not in self.existing
+    if pr is None:
+      pr = self.existing.get(item["check_number"]) or models.MCTPayroll()
+    pr.last_name = item["last_name"]
+    pr.name = item["full_name"]
+    pr.designation = item["designation"]
+    if item["designation"]:
+      pr.specialty_id = self.specialties.get(item["designation"])
+    if item["district"]:
+      pr.facility_id = self.facilities.get(item["district"])
+      pr.region_id = self.regions.get(item["district"])
+    pr.birthdate = _parse_birth_date(item["date_of_birth"])
+    pr.check_number = item["check_number"]
+    pr.district = item["district"]
+    if is_new:
+      self.new[pr.check_number] = pr
+      self.loader.create(pr)
+    elif pr.id is not None:
+      self.loader.update(pr)
 
 def run():
-  with transaction.commit_on_success():
-    items = _helpers.read_csv(_helpers.get_path('payroll_payroll 1 Mar 2013.csv'),
+  with transaction.atomic():
+    payroll = PayrollImport()
+    items = _helpers.iter_csv(_helpers.get_path('payroll_payroll 1 Mar 2013.csv'),
                               fields=["id", "full_name", "last_name",
                                       "check_number", "date_of_birth",
                                       "designation", "district"])
     for item in items:
-      import_new_payroll(item)
+      payroll.add(item)
+    payroll.loader.finish()
 
-    for hw in models.HealthWorker.objects.all():
-      hw.auto_verify()
+  verification.verify_unverified()
 
 if __name__ == '__main__':
   run()
-
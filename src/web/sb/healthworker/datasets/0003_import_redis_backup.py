@@ -1,6 +1,9 @@
 from sb.healthworker.datasets import _redis_import
 from sb.healthworker.datasets import _helpers
 
+SOURCES = ['kv-backup-20130715.json']
+DEPENDS = []
+
 def run():
   _redis_import.import_redis_backup(_helpers.get_path('kv-backup-20130715.json'))
 
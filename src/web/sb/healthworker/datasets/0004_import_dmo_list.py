@@ -3,9 +3,13 @@ import re
 
 from django.db import transaction
 
+from sb.healthworker.datasets import _bulk
 from sb.healthworker.datasets import _helpers
 from sb.healthworker.models import DMORegistration
 
+SOURCES = ['dmo_list_11Feb13.csv']
+DEPENDS = []
+
 # Useful during testing
 def remove_unlinked_registration_entries():
   DMORegistration.objects.filter(health_worker__isnull=True).delete()
@@ -23,7 +27,7 @@ def parse_phone_number(phone_number):
   if phone_number:
     return "+255%s" % (phone_number)
 
-def import_new_entry(item):
+def import_new_entry(item, loader):
   # Strip all values of leading and trailing whitespace
   for k,v in item.items():
     if item[k] is not None:
@@ -34,6 +38,7 @@ def import_new_entry(item):
   # Ignore records with no name
   worker.name = ' '.join(filter(bool, [item["FirstName"], item["MiddleName"], item["LastName"]]))
   if not worker.name:
+    loader.skip()
     return
 
   worker.phone_number = parse_phone_number(item["Vodacom"])
@@ -48,15 +53,16 @@ def import_new_entry(item):
   worker.gender = item["Gender"]
   worker.duty_station = item["DutyStation"]
   worker.department = item["Dep"]
-  worker.save()
+  loader.create(worker)
 
 def run():
   path = _helpers.get_path('dmo_list_11Feb13.csv')
-  rows = _helpers.read_csv(path)
-  with transaction.commit_on_success():
+  with transaction.atomic():
     remove_unlinked_registration_entries()
-    for row in rows:
-      import_new_entry(row)
+    loader = _bulk.BulkLoader(DMORegistration, "dmo registrations")
+    for row in _helpers.iter_csv(path):
+      import_new_entry(row, loader)
+    loader.finish()
 
 if __name__ == '__main__':
   run()
@@ -1,6 +1,9 @@
 from sb.healthworker.datasets import _ngo_import
 from sb.healthworker.models import NGORegistration
 
+SOURCES = ['helpage_13Sept2013.csv']
+DEPENDS = []
+
 def run():
   _ngo_import.import_ngo_list('helpage_13Sept2013.csv', 'HelpAge', 1)
 
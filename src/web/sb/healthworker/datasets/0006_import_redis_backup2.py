@@ -1,6 +1,9 @@
 from sb.healthworker.datasets import _redis_import
 from sb.healthworker.datasets import _helpers
 
+SOURCES = ['kv-backup-20131005.json']
+DEPENDS = ['0003_import_redis_backup']
+
 def run():
   _redis_import.import_redis_backup(_helpers.get_path('kv-backup-20131005.json'))
 
@@ -0,0 +1,199 @@
+# Copyright 2013 Switchboard, Inc
+"""Bulk loading for the dataset importers
+
+An importer streams its rows, resolves foreign keys through Lookups loaded
+with one query each, and hands the model instances it builds to a
+BulkLoader, which writes them CHUNK_SIZE at a time: new rows with
+bulk_create() and changed rows with one UPDATE per field.
+
+bulk_create() and QuerySet.update() skip the post_save signals, so the
+loader drops the registry indexes of its model when it finishes.
+"""
+
+import collections
+import logging
+import time
+
+from django.conf import settings
+from django.db.models import Case, Max, Value, When
+
+from sb.healthworker import registry_index
+
+_log = logging.getLogger("sb.healthworker.datasets")
+
+CHUNK_SIZE = getattr(settings, "DATASET_CHUNK_SIZE", 1000)
+
+# Stats of the loaders finished since the last take_stats()
+_finished = []
+
+def take_stats():
+  "Get and forget the Stats of the loaders finished so far"
+  result = list(_finished)
+  del _finished[:]
+  return result
+
+class Stats(object):
+  def __init__(self, name):
+    self.name = name
+    self.created = 0
+    self.updated = 0
+    self.skipped = 0
+    # reason -> rows skipped for it
+    self.skip_reasons = collections.Counter()
+    self.started_at = time.time()
+    self.finished_at = None
+
+  @property
+  def rows(self):
+    return self.created + self.updated + self.skipped
+
+  def elapsed(self):
+    return (self.finished_at or time.time()) - self.started_at
+
+  def rate(self):
+    "Rows per second"
+    elapsed = self.elapsed()
+    return self.rows / elapsed if elapsed > 0 else 0.0
+
+  def line(self):
+    line = "%s: %d rows (%d created, %d updated, %d skipped) in %.1fs, %.0f rows/s" % (
+      self.name, self.rows, self.created, self.updated, self.skipped,
+      self.elapsed(), self.rate())
+    if self.skip_reasons:
+      line += "; skipped " + ", ".join("%s: %d" % (reason, count)
+                                       for reason, count in sorted(self.skip_reasons.items()))
+    return line
+
+def _lower(value):
+  return value.strip().lower()
+
+class Lookup(object):
+  """Map a field's values to row ids, loaded with one query
+
+  Values are compared after normalize, case-insensitively by default; when
+  several rows share a value the one with the lowest id wins.
+  """
+  def __init__(self, query_set, field, normalize=_lower):
+    self._normalize = normalize
+    self._ids = {}
+    for row_id, value in query_set.order_by("id").values_list("id", field):
+      if value is not None:
+        self._ids.setdefault(normalize(value), row_id)
+
+  def get(self, value):
+    "The id of the row with value, or None"
+    if not value:
+      return None
+    return self._ids.get(self._normalize(value))
+
+def bulk_update(model, rows, fields):
+  "Write fields of rows, which must have ids, with one UPDATE per field"
+  rows = list(rows)
+  if not rows:
+    return
+  ids = [row.id for row in rows]
+  query_set = model.objects.filter(id__in=ids)
+  for name in fields:
+    field = model._meta.get_field(name)
+    output_field = field.target_field if field.is_relation else field
+    whens = [When(id=row.id, then=Value(getattr(row, field.attname), output_field=output_field))
+             for row in rows]
+    query_set.update(**{field.attname: Case(*whens, output_field=output_field)})
+
+class BulkLoader(object):
+  """Buffers new and changed rows of a model and writes them a chunk at a time
+
+    loader = BulkLoader(models.MCTPayroll, "payroll", update_fields=["name"])
+    for item in items:
+      loader.create(models.MCTPayroll(...))
+    loader.finish()
+
+  Call finish() inside the import's transaction.
+  """
+  def __init__(self, model, name=None, chunk_size=None, update_fields=None):
+    self.model = model
+    self.chunk_size = chunk_size or CHUNK_SIZE
+    self.update_fields = update_fields or []
+    self.stats = Stats(name or model.__name__)
+    self._created = []
+    # row id -> row, so that the last change of a row wins
+    self._updated = collections.OrderedDict()
+
+  def create(self, row, many=None):
+    """Insert row, setting its id when its chunk is written
+
+    many maps a many-to-many field name to the ids of the rows to link.
+    """
+    self._created.append((row, many or {}))
+    if len(self._created) >= self.chunk_size:
+      self._flush_created()
+
+  def update(self, row):
+    "Write update_fields of row, which must have an id"
+    if row.id not in self._updated:
+      self.stats.updated += 1
+    self._updated[row.id] = row
+    if len(self._updated) >= self.chunk_size:
+      self._flush_updated()
+
+  def skip(self, reason=None):
+    "Count a row that was read but not loaded"
+    self.stats.skipped += 1
+    if reason:
+      self.stats.skip_reasons[reason] += 1
+
+  def _flush_created(self):
+    if not self._created:
+      return
+    rows = [row for row, _ in self._created]
+    links = [many for _, many in self._created]
+    last_id = self.model.objects.aggregate(last_id=Max("id"))["last_id"] or 0
+    self.model.objects.bulk_create(rows)
+    _assign_ids(self.model, rows, last_id)
+    if any(links):
+      self._link(rows, links)
+    self.stats.created += len(rows)
+    self._created = []
+
+  def _link(self, rows, links):
+    by_field = collections.defaultdict(list)
+    for row, many in zip(rows, links):
+      for name, related_ids in many.items():
+        by_field[name].extend((row.id, i) for i in sorted(set(related_ids)))
+    for name, pairs in by_field.items():
+      field = self.model._meta.get_field(name)
+      through = field.remote_field.through
+      source = field.m2m_column_name()
+      target = field.m2m_reverse_name()
+      through.objects.bulk_create([through(**{source: row_id, target: related_id})
+                                   for row_id, related_id in pairs])
+
+  def _flush_updated(self):
+    if self._updated:
+      bulk_update(self.model, self._updated.values(), self.update_fields)
+      self._updated.clear()
+
+  def flush(self):
+    self._flush_created()
+    self._flush_updated()
+
+  def finish(self):
+    "Write the buffered rows, returns the Stats"
+    self.flush()
+    registry_index.invalidate(self.model)
+    self.stats.finished_at = time.time()
+    _log.info(self.stats.line())
+    _finished.append(self.stats)
+    return self.stats
+
+def _assign_ids(model, rows, last_id):
+  """Set the ids of rows just inserted with bulk_create()
+
+  They are the ids after last_id, which holds while the import's
+  transaction is the only writer of the table.
+  """
+  if all(row.id is not None for row in rows):
+    return
+  ids = model.objects.filter(id__gt=last_id).order_by("id").values_list("id", flat=True)
+  for row, row_id in zip(rows, ids[:len(rows)]):
+    row.id = row_id
@@ -1,19 +1,215 @@
+"""Readers for the dataset files
+
+CSVReader and LineJSONReader generate the rows of a file one at a time, so a
+dataset of any size is imported in constant memory.  Both can read the file
+through mmap, start at a byte offset, and keep the byte offset just past the
+last row they generated in .offset.  batches() groups their rows into lists
+and can save that offset in a Checkpoint after each batch, so an interrupted
+import resumes where it stopped:
+
+  checkpoint = Checkpoint("kv-backup-20131005")
+  reader = LineJSONReader(path, start=checkpoint.load(path))
+  for batch in batches(reader, 500, checkpoint):
+    with transaction.atomic():
+      ...
+"""
+
+import contextlib
 import csv
+import errno
 import json
+import mmap
+import os
 import os.path
+import re
+
+from django.conf import settings
+
+# Bytes read from a dataset file at a time
+READ_SIZE = 64 * 1024
+BATCH_SIZE = getattr(settings, "DATASET_CHUNK_SIZE", 1000)
+CHECKPOINT_ROOT = getattr(settings, "DATASET_CHECKPOINT_ROOT", None)
+
+_line_end = re.compile(r"\r\n|\r|\n")
+
+@contextlib.contextmanager
+def _open(path, use_mmap=False):
+  with open(path, 'rb') as f:
+    if use_mmap and os.fstat(f.fileno()).st_size:
+      mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+      try:
+        yield mapped
+      finally:
+        mapped.close()
+    else:
+      yield f
+
+def iter_lines(path, start=0, use_mmap=False):
+  """Generate (end offset, line) for the lines of a file from byte offset start
+
+  Lines may end with "\\n", "\\r\\n" or "\\r", like a file opened with 'rU',
+  and are generated ending with "\\n".  end offset is the byte offset just
+  past the line.
+  """
+  with _open(path, use_mmap) as source:
+    source.seek(start)
+    offset = start
+    pending = ""
+    while True:
+      chunk = source.read(READ_SIZE)
+      if not chunk:
+        break
+      data = pending + chunk
+      position = 0
+      for match in _line_end.finditer(data):
+        if match.group() == "\r" and match.end() == len(data):
+          # The "\n" of a "\r\n" may be in the next chunk
+          break
+        yield offset + match.end(), data[position:match.start()] + "\n"
+        position = match.end()
+      offset += position
+      pending = data[position:]
+    if pending:
+      yield offset + len(pending), pending.rstrip("\r") + ("\n" if pending.endswith("\r") else "")
+
+class _Reader(object):
+  def __init__(self, path, start=0, use_mmap=False):
+    self.path = path
+    self.start = start
+    self.use_mmap = use_mmap
+    # The offset just past the last row generated
+    self.offset = start
+    self._line_end = start
+
+  def _lines(self, start):
+    for end, line in iter_lines(self.path, start, self.use_mmap):
+      self._line_end = end
+      yield line
+
+class CSVReader(_Reader):
+  """Generates the rows of a csv file as dicts
+
+  The keys are fields, or the first row of the file.
+  """
+  def __init__(self, path, fields=None, start=0, use_mmap=False):
+    super(CSVReader, self).__init__(path, start, use_mmap)
+    self.fields = fields
+
+  def __iter__(self):
+    fields = self.fields
+    start = self.start
+    if fields is None:
+      for end, line in iter_lines(self.path, 0, self.use_mmap):
+        fields = next(csv.reader([line]))
+        start = max(start, end)
+        break
+      else:
+        return
+    # A quoted value may span lines, so the offset is that of the last line
+    # the csv reader took
+    for row in csv.DictReader(self._lines(start), fieldnames=fields):
+      self.offset = self._line_end
+      yield row
+
+class LineJSONReader(_Reader):
+  "Generates the values of a file of JSON values, one per line"
+  def __iter__(self):
+    for line in self._lines(self.start):
+      self.offset = self._line_end
+      if line.strip():
+        yield json.loads(line)
+
+class Checkpoint(object):
+  """The offset an import has reached in a file, kept in CHECKPOINT_ROOT
+
+  Without a CHECKPOINT_ROOT nothing is kept and every import starts over.
+  An offset is only resumed from while the file has the size and
+  modification time it had when the offset was saved.
+  """
+  def __init__(self, name, root=None):
+    self.name = name
+    self.root = root or CHECKPOINT_ROOT
+    self._stat = None
+
+  def _path(self):
+    return os.path.join(self.root, self.name + ".checkpoint")
+
+  def load(self, path):
+    "The offset to resume reading path from"
+    stat = os.stat(path)
+    self._stat = [stat.st_size, int(stat.st_mtime)]
+    if not self.root:
+      return 0
+    try:
+      with open(self._path(), "r") as f:
+        data = json.load(f)
+    except IOError, err:
+      if err.errno != errno.ENOENT:
+        raise
+      return 0
+    except ValueError:
+      return 0
+    if data.get("stat") != self._stat:
+      return 0
+    return data.get("offset", 0)
+
+  def save(self, offset):
+    if not self.root:
+      return
+    try:
+      os.makedirs(self.root)
+    except OSError, err:
+      if err.errno != errno.EEXIST:
+        raise
+    path = self._path()
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp_path, "w") as f:
+      json.dump({"offset": offset, "stat": self._stat}, f)
+    os.rename(tmp_path, path)
+
+  def clear(self):
+    if not self.root:
+      return
+    try:
+      os.remove(self._path())
+    except OSError, err:
+      if err.errno != errno.ENOENT:
+        raise
+
+def batches(reader, size=BATCH_SIZE, checkpoint=None):
+  """Generate lists of at most size rows of reader
+
+  With a checkpoint, the offset past a batch is saved when the next batch is
+  asked for, that is after the caller is done with it, and the checkpoint is
+  cleared after the last batch.  Commit each batch before asking for the next.
+  """
+  batch = []
+  for row in reader:
+    batch.append(row)
+    if len(batch) >= size:
+      offset = reader.offset
+      yield batch
+      batch = []
+      if checkpoint is not None:
+        checkpoint.save(offset)
+  if batch:
+    yield batch
+  if checkpoint is not None:
+    checkpoint.clear()
 
 def read_csv(path, fields=None):
-  items = []
-  with open(path, 'rU') as f:
-    reader = csv.DictReader(f, fieldnames=fields)
-    items = list(reader)
-  return items
+  return list(CSVReader(path, fields))
+
+def iter_csv(path, fields=None):
+  "Generate the rows of a csv file as dicts, without reading it all"
+  return iter(CSVReader(path, fields))
 
 # Read LF terminated json
 def read_lf_json(path):
-  with open(path, 'r') as f:
-    data = f.readlines()
-  return [json.loads(line) for line in data]
+  return list(LineJSONReader(path))
+
+def iter_lf_json(path, start=0):
+  return iter(LineJSONReader(path, start))
 
 def get_path(*path_parts):
   return os.path.join(os.path.split(__file__)[0], *path_parts)
@@ -24,4 +220,3 @@ def first(qs):
   if r:
     return r[0]
   return None
-
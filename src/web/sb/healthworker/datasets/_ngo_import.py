@@ -3,6 +3,7 @@ import re
 
 from django.db import transaction
 
+from sb.healthworker.datasets import _bulk
 from sb.healthworker.datasets import _helpers
 from sb.healthworker.models import NGO, NGORegistration
 
@@ -13,7 +14,7 @@ def format_phone_number(phone_number):
   return phone_number
 
 #First Name,Middle Name,Last Name,Cadre,District,Duty Station,Vodacom #,Other Tel #,Payroll #,MCT License #,E-mail,Town/City,Region,NGO
-def import_new_entry(item, ngo, list_num):
+def import_new_entry(item, ngo, list_num, loader):
   # Strip all values of leading and trailing whitespace
   for k,v in item.items():
     if item[k] is not None:
@@ -24,6 +25,7 @@ def import_new_entry(item, ngo, list_num):
   # Ignore records with no name
   worker.name = ' '.join(filter(bool, [item["First Name"], item["Middle Name"], item["Last Name"]]))
   if not worker.name:
+    loader.skip()
     return
 
   worker.cadre = item["Cadre"]
@@ -38,13 +40,12 @@ def import_new_entry(item, ngo, list_num):
   worker.email = item["E-mail"]
   worker.city = item["Town/City"]
   worker.region = item["Region"]
-  worker.save()
+  loader.create(worker)
 
 def import_ngo_list(filename, ngo_name, list_num, replace=True):
   path = _helpers.get_path(filename)
-  rows = _helpers.read_csv(path)
 
-  with transaction.commit_on_success():
+  with transaction.atomic():
     # Get/create NGO
     ngo = NGO.get_or_create_by_name(ngo_name)
 
@@ -53,5 +54,7 @@ def import_ngo_list(filename, ngo_name, list_num, replace=True):
       NGORegistration.objects.filter(ngo=ngo, list_num=list_num).delete()
 
     # Import csv contents
-    for row in rows:
-      import_new_entry(row, ngo, list_num)
+    loader = _bulk.BulkLoader(NGORegistration, "%s registrations" % (ngo_name, ))
+    for row in _helpers.iter_csv(path):
+      import_new_entry(row, ngo, list_num, loader)
+    loader.finish()
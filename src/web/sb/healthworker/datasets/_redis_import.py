@@ -1,108 +1,163 @@
 import json
+import os.path
 import re
 
 from django.db import transaction
 
+from sb.healthworker.datasets import _bulk
 from sb.healthworker.datasets import _helpers
 from sb.healthworker.models import RegistrationStatus, RegistrationAnswer
 
+# Users read and written per transaction
+BATCH_SIZE = 500
+
 # Mapping from state names to our integer ids
+_states = {
+  'intro': RegistrationStatus.INTRO,
+  'no_vodacom_sim': RegistrationStatus.NO_VODACOM_SIM,
+  'cadre': RegistrationStatus.CADRE,
+  'cadre_other': RegistrationStatus.CADRE_OTHER,
+  'cadre_unavailable': RegistrationStatus.CADRE_UNAVAILABLE,
+  'cadre_unavailable_contact': RegistrationStatus.CADRE_UNAVAILABLE_CONTACT,
+  'cadre_unavailable_dont_contact': RegistrationStatus.CADRE_UNAVAILABLE_DONT_CONTACT,
+  'cheque_number': RegistrationStatus.CHECK_NUMBER,
+  'registration_number': RegistrationStatus.REGISTRATION_NUMBER,
+  'date_of_birth': RegistrationStatus.DATE_OF_BIRTH,
+  'dont_match_mct': RegistrationStatus.DONT_MATCH_MCT,
+  'dont_match_mct_end': RegistrationStatus.DONT_MATCH_MCT_END,
+  'first_name': RegistrationStatus.FIRST_NAME,
+  'surname': RegistrationStatus.LAST_NAME,
+  'terms_and_conditions': RegistrationStatus.TERMS,
+  'session1_end': RegistrationStatus.SESSION1_END,
+  'session1_abort_yn': RegistrationStatus.SESSION1_ABORT_YN,
+  'session1_abort': RegistrationStatus.SESSION1_ABORT,
+  'session2_intro': RegistrationStatus.SESSION2_INTRO,
+  'district_select': RegistrationStatus.DISTRICT_SELECT,
+  'district_reenter': RegistrationStatus.DISTRICT_REENTER,
+  'facility_type': RegistrationStatus.FACILITY_TYPE,
+  'facility_name': RegistrationStatus.FACILITY_NAME,
+  'facility_select': RegistrationStatus.FACILITY_SELECT,
+  'select_speciality': RegistrationStatus.SELECT_SPECIALTY,
+  'email': RegistrationStatus.EMAIL,
+  'session2_end': RegistrationStatus.SESSION2_END,
+  'end': RegistrationStatus.END}
+
 def _lookup_state(state_name):
-  return {
-    'intro': RegistrationStatus.INTRO,
-    'no_vodacom_sim': RegistrationStatus.NO_VODACOM_SIM,
-    'cadre': RegistrationStatus.CADRE,
-    'cadre_other': RegistrationStatus.CADRE_OTHER,
-    'cadre_unavailable': RegistrationStatus.CADRE_UNAVAILABLE,
-    'cadre_unavailable_contact': RegistrationStatus.CADRE_UNAVAILABLE_CONTACT,
-    'cadre_unavailable_dont_contact': RegistrationStatus.CADRE_UNAVAILABLE_DONT_CONTACT,
-    'cheque_number': RegistrationStatus.CHECK_NUMBER,
-    'registration_number': RegistrationStatus.REGISTRATION_NUMBER,
-    'date_of_birth': RegistrationStatus.DATE_OF_BIRTH,
-    'dont_match_mct': RegistrationStatus.DONT_MATCH_MCT,
-    'dont_match_mct_end': RegistrationStatus.DONT_MATCH_MCT_END,
-    'first_name': RegistrationStatus.FIRST_NAME,
-    'surname': RegistrationStatus.LAST_NAME,
-    'terms_and_conditions': RegistrationStatus.TERMS,
-    'session1_end': RegistrationStatus.SESSION1_END,
-    'session1_abort_yn': RegistrationStatus.SESSION1_ABORT_YN,
-    'session1_abort': RegistrationStatus.SESSION1_ABORT,
-    'session2_intro': RegistrationStatus.SESSION2_INTRO,
-    'district_select': RegistrationStatus.DISTRICT_SELECT,
-    'district_reenter': RegistrationStatus.DISTRICT_REENTER,
-    'facility_type': RegistrationStatus.FACILITY_TYPE,
-    'facility_name': RegistrationStatus.FACILITY_NAME,
-    'facility_select': RegistrationStatus.FACILITY_SELECT,
-    'select_speciality': RegistrationStatus.SELECT_SPECIALTY,
-    'email': RegistrationStatus.EMAIL,
-    'session2_end': RegistrationStatus.SESSION2_END,
-    'end': RegistrationStatus.END
-  }.get(state_name)
-
-def import_user_progress(user):
-  # Most of the information is in a json-encoded value
-  key = user.get('key', '')
-  value = user.get('value', '')
+  return _states.get(state_name)
+
+_status_fields = ["last_state", "num_ussd_sessions", "num_possible_timeouts", "registered"]
+_answer_fields = ["answer", "page"]
+
+def decode_user(record):
+  """Get (msisdn, user dict) from a backup record, or None for other records
 
+  Most of the information is in a json-encoded value.
+  """
   # Extract msisdn. Look for a key named "key" with a value like "users.+255752036824"
-  match = re.match(r'^users\.\+(\d+)$', key)
+  match = re.match(r'^users\.\+(\d+)$', record.get('key', ''))
   if not match:
-    return # there are other records we don't care about
-  msisdn = match.group(1)
-
-  # Decode value
+    return None # there are other records we don't care about
+  value = record.get('value', '')
   if value == '':
-    return
-  user = json.loads(value)
-
-  print("Importing user %s: %s" % (msisdn, user))
-
-  # Get or create RegistrationStatus
-  status = _helpers.first(RegistrationStatus.objects.filter(msisdn=msisdn))
-  if status is None:
-    status = RegistrationStatus()
-    status.msisdn = msisdn
-  status.last_state = _lookup_state(user.get('current_state'))
-  status.num_ussd_sessions = user.get('custom', {}).get('ussd_sessions')
-  status.num_possible_timeouts = user.get('custom', {}).get('possible_timeouts')
-  status.registered = user.get('custom', {}).get('registered', False)
-  status.save()
-
-  # Import answers
-  for k in user.get('answers', {}).keys():
-    state = _lookup_state(k)
-    if state is None:
-      print("Unknown state found in answers: %s" % k)
-
-    answer = _helpers.first(RegistrationAnswer.objects.filter(msisdn=msisdn, question=state))
-    if answer is None:
-      answer = RegistrationAnswer()
-      answer.msisdn = msisdn
-      answer.question = state
-    if user['answers'][k] is not None:
-      answer.answer = user['answers'][k]
-    answer.save()
-
-  # Import pages. Some questions are multi-page and this tells us which page
-  # they last saw. We do this separately because it's possible to have a page and
-  # not an answer
-  for k in user.get('pages', {}).keys():
-    state = _lookup_state(k)
-    if state is None:
-      print("Unknown state found in pages: %s" % k)
-
-    answer = _helpers.first(RegistrationAnswer.objects.filter(msisdn=msisdn, question=state))
-    if answer is None:
-      answer = RegistrationAnswer()
-      answer.msisdn = msisdn
-      answer.question = state
-    if user['pages'][k] is not None:
-      answer.page = user['pages'][k]
-    answer.save()
+    return None
+  return match.group(1), json.loads(value)
+
+def _values(row, fields):
+  return tuple(getattr(row, f) for f in fields)
+
+class ProgressImport(object):
+  """Upserts the RegistrationStatus and RegistrationAnswer rows of users
+
+  Each batch of users costs two queries to read the existing rows and a few
+  bulk writes, however many answers the users have.
+  """
+  def __init__(self):
+    self.statuses = _bulk.BulkLoader(RegistrationStatus, "registration statuses",
+                                     update_fields=_status_fields)
+    self.answers = _bulk.BulkLoader(RegistrationAnswer, "registration answers",
+                                    update_fields=_answer_fields)
+
+  def import_batch(self, records):
+    users = []
+    for record in records:
+      user = decode_user(record)
+      if user is None:
+        self.statuses.skip("not a user")
+      else:
+        users.append(user)
+    msisdns = set(msisdn for msisdn, _ in users)
+    statuses = {}
+    for status in RegistrationStatus.objects.filter(msisdn__in=msisdns):
+      statuses[status.msisdn] = status
+    # (msisdn, question) -> answer, the first of each
+    answers = {}
+    for answer in RegistrationAnswer.objects.filter(msisdn__in=msisdns).order_by("-id"):
+      answers[(answer.msisdn, answer.question)] = answer
+    # row -> its values before this batch
+    original = {}
+    for row in statuses.values():
+      original[row] = _values(row, _status_fields)
+    for row in answers.values():
+      original[row] = _values(row, _answer_fields)
+
+    for msisdn, user in users:
+      self.import_user(msisdn, user, statuses, answers)
+
+    for loader, rows, fields in [(self.statuses, statuses, _status_fields),
+                                 (self.answers, answers, _answer_fields)]:
+      for row in rows.values():
+        if row.id is None:
+          loader.create(row)
+        elif _values(row, fields) != original[row]:
+          loader.update(row)
+        else:
+          loader.skip("unchanged")
+      loader.flush()
+
+  def import_user(self, msisdn, user, statuses, answers):
+    last_state = _lookup_state(user.get('current_state'))
+    if last_state is None:
+      self.statuses.skip("unknown state %s" % (user.get('current_state'), ))
+      return
+    status = statuses.get(msisdn)
+    if status is None:
+      status = statuses[msisdn] = RegistrationStatus(msisdn=msisdn)
+    custom = user.get('custom', {})
+    status.last_state = last_state
+    status.num_ussd_sessions = custom.get('ussd_sessions')
+    status.num_possible_timeouts = custom.get('possible_timeouts')
+    status.registered = custom.get('registered', False)
+
+    # Import answers, and pages. Some questions are multi-page and pages
+    # tells us which page they last saw. It's possible to have a page and not
+    # an answer
+    for field, values in [('answer', user.get('answers', {})),
+                          ('page', user.get('pages', {}))]:
+      for k, value in values.items():
+        state = _lookup_state(k)
+        if state is None:
+          self.answers.skip("unknown state %s" % (k, ))
+          continue
+        answer = answers.get((msisdn, state))
+        if answer is None:
+          answer = answers[(msisdn, state)] = RegistrationAnswer(msisdn=msisdn, question=state)
+        if value is not None:
+          setattr(answer, field, value)
+
+  def finish(self):
+    self.statuses.finish()
+    self.answers.finish()
 
 def import_redis_backup(path):
-  data = _helpers.read_lf_json(path)
-  with transaction.commit_on_success():
-    for user in data:
-      import_user_progress(user)
+  """Import the users of a kv-backup, a batch per transaction
 
+  An interrupted import resumes after the last batch it committed.
+  """
+  name = os.path.splitext(os.path.basename(path))[0]
+  checkpoint = _helpers.Checkpoint(name)
+  progress = ProgressImport()
+  reader = _helpers.LineJSONReader(path, start=checkpoint.load(path))
+  for records in _helpers.batches(reader, BATCH_SIZE, checkpoint):
+    with transaction.atomic():
+      progress.import_batch(records)
+  progress.finish()
@@ -0,0 +1,117 @@
+# Copyright 2013 Switchboard, Inc
+"""Fuzzy name matching
+
+Names are compared token by token.  Tokens are the lower case alphabetic runs
+of a name; single letters (initials) are ignored.  A query name matches a
+record name when every query token can be paired with a different record
+token whose similarity is at least the threshold.  The record may have extra
+tokens, and token order does not matter, so "Bickford" matches "Brandon
+Bickford" and "Brandon Samson Bickford" matches "Bickford Brandon Samson".
+
+The score of a match is the mean similarity of the paired tokens.
+"""
+
+import re
+
+DEFAULT_ALGORITHM = "trigram"
+DEFAULT_THRESHOLD = 0.5
+
+_token_pat = re.compile(r"[^\W\d_]+", re.U)
+
+def tokens(name):
+  "Split a name into lower case tokens, dropping initials"
+  if not name:
+    return []
+  return [t for t in _token_pat.findall(name.lower()) if len(t) > 1]
+
+def ngrams(token, n):
+  "The set of n-grams of a token padded like PostgreSQL's pg_trgm"
+  padded = u" " * (n - 1) + token + u" "
+  return frozenset(padded[i:i + n] for i in range(len(padded) - n + 1))
+
+def _ngram_similarity(n):
+  def similarity(a, b):
+    if a == b:
+      return 1.0
+    grams_a = ngrams(a, n)
+    grams_b = ngrams(b, n)
+    shared = len(grams_a & grams_b)
+    return float(shared) / (len(grams_a) + len(grams_b) - shared)
+  return similarity
+
+def levenshtein_similarity(a, b):
+  "1 - edit distance / length of the longer token"
+  if a == b:
+    return 1.0
+  previous = range(len(b) + 1)
+  for i, char_a in enumerate(a):
+    current = [i + 1]
+    for j, char_b in enumerate(b):
+      current.append(min(previous[j + 1] + 1,
+                         current[j] + 1,
+                         previous[j] + (char_a != char_b)))
+    previous = current
+  return 1.0 - float(previous[-1]) / max(len(a), len(b))
+
+# Algorithm name -> (token similarity function, n-gram size used to find
+# candidate tokens in an index)
+ALGORITHMS = {
+  "trigram": (_ngram_similarity(3), 3),
+  "bigram": (_ngram_similarity(2), 2),
+  "levenshtein": (levenshtein_similarity, 2),
+}
+
+def get_algorithm(algorithm):
+  try:
+    return ALGORITHMS[algorithm]
+  except KeyError:
+    raise ValueError("unknown name matching algorithm %r" % (algorithm, ))
+
+def match_score(query_tokens, record_tokens, token_similarity):
+  """Score the best pairing of every query token with a distinct record token
+
+  token_similarity(query_token, record_token) returns a similarity, or None
+  if the pair is below the threshold.  Returns the mean similarity of the
+  best pairing, or None if some query token can't be paired.
+  """
+  if not query_tokens or len(query_tokens) > len(record_tokens):
+    return None
+  options = []
+  for q in query_tokens:
+    scored = []
+    for position, r in enumerate(record_tokens):
+      s = token_similarity(q, r)
+      if s is not None:
+        scored.append((s, position))
+    if not scored:
+      return None
+    scored.sort(reverse=True)
+    options.append(scored)
+
+  # Names have a handful of tokens, so a depth first search is cheap
+  best = [None]
+  def search(i, used, total):
+    if i == len(options):
+      if best[0] is None or total > best[0]:
+        best[0] = total
+      return
+    for s, position in options[i]:
+      if position not in used:
+        used.add(position)
+        search(i + 1, used, total + s)
+        used.remove(position)
+  search(0, set(), 0.0)
+  if best[0] is None:
+    return None
+  return best[0] / len(query_tokens)
+
+def score(query, name, algorithm=DEFAULT_ALGORITHM, threshold=DEFAULT_THRESHOLD):
+  "Score how well the name matches the query, or None if it doesn't"
+  similarity = get_algorithm(algorithm)[0]
+  def token_similarity(a, b):
+    s = similarity(a, b)
+    return s if s >= threshold else None
+  return match_score(tokens(query), tokens(name), token_similarity)
+
+def is_similar(query, name, algorithm=DEFAULT_ALGORITHM, threshold=DEFAULT_THRESHOLD):
+  return score(query, name, algorithm, threshold) is not None
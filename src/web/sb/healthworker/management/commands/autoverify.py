@@ -1,9 +1,18 @@
 from django.core.management.base import BaseCommand, CommandError
 from sb.healthworker.models import HealthWorker
+from sb.healthworker import blocking
+from sb.healthworker import verification
 
 class Command(BaseCommand):
   args = ''
-  help = 'HealthWorker.auto_verify'
+  help = 'HealthWorker.auto_verify for every unverified health worker, in bulk'
+
+  def add_arguments(self, parser):
+    parser.add_argument('--batch-size', type=int, default=verification.BATCH_SIZE,
+                        help=u'number of health workers verified per transaction')
+    parser.add_argument('--measure-recall', type=int, default=0, metavar='N',
+                        help=u'before verifying, compare blocked and full name'
+                             u' search for N unverified names')
 
   def handle(self, *args, **options):
     statuses = [
@@ -15,15 +24,25 @@ class Command(BaseCommand):
         "Verified By Name"
       ]
 
-    for hw in HealthWorker.objects.filter(verification_state=HealthWorker.UNVERIFIED).order_by('id').all():
-      hw.auto_verify()
-      if hw.verification_state != HealthWorker.UNVERIFIED:
-        status = statuses[hw.verification_state]
-        if hw.verification_state == HealthWorker.NAME_VERIFIED:
-          status += " (matched '%s')" % hw.get_matching_name()
-        print "'%s' (id #%d): %s" % (hw.name, hw.id, status)
+    if options['measure_recall']:
+      names = HealthWorker.objects.filter(verification_state=HealthWorker.UNVERIFIED)
+      names = list(names.order_by('?').values_list('name', flat=True)[:options['measure_recall']])
+      print "Blocking recall:"
+      for cls in verification.STAGES[-1].sources:
+        found, total = blocking.measure_recall(cls, names)
+        print "%s: %d of %d matches (%.1f%%)" % (cls.__name__, found, total,
+                                                 100.0 * found / (total or 1))
+
+    blocking.stats.reset()
+    report = verification.verify_unverified(batch_size=options['batch_size'])
+    print "Stages:"
+    for line in report.lines():
+      print line
+
+    print "Blocking:"
+    for line in blocking.stats.lines():
+      print line
 
     print "Summary:"
     for i in range(len(statuses)):
       print "%s: %d" % (statuses[i], HealthWorker.objects.filter(verification_state__exact=i).count())
-
@@ -1,11 +1,29 @@
 from django.core.management.base import BaseCommand, CommandError
-from sb.healthworker.dataset import import_all_datasets
+from sb.healthworker import dataset
 
 class Command(BaseCommand):
-  args = ''
-  help = 'import datasets'
+  help = 'Import the new datasets, and list the datasets whose files changed'
 
-  def handle(self, *args, **options):
-    import_all_datasets()
+  def add_arguments(self, parser):
+    parser.add_argument('--dry-run', action='store_true',
+                        help=u'list what would be imported without importing it')
+    parser.add_argument('--only', action='append', metavar='DATASET',
+                        help=u'import only this dataset, may be repeated')
+    parser.add_argument('--force', action='store_true',
+                        help=u'import the --only datasets again even if they were imported before')
+    parser.add_argument('--jobs', type=int, default=None,
+                        help=u'datasets to import at once (default settings.DATASET_JOBS)')
 
+  def handle(self, *args, **options):
+    if options['force'] and not options['only']:
+      raise CommandError("--force needs --only, the imports aren't safe to repeat")
+    failed = dataset.import_all_datasets(only=options['only'],
+                                         dry_run=options['dry_run'],
+                                         jobs=options['jobs'],
+                                         force=options['force'],
+                                         report=self._report)
+    if failed:
+      raise CommandError("failed to import: %s" % (", ".join(failed), ))
 
+  def _report(self, line):
+    print line
@@ -0,0 +1,28 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from sb.healthworker import cug
+
+class Command(BaseCommand):
+  help = 'Import the queued /cug uploads, resuming the ones a process left unfinished'
+
+  def add_arguments(self, parser):
+    parser.add_argument('--once', action='store_true',
+                        help=u'import the queued jobs and exit')
+    parser.add_argument('--poll', type=float, default=5.0,
+                        help=u'seconds to wait between looks for queued jobs')
+
+  def handle(self, *args, **options):
+    while True:
+      try:
+        for job in cug.run_pending():
+          print "%s: %s, %d phone numbers read, %d health workers added" % (
+            job["id"], job["state"], job["phones"], job["added"])
+      finally:
+        # Don't keep a connection open between polls
+        connection.close()
+      if options['once']:
+        break
+      time.sleep(options['poll'])
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand, CommandError
+import sb.smsqueue
+
+class Command(BaseCommand):
+  help = 'Send the SMSes queued in sb.smsqueue'
+
+  def add_arguments(self, parser):
+    parser.add_argument('--workers', type=int, default=sb.smsqueue.WORKERS,
+                        help=u'number of sender threads')
+    parser.add_argument('--once', action='store_true',
+                        help=u'send the jobs that are due and exit')
+    parser.add_argument('--poll', type=float, default=1.0,
+                        help=u'seconds to wait when the queue is empty')
+
+  def handle(self, *args, **options):
+    dispatcher = sb.smsqueue.Dispatcher(workers=options['workers'])
+    try:
+      if options['once']:
+        dispatcher.run_once()
+      else:
+        dispatcher.run_forever(poll_seconds=options['poll'])
+    finally:
+      dispatcher.close()
+      print "Sent: %d, retrying: %d, failed: %d" % (dispatcher.sent,
+                                                    dispatcher.retried,
+                                                    dispatcher.failed)
@@ -0,0 +1,54 @@
+import datetime
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from sb.healthworker import cug
+from sb import logchan_index
+
+def _date(value):
+  return datetime.datetime.strptime(value, "%Y-%m-%d").date()
+
+class Command(BaseCommand):
+  help = 'Index a channel log and print its entries about a phone, a health worker or a time range'
+
+  def add_arguments(self, parser):
+    parser.add_argument('--channel', default='closed-user-group-change',
+                        help=u'channel to query (default closed-user-group-change)')
+    parser.add_argument('--phone', help=u'entries about this phone number')
+    parser.add_argument('--id', type=int, help=u'entries about this health worker id')
+    parser.add_argument('--since', type=_date, metavar='YYYY-MM-DD',
+                        help=u'entries from this day on')
+    parser.add_argument('--until', type=_date, metavar='YYYY-MM-DD',
+                        help=u'entries up to and including this day')
+    parser.add_argument('--rebuild', action='store_true',
+                        help=u'read every day file again instead of the new entries')
+
+  def handle(self, *args, **options):
+    index = logchan_index.ChannelIndex(options['channel'])
+    try:
+      if options['rebuild']:
+        added = index.rebuild()
+      else:
+        added = index.update()
+      print "indexed %d new entries" % (added, )
+      start = options['since']
+      end = options['until'] + datetime.timedelta(days=1) if options['until'] else None
+      if options['phone']:
+        entries = index.by_phone(cug.normalize_tz_phone(options['phone']), start, end)
+      elif options['id'] is not None:
+        entries = index.by_id(options['id'], start, end)
+      elif start or end:
+        entries = index.between(start, end)
+      else:
+        return
+      for entry in entries:
+        when = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(entry["time"]))
+        data = entry["data"]
+        if "change" in data:
+          change = "added to" if data["change"] else "removed from"
+          print "%s %s (id %s) %s the closed user group" % (when, data.get("phone"),
+                                                          data.get("id"), change)
+        else:
+          print "%s %r" % (when, data)
+    finally:
+      index.close()
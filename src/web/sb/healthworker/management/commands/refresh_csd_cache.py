@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand, CommandError
+from sb.healthworker import csd
+from sb.healthworker import csdcache
+
+class Command(BaseCommand):
+  help = 'Refresh the cached CSD region, facility and health worker directories'
+
+  def add_arguments(self, parser):
+    parser.add_argument('--full', action='store_true',
+                        help=u'fetch every record instead of the recently updated ones')
+    parser.add_argument('--invalidate', action='store_true',
+                        help=u'drop the cache before refreshing it')
+
+  def handle(self, *args, **options):
+    if options['invalidate']:
+      csdcache.invalidate()
+    failed = csdcache.refresh_all(full=options['full'])
+    for line in csd.client().metrics.lines():
+      print line
+    if failed:
+      raise CommandError("failed to refresh: %s" % (", ".join(failed), ))
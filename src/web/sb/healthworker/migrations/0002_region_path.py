@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+from sb.healthworker.models import rebuild_region_paths
+
+
+def build_paths(apps, schema_editor):
+    rebuild_region_paths(apps.get_model('healthworker', 'Region'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('healthworker', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='region',
+            name='path',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=255),
+        ),
+        migrations.RunPython(build_paths, migrations.RunPython.noop),
+    ]
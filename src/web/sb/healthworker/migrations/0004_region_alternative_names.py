@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('healthworker', '0003_dataset_content_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='region',
+            name='alternative_names',
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+    ]
@@ -3,9 +3,14 @@
 import datetime
 
 from django.db import models
+from django.db.models import Case, Q, Value, When
+from django.db.models.functions import Concat, Substr
 
+from sb.healthworker import blocking
+from sb.healthworker import refcache
+from sb.healthworker import registry_index
 import sb.logchan
-import sb.util
+import sb.smsqueue
 
 CUG_ACTIVATION_SMSES = {
   "en":
@@ -28,6 +33,14 @@ CUG_DEACTIVATION_SMSES = {
      " the programme."),  # TODO: translate
 }
 
+def closed_user_group_sms(language, in_group):
+  "The SMS telling a user they were added to or removed from the CUG"
+  smses = CUG_ACTIVATION_SMSES if in_group else CUG_DEACTIVATION_SMSES
+  content = smses.get(language)
+  if not content:
+    content = smses["en"]
+  return content
+
 class HealthWorker(models.Model):
   address = models.TextField("Manual Verification Notes", null=True, blank=True)
   birthdate = models.DateField(null=True, blank=True)
@@ -99,17 +112,11 @@ class HealthWorker(models.Model):
     if not self.mct_payroll_num:
       return False
 
-    records = cls.objects
-    records = records.filter(check_number=self.mct_payroll_num)
-    records = records.filter(health_worker_id__isnull=True)
-    records = list(records[:1])
-    if not records:
+    index = registry_index.key_index(cls)
+    record_ids = index.lookup("check_number", self.mct_payroll_num)
+    if not self.claim_record(cls, record_ids):
       return False
 
-    record = records[0]
-    record.health_worker = self
-    record.save()
-
     self.verification_state = self.MCT_PAYROLL_VERIFIED
     self.save()
     return True
@@ -120,18 +127,15 @@ class HealthWorker(models.Model):
     if not self.surname or not self.mct_registration_num:
       return False
 
-    records = cls.objects
-    records = records.filter(registration_number=self.mct_registration_num)
-    records = records.filter(health_worker_id__isnull=True)
-    name_search = "is_similar(%%s, %s.name)" % cls._meta.db_table
-    records = records.extra(where=[name_search], params=[self.surname])
-    records = list(records[:1])
-    if not records:
+    index = registry_index.key_index(cls)
+    record_ids = index.lookup("registration_number", self.mct_registration_num)
+    if not record_ids:
       return False
 
-    record = records[0]
-    record.health_worker = self
-    record.save()
+    names = registry_index.name_index(cls)
+    record_ids = [i for i in record_ids if names.score(i, self.surname) is not None]
+    if not self.claim_record(cls, record_ids):
+      return False
 
     self.verification_state = self.MCT_REGISTRATION_VERIFIED
     self.save()
@@ -143,17 +147,11 @@ class HealthWorker(models.Model):
     if not self.vodacom_phone:
       return False
 
-    records = cls.objects
-    records = records.filter(phone_number=self.vodacom_phone)
-    records = records.filter(health_worker_id__isnull=True)
-    records = list(records[:1])
-    if not records:
+    index = registry_index.key_index(cls)
+    record_ids = index.lookup("phone_number", self.vodacom_phone)
+    if not self.claim_record(cls, record_ids):
       return False
 
-    record = records[0]
-    record.health_worker = self
-    record.save()
-
     self.verification_state = self.PHONE_NUMBER_VERIFIED
     self.save()
     return True
@@ -168,22 +166,25 @@ class HealthWorker(models.Model):
     if not all([name_part.isalpha() for name_part in self.name.split()]):
       return False
 
-    records = cls.objects
-    records = records.filter(health_worker_id__isnull=True)
-    name_search = "is_similar(%%s, %s.name)" % cls._meta.db_table
-    records = records.extra(where=[name_search], params=[self.name])
-    records = list(records[:1])
-    if not records:
+    matches = blocking.search(cls, self.name)
+    if not self.claim_record(cls, [record_id for record_id, score in matches]):
       return False
 
-    record = records[0]
-    record.health_worker = self
-    record.save()
-
     self.verification_state = self.NAME_VERIFIED
     self.save()
     return True
 
+  # Link the first of the given registry records that is still unclaimed.
+  # Record ids come from the registry indexes, which may be stale, so each
+  # claim is checked against the database.
+  def claim_record(self, cls, record_ids):
+    for record_id in record_ids:
+      records = cls.objects.filter(id=record_id, health_worker_id__isnull=True)
+      if records.update(health_worker=self):
+        registry_index.claimed_on_commit(cls, [record_id])
+        return True
+    return False
+
   # Helper to get the match if verified by name
   def get_matching_name(self):
     if self.verification_state != self.NAME_VERIFIED:
@@ -218,17 +219,12 @@ class HealthWorker(models.Model):
                      id=self.id)
 
 
+  # SMSes are queued and sent by the process_sms_queue command
   def send_activation_sms(self):
-    content = CUG_ACTIVATION_SMSES.get(self.language)
-    if not content:
-      content = CUG_ACTIVATION_SMSES["en"]
-    sb.util.send_vumigo_sms(self.vodacom_phone, content)
+    sb.smsqueue.enqueue(self.vodacom_phone, closed_user_group_sms(self.language, True))
 
   def send_deactivation_sms(self):
-    content = CUG_DEACTIVATION_SMSES.get(self.language)
-    if content is None:
-      content = CUG_DEACTIVATION_SMSES["en"]
-    sb.util.send_vumigo_sms(self.vodacom_phone, content)
+    sb.smsqueue.enqueue(self.vodacom_phone, closed_user_group_sms(self.language, False))
 
   # This improves the Django admin view:
   def __unicode__(self):
@@ -251,16 +247,91 @@ class RegionType(models.Model):
     return self.title
 
 class Region(models.Model):
-  """A region like "The Bronx" """
+  """A region like "The Bronx"
+
+  path is the materialized path of the region's ancestors' ids and its own,
+  like "/1/12/345/", so a region's subtree is the regions whose path starts
+  with its path.  save() maintains it, rows written some other way need
+  Region.rebuild_paths().
+  """
   title = models.CharField(max_length=255, null=False, blank=False, db_index=True)
   type = models.ForeignKey(RegionType, null=True, blank=True, db_index=True)
   parent_region = models.ForeignKey("Region", null=True, blank=True, db_index=True)
   created_at = models.DateTimeField(auto_now_add=True)
   updated_at = models.DateTimeField(auto_now_add=True)
+  path = models.CharField(max_length=255, null=False, blank=True, default="", db_index=True)
+  # Other spellings of the title, see place_index.alternative_names
+  alternative_names = models.CharField(max_length=255, null=True, blank=True)
 
   def __unicode__(self):
     return self.title
 
+  def _compute_path(self):
+    parent_path = "/"
+    if self.parent_region_id is not None:
+      parent_path = Region.objects.filter(id=self.parent_region_id).values_list("path", flat=True)[0] or "/"
+    return "%s%d/" % (parent_path, self.id)
+
+  def save(self, *args, **kwargs):
+    old_path = self.path
+    super(Region, self).save(*args, **kwargs)
+    path = self._compute_path()
+    if path != old_path:
+      self.path = path
+      Region.objects.filter(id=self.id).update(path=path)
+      if old_path:
+        # Move the subtree with the region
+        subtree = Region.objects.filter(path__startswith=old_path).exclude(id=self.id)
+        subtree.update(path=Concat(Value(path), Substr("path", len(old_path) + 1),
+                                   output_field=models.CharField()))
+
+  @classmethod
+  def rebuild_paths(cls):
+    "Recompute every region's path, returns the number of regions changed"
+    return rebuild_region_paths(cls)
+
+  def subtree_path(self):
+    """The prefix of the paths of the regions under this one
+
+    Computed from the nearest ancestor with a path if this row's path isn't
+    set yet, so it's never empty, which would match every region.  None for
+    an unsaved region.
+    """
+    if self.path:
+      return self.path
+    if self.id is None:
+      return None
+    ids = [self.id]
+    prefix = "/"
+    parent_id = self.parent_region_id
+    while parent_id is not None and parent_id not in ids:
+      row = Region.objects.filter(id=parent_id).values_list("path", "parent_region_id").first()
+      if row is None:
+        break
+      path, grandparent_id = row
+      if path:
+        prefix = path
+        break
+      ids.append(parent_id)
+      parent_id = grandparent_id
+    return prefix + "".join("%d/" % i for i in reversed(ids))
+
+  def subtree(self):
+    "This region and every region under it, with one query"
+    path = self.subtree_path()
+    if path is None:
+      return Region.objects.none()
+    return Region.objects.filter(Q(path__startswith=path) | Q(id=self.id))
+
+  def ancestor_ids(self):
+    "The ids of the regions above this one, the top first"
+    return [int(i) for i in self.path.strip("/").split("/")[:-1] if i]
+
+  def ancestors(self):
+    "The regions above this one, the top first, with one query"
+    by_id = Region.objects.in_bulk(self.ancestor_ids())
+    return [by_id[i] for i in self.ancestor_ids() if i in by_id]
+
   @classmethod
   def get_or_create_region_by_title_type(cls, title, region_type_title, parent=None, filter_parent=True):
     region_type = get_or_create_by_title(RegionType, region_type_title)
@@ -278,13 +349,41 @@ class Region(models.Model):
       return region
 
   def subregion_ids(self):
-    result = set()
-    parent_region_ids = [self.id]
-    while parent_region_ids:
-      subregions = list(Region.objects.filter(parent_region_id__in=parent_region_ids).all())
-      parent_region_ids = [i.id for i in subregions]
-      result.update(parent_region_ids)
-    return result
+    return set(self.subtree().exclude(id=self.id).values_list("id", flat=True))
+
+def rebuild_region_paths(region_model):
+  """Recompute the paths of every row of region_model
+
+  Takes the model so that migrations can pass their historical Region.
+  Returns the number of regions changed.
+  """
+  rows = list(region_model.objects.values_list("id", "parent_region_id", "path"))
+  parents = dict((i, parent_id) for i, parent_id, _ in rows)
+  paths = {}
+  def path_of(region_id):
+    # Iterative, and safe against parent cycles
+    chain = []
+    seen = set()
+    while region_id in parents and region_id not in paths and region_id not in seen:
+      chain.append(region_id)
+      seen.add(region_id)
+      region_id = parents.get(region_id)
+    prefix = paths.get(region_id, "/")
+    for i in reversed(chain):
+      prefix = paths[i] = "%s%d/" % (prefix, i)
+    return paths[chain[0]] if chain else paths.get(region_id)
+  changed = {}
+  for region_id, parent_id, path in rows:
+    new_path = path_of(region_id)
+    if new_path != path:
+      changed[region_id] = new_path
+  ids = sorted(changed)
+  for start in range(0, len(ids), 500):
+    chunk = ids[start:start + 500]
+    region_model.objects.filter(id__in=chunk).update(path=Case(
+      *[When(id=i, then=Value(changed[i])) for i in chunk],
+      output_field=models.CharField()))
+  return len(changed)
 
 class FacilityType(models.Model):
   "A facility type like Hospital"
@@ -357,10 +456,18 @@ class Specialty(models.Model):
       yield curr
       curr = curr.parent_specialty
 
+  # The tree methods read the cached specialty_tree, walking the
+  # parent_specialty chain only for specialties it doesn't know yet
   def __unicode__(self):
-    return u" -> ".join([i.title for i in reversed(list(self.tree()))])
+    tree = specialty_tree.get()
+    if self.id not in tree.by_id:
+      return u" -> ".join([i.title for i in reversed(list(self.tree()))])
+    return u" -> ".join([i.title for i in tree.ancestors(self.id)] + [self.title])
 
   def is_child_of(self, ancestor):
+    tree = specialty_tree.get()
+    if self.id in tree.by_id:
+      return tree.is_child_of(self.id, ancestor.id)
     curr = self
     while curr is not None:
       if ancestor.id == curr.parent_specialty_id:
@@ -584,7 +691,18 @@ class RegistrationAnswer(models.Model):
   updated_at = models.DateTimeField(auto_now_add=True)
 
 class DataSet(models.Model):
+  "A dataset module that was imported, see sb.healthworker.dataset"
   key = models.CharField(null=False, blank=False, max_length=128)
   updated_at = models.DateTimeField(auto_now_add=True)
   created_at = models.DateTimeField(auto_now_add=True)
+  # SHA-1 of the module and its source files when they were last imported
+  content_hash = models.CharField(max_length=40, null=True, blank=True)
+  # Seconds the last import took
+  duration = models.FloatField(null=True, blank=True)
+  # Rows the last import read
+  rows = models.IntegerField(null=True, blank=True)
+
+registry_index.connect([MCTPayroll, MCTRegistration, DMORegistration, NGORegistration])
 
+specialty_tree = refcache.ReferenceCache(
+  "specialty_tree", lambda: refcache.SpecialtyTree(Specialty.objects.all()), [Specialty])
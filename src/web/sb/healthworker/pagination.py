@@ -0,0 +1,102 @@
+# Copyright 2013 Switchboard, Inc
+"""Database-side pagination for the registry API indexes
+
+Index requests take these query parameters:
+
+  count --- rows per page, at most MAX_COUNT (default DEFAULT_COUNT)
+  offset --- rows to skip, for LIMIT/OFFSET paging
+  after_id --- a keyset cursor: return rows with an id greater than this,
+               which costs the same on every page however deep
+  total --- how to compute the total row count: "exact" (the default),
+            "estimate" (from the query planner) or "none"
+
+Rows are ordered by id.  Only one page of rows, plus one row to tell whether
+there are more, is read from the database.  The response's "next" is the
+query parameters of the following page, or null on the last page.
+
+paginate_ranked() pages through a list of ids in rank order instead, like
+the matches of a name search, by offset only.
+"""
+
+import json
+
+from django.db import connection
+
+import sb.util
+
+DEFAULT_COUNT = 100
+MAX_COUNT = 1000
+
+TOTAL_EXACT = "exact"
+TOTAL_ESTIMATE = "estimate"
+TOTAL_NONE = "none"
+
+class Page(object):
+  def __init__(self, rows, total, next):
+    self.rows = rows
+    self.total = total
+    self.next = next
+
+def estimate_count(query_set):
+  "The planner's row estimate for a query set, or its count off PostgreSQL"
+  if connection.vendor != "postgresql":
+    return query_set.count()
+  sql, params = query_set.query.sql_with_params()
+  with connection.cursor() as cursor:
+    cursor.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+    plan = cursor.fetchone()[0]
+  if isinstance(plan, basestring):
+    plan = json.loads(plan)
+  return int(plan[0]["Plan"]["Plan Rows"])
+
+def _count_and_offset(request):
+  count = sb.util.safe(lambda: int(request.GET["count"])) or DEFAULT_COUNT
+  count = max(1, min(count, MAX_COUNT))
+  offset = max(0, sb.util.safe(lambda: int(request.GET["offset"])) or 0)
+  return count, offset
+
+def paginate(query_set, request):
+  "Get the page of query_set requested by request's query parameters"
+  count, offset = _count_and_offset(request)
+  after_id = sb.util.safe(lambda: int(request.GET["after_id"]))
+  total_mode = request.GET.get("total", TOTAL_EXACT)
+
+  query_set = query_set.order_by("id")
+  if after_id is not None:
+    rows = list(query_set.filter(id__gt=after_id)[:count + 1])
+  else:
+    rows = list(query_set[offset:offset + count + 1])
+  has_more = len(rows) > count
+  rows = rows[:count]
+
+  if has_more:
+    next = {"after_id": rows[-1].id, "count": count}
+  else:
+    next = None
+
+  if total_mode == TOTAL_NONE:
+    total = None
+  elif after_id is None and not has_more and (rows or not offset):
+    # The last page tells the total without counting
+    total = offset + len(rows)
+  elif total_mode == TOTAL_ESTIMATE:
+    total = estimate_count(query_set)
+  else:
+    total = query_set.count()
+  return Page(rows, total, next)
+
+def paginate_ranked(query_set, ids, request):
+  """Get the page of the rows of query_set with ids, in the order of ids
+
+  Only the rows of the page are read, with one id__in query.
+  """
+  count, offset = _count_and_offset(request)
+  page_ids = ids[offset:offset + count]
+  by_id = query_set.in_bulk(page_ids) if page_ids else {}
+  rows = [by_id[i] for i in page_ids if i in by_id]
+  if offset + count < len(ids):
+    next = {"offset": offset + count, "count": count}
+  else:
+    next = None
+  total = None if request.GET.get("total") == TOTAL_NONE else len(ids)
+  return Page(rows, total, next)
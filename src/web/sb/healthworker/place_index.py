@@ -0,0 +1,299 @@
+# Copyright 2013 Switchboard, Inc
+"""In-memory fuzzy search over the names of facilities and districts
+
+A PlaceIndex keeps the name tokens of every place, an inverted index from
+each token to the places using it, and an n-gram index over the token
+vocabulary, like registry_index.NameIndex.  The names of a facility, or of a
+Region of type District, are its title and its alternative names.  Queries
+are stripped of common phrases ("hospitali ya", "wilaya", ...) by
+sb.healthworker.stopwords before they are matched, and facility results can
+be limited to a region's subtree and to some facility types:
+
+  query, matches = search_facilities(u"Hospitali ya Wilaya Mbeya", limit=5)
+  for place, score in matches:
+    print place.id, place.title, score
+
+The indexes are refcache.ReferenceCaches, so they are dropped when a
+facility or region is saved or deleted in this process and reloaded after
+REFERENCE_CACHE_TTL seconds.  warm() loads them at process start and
+reloads them in a background thread before they expire, restarted in each
+forked child, so searches don't wait for the database.  Once warm, an index
+whose places change is reloaded by that thread after the change commits,
+and searches use the old index until then.
+"""
+
+import logging
+import os
+import re
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from sb.healthworker import fuzzy
+from sb.healthworker import models
+from sb.healthworker import refcache
+from sb.healthworker import stopwords
+
+ALGORITHM = getattr(settings, "PLACE_SEARCH_ALGORITHM", fuzzy.DEFAULT_ALGORITHM)
+THRESHOLD = getattr(settings, "PLACE_SEARCH_THRESHOLD", fuzzy.DEFAULT_THRESHOLD)
+
+DEFAULT_COUNT = 10
+MAX_COUNT = 100
+
+_log = logging.getLogger("sb.healthworker.place_index")
+
+# Separates the names of an alternative_names column
+_names_pat = re.compile(r"[,;|]")
+
+def alternative_names(value):
+  "The names of an alternative_names column"
+  if not value:
+    return []
+  return [i.strip() for i in _names_pat.split(value) if i.strip()]
+
+class Place(object):
+  "A named place, with what searches filter it by"
+  __slots__ = ["id", "title", "names", "path", "type_id", "parent", "tokens"]
+
+  def __init__(self, id, title, names, path=None, type_id=None, parent=None):
+    self.id = id
+    self.title = title
+    self.names = names
+    # The materialized path of the place's region (see models.Region)
+    self.path = path
+    self.type_id = type_id
+    # {"id", "title"} of the region a region is in, or None
+    self.parent = parent
+    # The tokens of each distinct name
+    self.tokens = ()
+
+class PlaceIndex(object):
+  "Fuzzy search index over the names of a list of Places"
+  def __init__(self, places, algorithm=None):
+    self.algorithm = algorithm or ALGORITHM
+    self._similarity, self._n = fuzzy.get_algorithm(self.algorithm)
+    self.places = {}
+    self._postings = {}
+    self._grams = {}
+    for place in places:
+      self._add(place)
+
+  def _add(self, place):
+    name_tokens = []
+    for name in place.names:
+      tokens = tuple(fuzzy.tokens(name))
+      if tokens and tokens not in name_tokens:
+        name_tokens.append(tokens)
+    if not name_tokens:
+      return
+    place.tokens = tuple(name_tokens)
+    self.places[place.id] = place
+    for token in set(t for tokens in name_tokens for t in tokens):
+      ids = self._postings.get(token)
+      if ids is None:
+        ids = self._postings[token] = set()
+        for gram in fuzzy.ngrams(token, self._n):
+          self._grams.setdefault(gram, set()).add(token)
+      ids.add(place.id)
+
+  def _token_similarities(self, query_tokens, threshold):
+    "Map each query token to the similar vocabulary tokens and their scores"
+    result = {}
+    for q in set(query_tokens):
+      candidates = set()
+      for gram in fuzzy.ngrams(q, self._n):
+        candidates.update(self._grams.get(gram, ()))
+      scores = {}
+      for token in candidates:
+        s = self._similarity(q, token)
+        if s >= threshold:
+          scores[token] = s
+      result[q] = scores
+    return result
+
+  def __len__(self):
+    return len(self.places)
+
+  def search(self, query, path=None, type_ids=None, limit=None, threshold=None):
+    """Find the places with a name matching query
+
+    path limits the search to the places in the subtree of the region with
+    that path, type_ids to the places of those types.  Returns (Place, score)
+    pairs, best score first, then the places whose matching name has the
+    fewest extra tokens, then by title.
+    """
+    if threshold is None:
+      threshold = THRESHOLD
+    query_tokens = fuzzy.tokens(query)
+    if not query_tokens:
+      return []
+    similar = self._token_similarities(query_tokens, threshold)
+    token_similarity = lambda q, r: similar[q].get(r)
+    # A place must have a similar token for every query token
+    row_sets = []
+    for q in similar:
+      ids = set()
+      for token in similar[q]:
+        ids.update(self._postings[token])
+      row_sets.append(ids)
+    row_sets.sort(key=len)
+    candidates = row_sets[0].intersection(*row_sets[1:])
+
+    results = []
+    for place_id in candidates:
+      place = self.places[place_id]
+      if path is not None and not (place.path or "").startswith(path):
+        continue
+      if type_ids is not None and place.type_id not in type_ids:
+        continue
+      best = None
+      for tokens in place.tokens:
+        s = fuzzy.match_score(query_tokens, tokens, token_similarity)
+        if s is not None and (best is None or (s, -len(tokens)) > best):
+          best = (s, -len(tokens))
+      if best is not None:
+        results.append((place, best[0], -best[1]))
+    results.sort(key=lambda i: (-i[1], i[2], i[0].title, i[0].id))
+    if limit is not None:
+      results = results[:limit]
+    return [(place, s) for place, s, length in results]
+
+def _on_change(cache):
+  "Refresh a changed index in the background once warm, else drop it"
+  if not _warmed:
+    cache.invalidate()
+    return
+  # A refresh started before the change commits wouldn't see it
+  transaction.on_commit(lambda: _schedule_refresh(cache))
+
+def _load_facilities():
+  rows = models.Facility.objects.values_list(
+    "id", "title", "alternative_names", "region__path", "type_id")
+  return PlaceIndex(Place(facility_id, title, [title] + alternative_names(names), path, type_id)
+                    for facility_id, title, names, path, type_id in rows.iterator())
+
+_facilities = refcache.ReferenceCache("facility-search", _load_facilities,
+                                      [models.Facility, models.Region],
+                                      on_change=_on_change)
+
+def facility_index():
+  if _warmed:
+    _ensure_refresher()
+  return _facilities.get()
+
+def search_facilities(query, region=None, type_ids=None, limit=DEFAULT_COUNT):
+  """Find the facilities matching a query, in region's subtree if given
+
+  Returns (the query without its common phrases, [(Place, score)]).
+  """
+  query = stopwords.fix_facility_query(query)
+  path = None
+  if region is not None:
+    path = region.subtree_path()
+    if path is None:
+      # An unsaved region has no facilities
+      return query, []
+  return query, facility_index().search(query, path, type_ids, limit)
+
+def _load_districts():
+  rows = models.Region.objects.filter(type__title=models.RegionType.DISTRICT).values_list(
+    "id", "title", "alternative_names", "path", "parent_region_id", "parent_region__title")
+  places = []
+  for region_id, title, names, path, parent_id, parent_title in rows.iterator():
+    parent = {"id": parent_id, "title": parent_title} if parent_id is not None else None
+    places.append(Place(region_id, title, [title] + alternative_names(names), path,
+                        parent=parent))
+  return PlaceIndex(places)
+
+_districts = refcache.ReferenceCache("district-search", _load_districts,
+                                     [models.Region, models.RegionType],
+                                     on_change=_on_change)
+
+def district_index():
+  if _warmed:
+    _ensure_refresher()
+  return _districts.get()
+
+def search_districts(query, limit=DEFAULT_COUNT):
+  """Find the districts matching a query
+
+  Returns (the query without its common phrases, [(Place, score)]).
+  """
+  query = stopwords.fix_district_query(query)
+  return query, district_index().search(query, limit=limit)
+
+_caches = [_facilities, _districts]
+_warmed = False
+_refresher = None
+_refresher_lock = threading.Lock()
+# The process that started _refresher
+_pid = None
+# Set when a cache is added to _stale, to wake _refresher
+_changed = threading.Event()
+# The changed caches waiting for _refresher
+_stale = set()
+_stale_lock = threading.Lock()
+
+def _refresh_all(caches=None):
+  try:
+    for cache in caches or _caches:
+      try:
+        cache.refresh()
+      except Exception:
+        _log.exception("failed to load %s", cache.name)
+  finally:
+    # Don't hold a connection of this thread between refreshes
+    connection.close()
+
+def _keep_fresh():
+  "Refresh the changed caches, and all of them before they expire"
+  refresh_at = time.time() + refcache.CACHE_TTL / 2.0
+  while True:
+    _changed.wait(max(refresh_at - time.time(), 0))
+    _changed.clear()
+    with _stale_lock:
+      caches = list(_stale)
+      _stale.clear()
+    if time.time() >= refresh_at:
+      caches = _caches
+      refresh_at = time.time() + refcache.CACHE_TTL / 2.0
+    if caches:
+      _refresh_all(caches)
+
+def _schedule_refresh(cache):
+  "Have the refresh thread reload cache, which keeps its value meanwhile"
+  cache.mark_changed()
+  _ensure_refresher()
+  with _stale_lock:
+    _stale.add(cache)
+  _changed.set()
+
+def _ensure_refresher():
+  """Start the refresh thread, again in a forked child
+
+  A child (like a worker of a preloaded application) inherits the loaded
+  indexes but not the parent's thread.
+  """
+  global _refresher, _pid, _changed, _stale_lock
+  if _pid == os.getpid():
+    return
+  with _refresher_lock:
+    if _pid != os.getpid():
+      # The parent's thread may have held these when it forked
+      _changed = threading.Event()
+      _stale_lock = threading.Lock()
+      _refresher = threading.Thread(target=_keep_fresh, name="place-index-refresh")
+      _refresher.daemon = True
+      _refresher.start()
+      _pid = os.getpid()
+
+def warm():
+  "Load the indexes, and reload them in the background before they expire"
+  global _warmed
+  stopwords.get_facility_trie()
+  stopwords.get_district_trie()
+  _refresh_all()
+  _warmed = True
+  _ensure_refresher()
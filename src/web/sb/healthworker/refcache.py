@@ -0,0 +1,142 @@
+# Copyright 2013 Switchboard, Inc
+"""In-memory caches of small reference tables
+
+Reference tables like Specialty are read on most requests but rarely
+written.  A ReferenceCache holds a value computed from them, drops it when a
+row of one of its models is saved or deleted in this process, and
+recomputes it after REFERENCE_CACHE_TTL seconds to pick up writes made by
+other processes.
+
+SpecialtyTree is the specialty hierarchy with each specialty's ancestors
+precomputed, so tree walks and sorting never reach the database.
+"""
+
+import threading
+import time
+
+from django.conf import settings
+from django.db.models import signals
+
+CACHE_TTL = getattr(settings, "REFERENCE_CACHE_TTL", 300)
+
+class ReferenceCache(object):
+  """A value computed by load(), dropped when any of models changes
+
+  If on_change is given, it's called with the cache when a model changes
+  instead, and decides whether to invalidate() or refresh() it.
+  """
+  def __init__(self, name, load, models, on_change=None):
+    self.name = name
+    self._load = load
+    self.on_change = on_change
+    self._lock = threading.RLock()
+    self._value = None
+    self._loaded_at = None
+    # Counts invalidations, so refresh() doesn't keep a value loaded before one
+    self._generation = 0
+    for model in models:
+      signals.post_save.connect(self._on_change, sender=model, weak=False,
+                                dispatch_uid="refcache_save_%s_%s" % (name, model.__name__))
+      signals.post_delete.connect(self._on_change, sender=model, weak=False,
+                                  dispatch_uid="refcache_delete_%s_%s" % (name, model.__name__))
+
+  def get(self):
+    with self._lock:
+      if self._loaded_at is None or time.time() - self._loaded_at > CACHE_TTL:
+        self._value = self._load()
+        self._loaded_at = time.time()
+      return self._value
+
+  def refresh(self):
+    "Recompute the value now, get() keeps returning the old one meanwhile"
+    generation = self._generation
+    value = self._load()
+    with self._lock:
+      if generation == self._generation:
+        self._value = value
+        self._loaded_at = time.time()
+
+  def invalidate(self):
+    with self._lock:
+      self._generation += 1
+      self._value = None
+      self._loaded_at = None
+
+  def mark_changed(self):
+    "Keep the value, but make refreshes started before now discard theirs"
+    with self._lock:
+      self._generation += 1
+
+  def _on_change(self, sender, **kwargs):
+    if self.on_change is not None:
+      self.on_change(self)
+    else:
+      self.invalidate()
+
+def _priority_order(specialty):
+  return (-specialty.priority, specialty.title)
+
+class SpecialtyTree(object):
+  "The specialty hierarchy, loaded with one query"
+  def __init__(self, specialties):
+    self.by_id = dict((s.id, s) for s in specialties)
+    self._children = {}
+    self._by_abbreviation = {}
+    self._by_title = {}
+    for s in self.by_id.values():
+      self._children.setdefault(s.parent_specialty_id, []).append(s)
+      if s.abbreviation:
+        self._by_abbreviation.setdefault(s.abbreviation, []).append(s)
+      self._by_title.setdefault(s.title.lower(), []).append(s)
+    for items in self._children.values():
+      items.sort(key=_priority_order)
+    for group in [self._by_abbreviation, self._by_title]:
+      for items in group.values():
+        items.sort(key=lambda s: s.id)
+    # id -> ids of the ancestors, root first
+    self._paths = {}
+    for specialty_id in self.by_id:
+      self._paths[specialty_id] = self._ancestor_path(specialty_id)
+    self._ancestors = dict((i, frozenset(path)) for i, path in self._paths.items())
+    self.listed = sorted([s for s in self.by_id.values() if not s.is_user_submitted],
+                         key=_priority_order)
+
+  def _ancestor_path(self, specialty_id):
+    path = []
+    seen = set([specialty_id])
+    parent_id = self.by_id[specialty_id].parent_specialty_id
+    while parent_id is not None and parent_id in self.by_id and parent_id not in seen:
+      path.append(parent_id)
+      seen.add(parent_id)
+      parent_id = self.by_id[parent_id].parent_specialty_id
+    path.reverse()
+    return tuple(path)
+
+  def ancestors(self, specialty_id):
+    "The ancestors of a specialty, its cadre first"
+    return [self.by_id[i] for i in self._paths.get(specialty_id, ())]
+
+  def is_child_of(self, specialty_id, ancestor_id):
+    "Is ancestor_id a parent, grandparent, etc. of specialty_id"
+    return ancestor_id in self._ancestors.get(specialty_id, ())
+
+  def cadre(self, specialty_id):
+    "The top level specialty of a specialty"
+    path = self._paths.get(specialty_id)
+    if path is None:
+      return None
+    return self.by_id[path[0] if path else specialty_id]
+
+  def children(self, specialty_id):
+    "The subspecialties of a specialty, by priority and title"
+    return list(self._children.get(specialty_id, []))
+
+  def cadres(self):
+    return self.children(None)
+
+  def by_abbreviation(self, abbreviation):
+    return list(self._by_abbreviation.get(abbreviation, []))
+
+  def by_title(self, title):
+    "Specialties titled title, ignoring case"
+    return list(self._by_title.get(title.lower(), []))
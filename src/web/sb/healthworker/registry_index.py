@@ -0,0 +1,391 @@
+# Copyright 2013 Switchboard, Inc
+"""In-memory indexes over the registry tables
+
+The registry tables (MCTPayroll, MCTRegistration, DMORegistration,
+NGORegistration) are matched against health workers by check number,
+registration number, phone number and name.  Several of the number columns
+have no database index, and names were compared with a similarity function
+evaluated row by row.
+
+A KeyIndex keeps a hash table from each normalized number to the ids of the
+unclaimed rows holding it, so a miss never reaches the database.  A NameIndex
+keeps the name tokens of every row with an n-gram index over the token
+vocabulary, for ranked fuzzy name search (see sb.healthworker.fuzzy).
+
+Indexes are built lazily, kept in sync with post_save/post_delete signals
+sent in this process, and rebuilt after REGISTRY_INDEX_TTL seconds to pick up
+rows written by other processes.  Code that claims rows with
+QuerySet.update() must call claimed_on_commit() itself, so that a claim
+rolled back never hides a row.
+"""
+
+import bisect
+import threading
+import time
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import signals
+
+from sb.healthworker import fuzzy
+
+INDEX_TTL = getattr(settings, "REGISTRY_INDEX_TTL", 300)
+NAME_MATCH_ALGORITHM = getattr(settings, "NAME_MATCH_ALGORITHM", fuzzy.DEFAULT_ALGORITHM)
+NAME_MATCH_THRESHOLD = getattr(settings, "NAME_MATCH_THRESHOLD", fuzzy.DEFAULT_THRESHOLD)
+
+def normalize_number(value):
+  "Normalize a check or registration number: no whitespace, upper case"
+  if not value:
+    return None
+  value = u"".join(value.split()).upper()
+  return value or None
+
+def normalize_phone(value):
+  "Normalize a Tanzanian phone number to its digits with the 255 prefix"
+  if not value:
+    return None
+  digits = u"".join([c for c in value if c.isdigit()])
+  if digits.startswith(u"0"):
+    digits = u"255" + digits[1:]
+  elif len(digits) == 9 and digits.startswith(u"7"):
+    digits = u"255" + digits
+  return digits or None
+
+_normalizers = {
+  "check_number": normalize_number,
+  "registration_number": normalize_number,
+  "phone_number": normalize_phone,
+}
+
+# Model name -> indexed fields
+_indexed_fields = {
+  "MCTPayroll": ["check_number"],
+  "MCTRegistration": ["registration_number"],
+  "DMORegistration": ["check_number", "registration_number", "phone_number"],
+  "NGORegistration": ["check_number", "registration_number", "phone_number"],
+}
+
+class RegistryIndex(object):
+  "Lazy building, expiry and locking shared by the registry indexes"
+  def __init__(self, model):
+    self.model = model
+    self._lock = threading.RLock()
+    self._built_at = None
+
+  def _load(self):
+    raise NotImplementedError()
+
+  def _clear(self):
+    raise NotImplementedError()
+
+  def build(self):
+    "Load the rows from the database"
+    with self._lock:
+      self._load()
+      self._built_at = time.time()
+
+  def is_built(self):
+    return self._built_at is not None
+
+  def invalidate(self):
+    with self._lock:
+      self._clear()
+      self._built_at = None
+
+  def _ensure_built(self):
+    if self._built_at is None or time.time() - self._built_at > INDEX_TTL:
+      self.build()
+
+class KeyIndex(RegistryIndex):
+  """Hash index of the unclaimed rows of a registry table
+
+  Maps the normalized value of each indexed field to the ascending ids of the
+  rows holding it.
+  """
+  def __init__(self, model, fields):
+    super(KeyIndex, self).__init__(model)
+    self.fields = fields
+    self._clear()
+
+  def _clear(self):
+    self._keys = None
+    self._row_keys = None
+
+  def _load(self):
+    self._keys = dict((f, {}) for f in self.fields)
+    self._row_keys = {}
+    rows = self.model.objects.filter(health_worker__isnull=True)
+    rows = rows.order_by("id").values_list("id", *self.fields)
+    for row in rows.iterator():
+      self._add(row[0], row[1:])
+
+  def _add(self, row_id, values):
+    row_keys = []
+    for field, value in zip(self.fields, values):
+      key = _normalizers[field](value)
+      if key is None:
+        continue
+      ids = self._keys[field].setdefault(key, [])
+      bisect.insort(ids, row_id)
+      row_keys.append((field, key))
+    if row_keys:
+      self._row_keys[row_id] = tuple(row_keys)
+
+  def _discard(self, row_id):
+    for field, key in self._row_keys.pop(row_id, ()):
+      ids = self._keys[field].get(key)
+      if ids is None:
+        continue
+      ids.remove(row_id)
+      if not ids:
+        del self._keys[field][key]
+
+  def lookup(self, field, value):
+    "Return the ids of unclaimed rows whose field matches value"
+    key = _normalizers[field](value)
+    if key is None:
+      return []
+    with self._lock:
+      self._ensure_built()
+      return list(self._keys[field].get(key, ()))
+
+  def update(self, instance):
+    "Re-index a saved row"
+    with self._lock:
+      if not self.is_built():
+        return
+      self._discard(instance.id)
+      if instance.health_worker_id is None:
+        self._add(instance.id, [getattr(instance, f) for f in self.fields])
+
+  def claim(self, row_id):
+    self.discard(row_id)
+
+  def discard(self, row_id):
+    "Drop a claimed or deleted row"
+    with self._lock:
+      if self.is_built():
+        self._discard(row_id)
+
+class NameIndex(RegistryIndex):
+  """Fuzzy search index over the name column of a registry table
+
+  Keeps the tokens of every row, claimed or not, an inverted index from each
+  token to the rows using it, and an n-gram index from n-grams to tokens.
+  """
+  def __init__(self, model, field="name", algorithm=None):
+    super(NameIndex, self).__init__(model)
+    self.field = field
+    self.algorithm = algorithm or NAME_MATCH_ALGORITHM
+    self._n = fuzzy.get_algorithm(self.algorithm)[1]
+    self._clear()
+
+  def _clear(self):
+    self._row_tokens = None
+    self._postings = None
+    self._grams = None
+    self._claimed = None
+
+  def _load(self):
+    self._row_tokens = {}
+    self._postings = {}
+    self._grams = {}
+    self._claimed = set()
+    rows = self.model.objects.values_list("id", self.field, "health_worker_id")
+    for row_id, name, health_worker_id in rows.iterator():
+      self._add(row_id, name, health_worker_id)
+
+  def _add(self, row_id, name, health_worker_id):
+    row_tokens = tuple(fuzzy.tokens(name))
+    if not row_tokens:
+      return
+    self._row_tokens[row_id] = row_tokens
+    for token in set(row_tokens):
+      ids = self._postings.get(token)
+      if ids is None:
+        ids = self._postings[token] = set()
+        for gram in fuzzy.ngrams(token, self._n):
+          self._grams.setdefault(gram, set()).add(token)
+      ids.add(row_id)
+    if health_worker_id is not None:
+      self._claimed.add(row_id)
+
+  def _discard(self, row_id):
+    self._claimed.discard(row_id)
+    for token in set(self._row_tokens.pop(row_id, ())):
+      ids = self._postings[token]
+      ids.discard(row_id)
+      if not ids:
+        del self._postings[token]
+        for gram in fuzzy.ngrams(token, self._n):
+          tokens = self._grams[gram]
+          tokens.discard(token)
+          if not tokens:
+            del self._grams[gram]
+
+  def _token_similarities(self, query_tokens, algorithm, threshold):
+    "Map each query token to the similar vocabulary tokens and their scores"
+    similarity = fuzzy.get_algorithm(algorithm)[0]
+    result = {}
+    for q in set(query_tokens):
+      candidates = set()
+      for gram in fuzzy.ngrams(q, self._n):
+        candidates.update(self._grams.get(gram, ()))
+      scores = {}
+      for token in candidates:
+        s = similarity(q, token)
+        if s >= threshold:
+          scores[token] = s
+      result[q] = scores
+    return result
+
+  def _candidate_similarity(self, algorithm, threshold):
+    "A memoized token similarity function for scoring a few candidate rows"
+    similarity = fuzzy.get_algorithm(algorithm)[0]
+    memo = {}
+    def token_similarity(q, r):
+      key = q, r
+      if key not in memo:
+        s = similarity(q, r)
+        memo[key] = s if s >= threshold else None
+      return memo[key]
+    return token_similarity
+
+  def search(self, query, algorithm=None, threshold=None, unclaimed_only=False,
+             limit=None, candidates=None):
+    """Find rows whose name matches query
+
+    Without candidates, every row is considered through the n-gram index.
+    With candidates, a collection of row ids from a blocking stage (see
+    sb.healthworker.blocking), only those rows are scored.
+
+    Returns a list of (id, score) pairs, best score first and then by id.
+    """
+    algorithm = algorithm or self.algorithm
+    if threshold is None:
+      threshold = NAME_MATCH_THRESHOLD
+    query_tokens = fuzzy.tokens(query)
+    if not query_tokens:
+      return []
+    with self._lock:
+      self._ensure_built()
+      if candidates is None:
+        similar = self._token_similarities(query_tokens, algorithm, threshold)
+        token_similarity = lambda q, r: similar[q].get(r)
+        # A row must have a similar token for every query token
+        row_sets = []
+        for q in similar:
+          ids = set()
+          for token in similar[q]:
+            ids.update(self._postings[token])
+          row_sets.append(ids)
+        row_sets.sort(key=len)
+        candidates = row_sets[0].intersection(*row_sets[1:])
+      else:
+        token_similarity = self._candidate_similarity(algorithm, threshold)
+        candidates = set(candidates)
+      if unclaimed_only:
+        candidates.difference_update(self._claimed)
+      results = []
+      for row_id in candidates:
+        row_tokens = self._row_tokens.get(row_id)
+        if row_tokens is None:
+          continue
+        s = fuzzy.match_score(query_tokens, row_tokens, token_similarity)
+        if s is not None:
+          results.append((row_id, s))
+    results.sort(key=lambda i: (-i[1], i[0]))
+    if limit is not None:
+      results = results[:limit]
+    return results
+
+  def score(self, row_id, query, algorithm=None, threshold=None):
+    "Score one row's name against query, or None if it doesn't match"
+    algorithm = algorithm or self.algorithm
+    if threshold is None:
+      threshold = NAME_MATCH_THRESHOLD
+    with self._lock:
+      self._ensure_built()
+      row_tokens = self._row_tokens.get(row_id, ())
+    similarity = fuzzy.get_algorithm(algorithm)[0]
+    def token_similarity(a, b):
+      s = similarity(a, b)
+      return s if s >= threshold else None
+    return fuzzy.match_score(fuzzy.tokens(query), row_tokens, token_similarity)
+
+  def update(self, instance):
+    "Re-index a saved row"
+    with self._lock:
+      if not self.is_built():
+        return
+      self._discard(instance.id)
+      self._add(instance.id, getattr(instance, self.field), instance.health_worker_id)
+
+  def claim(self, row_id):
+    with self._lock:
+      if self.is_built() and row_id in self._row_tokens:
+        self._claimed.add(row_id)
+
+  def discard(self, row_id):
+    "Drop a deleted row"
+    with self._lock:
+      if self.is_built():
+        self._discard(row_id)
+
+# model -> {kind: index}
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+def get_index(model, kind, create):
+  "Get the index of the given kind for model, calling create() to make it"
+  with _indexes_lock:
+    indexes = _indexes.setdefault(model, {})
+    index = indexes.get(kind)
+    if index is None:
+      index = indexes[kind] = create()
+    return index
+
+def key_index(model):
+  "Get the KeyIndex for a registry model"
+  return get_index(model, "key",
+                    lambda: KeyIndex(model, _indexed_fields[model.__name__]))
+
+def name_index(model, field="name"):
+  "Get the NameIndex over a registry model's name field"
+  return get_index(model, ("name", field), lambda: NameIndex(model, field))
+
+def claimed(model, row_id):
+  "Tell the indexes of model that a row was claimed by a health worker"
+  for index in _indexes.get(model, {}).values():
+    index.claim(row_id)
+
+def claimed_on_commit(model, row_ids):
+  "Call claimed() for rows when the transaction claiming them commits"
+  row_ids = list(row_ids)
+  def on_commit():
+    for row_id in row_ids:
+      claimed(model, row_id)
+  transaction.on_commit(on_commit)
+
+def invalidate(model=None):
+  "Drop the indexes of model, or of every model, so they are rebuilt on next use"
+  for m, indexes in _indexes.items():
+    if model is None or m is model:
+      for index in indexes.values():
+        index.invalidate()
+
+def _on_save(sender, instance, **kwargs):
+  for index in _indexes.get(sender, {}).values():
+    index.update(instance)
+
+def _on_delete(sender, instance, **kwargs):
+  for index in _indexes.get(sender, {}).values():
+    index.discard(instance.id)
+
+def connect(models):
+  "Keep the indexes of the given registry models in sync with their tables"
+  for model in models:
+    signals.post_save.connect(_on_save, sender=model,
+                              dispatch_uid="registry_index_save_%s" % model.__name__)
+    signals.post_delete.connect(_on_delete, sender=model,
+                                dispatch_uid="registry_index_delete_%s" % model.__name__)
@@ -0,0 +1,224 @@
+# Copyright 2013 Switchboard, Inc
+"""Validation of the JSON bodies of API requests
+
+A schema is built once, at import time, from these fields:
+
+  String --- a unicode string, stripped, matching a pattern and length limits
+  Date --- a {"year", "month", "day"} dict, parsed to a datetime.date
+  ForeignKey --- the id of a row of a model, parsed to the row
+  List --- a list of values of another field
+  Dictionary --- a dict with a field for each key
+
+Each field's parse(value) returns (parsed value, None), or (None, status)
+when the value is invalid.  Dictionary.parse() stops at the first invalid
+key like the API always has, and Dictionary.validate() reports every
+invalid key in one pass.
+
+A Dictionary resolves the ForeignKey ids of all its keys together, with one
+id__in query per model for the ids not found in the fields' caches, and
+reports the ids that don't exist as {"key", "status", "missing": [ids]}.
+"""
+
+import collections
+import datetime
+import re
+
+ERROR_INVALID_INPUT = -1
+
+_INVALID = (None, ERROR_INVALID_INPUT)
+_NONE = (None, None)
+
+class Field(object):
+  def __init__(self, required=False):
+    self.required = required
+
+  def parse(self, value, refs=None):
+    """Parse value, appending the Refs of its foreign keys to refs
+
+    Without refs foreign keys are resolved one at a time.
+    """
+    raise NotImplementedError()
+
+class String(Field):
+  def __init__(self, pattern=None, required=False, min_length=None, max_length=None, strip=True):
+    super(String, self).__init__(required)
+    if isinstance(pattern, basestring):
+      pattern = re.compile(pattern)
+    # Bound once so parse() doesn't look it up per value
+    self._match = pattern.match if pattern is not None else None
+    self.min_length = min_length
+    self.max_length = max_length
+    self.strip = strip
+
+  def parse(self, value, refs=None):
+    if value is None:
+      return _INVALID if self.required else _NONE
+    if not isinstance(value, unicode):
+      return _INVALID
+    if self.strip:
+      value = value.strip()
+    if self._match is not None and not self._match(value):
+      return _INVALID
+    if self.min_length is not None and len(value) < self.min_length:
+      return _INVALID
+    if self.max_length is not None and len(value) > self.max_length:
+      return _INVALID
+    return value, None
+
+class Date(Field):
+  "A date, or None if the parts don't make one"
+  def parse(self, value, refs=None):
+    if not isinstance(value, (dict, type(None))):
+      return _INVALID
+    if not value:
+      return _INVALID if self.required else _NONE
+    try:
+      return datetime.date(value["year"], value["month"], value["day"]), None
+    except Exception:
+      return _NONE
+
+class Ref(object):
+  "A foreign key id, until its Dictionary resolves it to its row"
+  __slots__ = ["field", "id", "key", "row"]
+
+  def __init__(self, field, id):
+    self.field = field
+    self.id = id
+    self.key = None
+    self.row = None
+
+class ForeignKey(Field):
+  """The id of a row of model_class
+
+  cached, if given, is a function returning a dict of id -> row of
+  reference data to look ids up in before querying the database.
+  """
+  def __init__(self, model_class, required=False, cached=None):
+    super(ForeignKey, self).__init__(required)
+    self.model_class = model_class
+    self.cached = cached
+
+  def parse(self, value, refs=None):
+    if value is None:
+      return _INVALID if self.required else _NONE
+    if isinstance(value, bool):
+      return _INVALID
+    try:
+      row_id = int(value)
+    except (ValueError, TypeError):
+      return _INVALID
+    ref = Ref(self, row_id)
+    if refs is None:
+      resolve([ref])
+      return (ref.row, None) if ref.row is not None else _INVALID
+    refs.append(ref)
+    return ref, None
+
+def resolve(refs):
+  "Set the row of each Ref, None if it doesn't exist, with a query per model"
+  by_model = collections.OrderedDict()
+  for ref in refs:
+    by_model.setdefault(ref.field.model_class, []).append(ref)
+  for model_class, model_refs in by_model.items():
+    ids = set(ref.id for ref in model_refs)
+    rows = {}
+    for field in set(ref.field for ref in model_refs):
+      if field.cached is not None:
+        cached = field.cached()
+        rows.update((i, cached[i]) for i in ids if i in cached)
+    missing = ids.difference(rows)
+    if missing:
+      rows.update(model_class.objects.in_bulk(sorted(missing)))
+    for ref in model_refs:
+      ref.row = rows.get(ref.id)
+
+def _resolved(value):
+  "value with its Refs replaced by their rows"
+  if isinstance(value, Ref):
+    return value.row
+  if isinstance(value, list):
+    return [_resolved(i) for i in value]
+  if isinstance(value, dict):
+    return dict((k, _resolved(v)) for k, v in value.items())
+  return value
+
+class List(Field):
+  "A list of values of field, empty if the list is missing and not required"
+  def __init__(self, field, required=False):
+    super(List, self).__init__(required)
+    self.field = field
+
+  def parse(self, values, refs=None):
+    if not isinstance(values, (list, tuple, type(None))):
+      return _INVALID
+    if not values:
+      return _INVALID if self.required else ([], None)
+    parse = self.field.parse
+    result = []
+    for v in values:
+      parsed, status = parse(v, refs)
+      if status:
+        return None, status
+      result.append(parsed)
+    return result, None
+
+class Dictionary(Field):
+  """A dict with a field for each key of fields
+
+  Errors are {"key": key, "status": status}, with a key of None when the
+  value is not a dict at all.
+  """
+  def __init__(self, fields, required=True):
+    super(Dictionary, self).__init__(required)
+    self.fields = tuple(sorted(fields.items()))
+
+  def _parse(self, data, first_only, refs=None):
+    if not data or not isinstance(data, dict):
+      return None, [{"status": ERROR_INVALID_INPUT, "key": None}]
+    own_refs = refs is None
+    if own_refs:
+      refs = []
+    result = {}
+    errors = None
+    get = data.get
+    for key, field in self.fields:
+      start = len(refs)
+      v, status = field.parse(get(key), refs)
+      for ref in refs[start:]:
+        if ref.key is None:
+          ref.key = key
+      if status:
+        if errors is None:
+          errors = []
+        errors.append({"key": key, "status": status})
+        if first_only:
+          return None, errors
+      else:
+        result[key] = v
+    if own_refs and refs:
+      invalid_keys = set(e["key"] for e in errors or [])
+      missing = self._resolve([r for r in refs if r.key not in invalid_keys])
+      if missing:
+        errors = sorted((errors or []) + missing, key=lambda e: e["key"])
+    if errors:
+      return None, errors
+    return (_resolved(result) if own_refs else result), None
+
+  def _resolve(self, refs):
+    "Resolve refs, returns the errors of the keys with ids that don't exist"
+    resolve(refs)
+    missing = collections.OrderedDict()
+    for ref in refs:
+      if ref.row is None:
+        missing.setdefault(ref.key, set()).add(ref.id)
+    return [{"key": key, "status": ERROR_INVALID_INPUT, "missing": sorted(ids)}
+            for key, ids in missing.items()]
+
+  def parse(self, data, refs=None):
+    "Returns (result, None), or (None, the error of the first invalid key)"
+    result, errors = self._parse(data, True, refs)
+    return result, errors[0] if errors else None
+
+  def validate(self, data):
+    "Returns (result, None), or (None, the errors of every invalid key)"
+    return self._parse(data, False)
@@ -0,0 +1,174 @@
+# Copyright 2013 Switchboard, Inc
+"""Declared JSON field sets for the registry API
+
+A Serializer lists the keys of a model's JSON dicts and where each value
+comes from:
+
+  "name" --- an attribute of the row
+  ("type", "type.title") --- an attribute of a foreign key's row, or None
+                             if the foreign key is null
+  ("region", Nested("region", REGION)) --- a foreign key's row as a dict
+  ("specialties", Many("specialties")) --- the ids of a many-to-many field
+
+Foreign keys are followed with select_related() on the query set (see
+Serializer.query_set), and many-to-many ids are read for a whole page of rows
+with one query on the through table, so serializing a page costs the same
+number of queries however many rows it has.
+"""
+
+from sb.healthworker import models
+
+class Nested(object):
+  "A foreign key's row, serialized with another Serializer"
+  def __init__(self, field, serializer):
+    self.field = field
+    self.serializer = serializer
+
+class Many(object):
+  "The ids of the rows related by a many-to-many field"
+  def __init__(self, field):
+    self.field = field
+
+def _get(row, path):
+  for attribute in path.split("."):
+    if row is None:
+      return None
+    row = getattr(row, attribute)
+  return row
+
+class Serializer(object):
+  def __init__(self, model, fields):
+    self.model = model
+    self.fields = [f if isinstance(f, tuple) else (f, f) for f in fields]
+
+  def related_paths(self):
+    "The select_related() paths of the foreign keys the fields follow"
+    paths = set()
+    for key, source in self.fields:
+      if isinstance(source, Nested):
+        paths.add(source.field)
+        paths.update(source.field + "__" + i for i in source.serializer.related_paths())
+      elif isinstance(source, basestring) and "." in source:
+        paths.add("__".join(source.split(".")[:-1]))
+    return sorted(paths)
+
+  def query_set(self, query_set):
+    "Make query_set fetch the foreign keys the fields follow"
+    paths = self.related_paths()
+    if paths:
+      query_set = query_set.select_related(*paths)
+    return query_set
+
+  def _many_ids(self, field_name, rows):
+    "Map row id -> ids of the rows related by a many-to-many field"
+    field = self.model._meta.get_field(field_name)
+    through = field.remote_field.through
+    source = field.m2m_column_name()
+    target = field.m2m_reverse_name()
+    result = dict((row.id, []) for row in rows)
+    links = through.objects.filter(**{source + "__in": list(result)})
+    for row_id, related_id in links.order_by("pk").values_list(source, target):
+      result[row_id].append(related_id)
+    return result
+
+  def to_dict(self, row, many_ids=None):
+    result = {}
+    for key, source in self.fields:
+      if isinstance(source, Nested):
+        related = getattr(row, source.field)
+        result[key] = source.serializer.to_dict(related) if related is not None else None
+      elif isinstance(source, Many):
+        result[key] = many_ids[source.field].get(row.id, [])
+      else:
+        result[key] = _get(row, source)
+    return result
+
+  def serialize(self, rows):
+    "Generate the dicts of a page of rows"
+    rows = list(rows)
+    many_ids = {}
+    for key, source in self.fields:
+      if isinstance(source, Many) and rows:
+        many_ids[source.field] = self._many_ids(source.field, rows)
+    return (self.to_dict(row, many_ids) for row in rows)
+
+MCT_PAYROLL = Serializer(models.MCTPayroll, [
+  "id",
+  "name",
+  "birthdate",
+  "designation",
+  "district",
+  "specialty_id",
+  "last_name",
+  "region_id",
+  "health_worker_id",
+  "facility_id",
+  "check_number"])
+
+MCT_REGISTRATION = Serializer(models.MCTRegistration, [
+  "address",
+  "birthdate",
+  "cadre",
+  "category",
+  "country",
+  "created_at",
+  "current_employer",
+  "dates_of_registration_full",
+  "dates_of_registration_provisional",
+  "dates_of_registration_temporary",
+  "email",
+  "employer_during_internship",
+  ("facility", "facility_id"),
+  "file_number",
+  "id",
+  "name",
+  "qualification_final",
+  "qualification_provisional",
+  "qualification_specialization_1",
+  "qualification_specialization_2",
+  "registration_number",
+  "registration_type",
+  ("specialties", Many("specialties")),
+  "specialty",
+  "specialty_duration",
+  "updated_at"])
+
+REGION = Serializer(models.Region, [
+  "title",
+  ("type", "type.title"),
+  "id",
+  "parent_region_id",
+  "created_at",
+  "updated_at"])
+
+FACILITY = Serializer(models.Facility, [
+  "id",
+  "title",
+  "address",
+  ("type", "type.title"),
+  "place_type",
+  "serial_number",
+  "owner",
+  "ownership_type",
+  "phone",
+  "region_id",
+  ("region", Nested("region", Serializer(models.Region, [
+    "title",
+    "id",
+    "parent_region_id",
+    "type_id"]))),
+  "created_at",
+  "updated_at"])
+
+HEALTH_WORKER = Serializer(models.HealthWorker, [
+  "id",
+  "name",
+  "surname",
+  "vodacom_phone",
+  "language",
+  "facility_id",
+  ("specialties", Many("specialties")),
+  "verification_state",
+  "is_closed_user_group",
+  "created_at",
+  "updated_at"])
@@ -1,3 +1,12 @@
+"""Strips common phrases ("hospitali ya", "zahanati", ...) from search queries
+
+The phrases of the phrase files are compiled into a PhraseTrie, which strips
+them in one pass over the words of a query, trying the longest phrase at each
+word.  get_pattern() compiles the same phrases into the alternation regex the
+queries used to be fixed with; the two give the same result (see
+scripts/bench_stopwords.py).
+"""
+
 import re
 
 import os
@@ -8,7 +17,11 @@ common_phrases_txt = os.path.join(_root, 'common-phrases.txt')
 facility_common_phrases_txt = os.path.join(_root, 'facility-common-phrases.txt')
 district_common_phrases_txt = os.path.join(_root, 'district-common-phrases.txt')
 
-def get_pattern(files):
+# Runs of word and of non-word characters, which alternate
+_token_pat = re.compile(ur"\w+|\W+", re.U)
+
+def read_phrases(files):
+  "The lowercased terms of each phrase of files, longest phrases first"
   phrase_terms = []
   for f in files:
     with open(f, "r") as a_file:
@@ -19,12 +32,63 @@ def get_pattern(files):
         phrase_terms.append(terms)
   phrase_terms.sort(key=len)
   phrase_terms.reverse()
+  return phrase_terms
+
+def get_pattern(files):
+  phrase_terms = read_phrases(files)
   pattern = (ur"\b(?:"
              + ur"|".join(ur"\s+".join(terms) for terms in phrase_terms)
              + ur")\b")
   pattern = re.compile(pattern, re.I | re.X | re.U)
   return pattern
 
+# Marks the node of the last term of a phrase
+_END = None
+
+class PhraseTrie(object):
+  """The phrases of a list of term lists, a node per term
+
+  Terms are words, compared ignoring case.  A phrase matches whole words
+  separated only by whitespace, like \\bterm\\s+term\\b.
+  """
+  def __init__(self, phrase_terms):
+    self.root = {}
+    for terms in phrase_terms:
+      node = self.root
+      for term in terms:
+        node = node.setdefault(term.lower(), {})
+      node[_END] = True
+
+  def sub(self, repl, q):
+    "Replace each longest phrase of q with repl, scanning left to right"
+    tokens = _token_pat.findall(q)
+    root = self.root
+    result = []
+    count = len(tokens)
+    i = 0
+    while i < count:
+      node = root.get(tokens[i].lower())
+      end = None
+      j = i
+      while node is not None:
+        if _END in node:
+          end = j
+        # The next term must follow whitespace
+        if j + 2 >= count or not tokens[j + 1].isspace():
+          break
+        j += 2
+        node = node.get(tokens[j].lower())
+      if end is None:
+        result.append(tokens[i])
+        i += 1
+      else:
+        result.append(repl)
+        i = end + 1
+    return u"".join(result)
+
+def get_trie(files):
+  return PhraseTrie(read_phrases(files))
+
 _facility_pat = None
 
 def get_facility_pattern():
@@ -41,7 +105,24 @@ def get_district_pattern():
     _district_pat = get_pattern([common_phrases_txt, district_common_phrases_txt])
   return _district_pat
 
+_facility_trie = None
+
+def get_facility_trie():
+  global _facility_trie
+  if _facility_trie is None:
+    _facility_trie = get_trie([common_phrases_txt, facility_common_phrases_txt])
+  return _facility_trie
+
+_district_trie = None
+
+def get_district_trie():
+  global _district_trie
+  if _district_trie is None:
+    _district_trie = get_trie([common_phrases_txt, district_common_phrases_txt])
+  return _district_trie
+
 def fix_query(q, patterns):
+  "Strip q with patterns, regexes or PhraseTries, and normalize its whitespace"
   if q:
     if patterns:
       for p in patterns:
@@ -57,8 +138,7 @@ def fix_query(q, patterns):
     return u''
 
 def fix_facility_query(query):
-  return fix_query(query, [get_facility_pattern()])
+  return fix_query(query, [get_facility_trie()])
 
 def fix_district_query(query):
-  return fix_query(query, [get_district_pattern()])
-
+  return fix_query(query, [get_district_trie()])
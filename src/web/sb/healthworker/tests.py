@@ -6,8 +6,23 @@ Replace this with more appropriate tests for your application.
 """
 
 import contextlib
+import datetime
+import fcntl
 import json
-from django.test import TestCase, Client
+import os
+import shutil
+import StringIO
+import sys
+import tempfile
+import threading
+import time
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase, TransactionTestCase, Client
+from django.test.utils import override_settings
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
 
 from sb.healthworker.models import HealthWorker
 from sb.healthworker.models import MCTRegistration
@@ -16,6 +31,30 @@ from sb.healthworker.models import NGORegistration
 from sb.healthworker.models import MCTPayroll
 from sb.healthworker.models import Specialty
 from sb.healthworker.models import Facility
+from sb.healthworker.models import FacilityType
+from sb.healthworker.models import DataSet
+from sb.healthworker.models import Region
+from sb.healthworker.models import RegionType
+from sb.healthworker.models import RegistrationAnswer
+from sb.healthworker.models import RegistrationStatus
+from sb.healthworker import blocking
+from sb.healthworker import csd
+from sb.healthworker import csdcache
+from sb.healthworker import csdstub
+from sb.healthworker import cug
+from sb.healthworker import dataset
+from sb.healthworker import place_index
+from sb.healthworker import registry_index
+from sb.healthworker import schema
+from sb.healthworker import stopwords
+from sb.healthworker.datasets import _bulk
+from sb.healthworker.datasets import _helpers
+from sb.healthworker.datasets import _redis_import
+import sb.logchan
+import sb.smsqueue
+import sb.util
+from sb import logchan_index
+from sb.healthworker import verification
 
 class AutoVerifyTest(TestCase):
   def test_registration_number(self):
@@ -248,6 +287,775 @@ class AutoVerifyTest(TestCase):
       hw = HealthWorker.objects.get(id=hw.id)
       self.assertEqual(hw.facility_id, facility.id)
 
+class BulkVerifyTest(TestCase):
+  def test_payroll_number(self):
+    with temp_obj(HealthWorker, name='Jim Johnson', mct_payroll_num='4567') as hw, \
+        temp_obj(MCTPayroll, check_number='4567') as payroll, \
+        temp_obj(DMORegistration, check_number='4567') as dmo:
+      report = verification.verify_unverified()
+      hw = HealthWorker.objects.get(id=hw.id)
+      self.assertEqual(hw.verification_state, HealthWorker.MCT_PAYROLL_VERIFIED)
+      self.assertEqual(MCTPayroll.objects.get(id=payroll.id).health_worker_id, hw.id)
+      self.assertEqual(DMORegistration.objects.get(id=dmo.id).health_worker_id, hw.id)
+      self.assertEqual(report.verified["payroll"], 1)
+
+  def test_one_record_per_worker(self):
+    # the lower id wins a contested record, like auto_verify in id order
+    with temp_obj(HealthWorker, name='Jim Johnson', vodacom_phone='255768328988') as hw0, \
+        temp_obj(HealthWorker, name='Jim Johnson', vodacom_phone='255768328988') as hw1, \
+        temp_obj(DMORegistration, phone_number='255768328988') as dmo:
+      report = verification.verify_unverified()
+      hw0 = HealthWorker.objects.get(id=hw0.id)
+      hw1 = HealthWorker.objects.get(id=hw1.id)
+      self.assertEqual(hw0.verification_state, HealthWorker.PHONE_NUMBER_VERIFIED)
+      self.assertEqual(hw1.verification_state, HealthWorker.UNVERIFIED)
+      self.assertEqual(DMORegistration.objects.get(id=dmo.id).health_worker_id, hw0.id)
+      self.assertEqual(report.verified["phone"], 1)
+
+  def test_record_claimed_after_index_built(self):
+    with temp_obj(HealthWorker, name='Jim Johnson', mct_payroll_num='4567') as hw, \
+        temp_obj(HealthWorker, name='Jim Johnson', verification_state=HealthWorker.MCT_PAYROLL_VERIFIED) as other, \
+        temp_obj(MCTPayroll, check_number='4567') as payroll:
+      registry_index.invalidate()
+      self.assertEqual(registry_index.key_index(MCTPayroll).lookup('check_number', '4567'), [payroll.id])
+      # A claim the index doesn't hear about, like one made by another process
+      MCTPayroll.objects.filter(id=payroll.id).update(health_worker=other)
+      report = verification.verify_unverified()
+      self.assertEqual(HealthWorker.objects.get(id=hw.id).verification_state, HealthWorker.UNVERIFIED)
+      self.assertEqual(MCTPayroll.objects.get(id=payroll.id).health_worker_id, other.id)
+      self.assertEqual(report.verified["payroll"], 0)
+
+class RegistryIndexTest(TestCase):
+  def setUp(self):
+    registry_index.invalidate()
+
+  def test_normalize(self):
+    for phone in ["0754 123 456", "754123456", "+255 754 123 456", "255-754-123456"]:
+      self.assertEqual(registry_index.normalize_phone(phone), "255754123456")
+    self.assertEqual(registry_index.normalize_phone("+1 (555) 0100"), "15550100")
+    self.assertEqual(registry_index.normalize_phone(" - "), None)
+    self.assertEqual(registry_index.normalize_number(" ab 12\t3 "), "AB123")
+    self.assertEqual(registry_index.normalize_number("   "), None)
+    self.assertEqual(registry_index.normalize_number(None), None)
+
+  def test_signals(self):
+    index = registry_index.key_index(MCTPayroll)
+    names = registry_index.name_index(MCTPayroll)
+    self.assertEqual(index.lookup('check_number', '4567'), [])
+    payroll = MCTPayroll.objects.create(name='Brandon Bickford', check_number='4567')
+    self.assertEqual(index.lookup('check_number', '4567'), [payroll.id])
+    self.assertEqual([i for i, score in names.search('Bickford')], [payroll.id])
+    payroll.check_number = '4568'
+    payroll.save()
+    self.assertEqual(index.lookup('check_number', '4567'), [])
+    self.assertEqual(index.lookup('check_number', '4568'), [payroll.id])
+    payroll.delete()
+    self.assertEqual(index.lookup('check_number', '4568'), [])
+    self.assertEqual(names.search('Bickford'), [])
+
+class RegistryClaimTest(TransactionTestCase):
+  "Claims reach the indexes when they commit"
+  def setUp(self):
+    registry_index.invalidate()
+
+  def test_claimed_row_drops_out(self):
+    with temp_obj(HealthWorker, name='Jim Johnson') as hw, \
+        temp_obj(DMORegistration, phone_number='0754 123 456', check_number='77') as dmo:
+      index = registry_index.key_index(DMORegistration)
+      self.assertEqual(index.lookup('phone_number', '+255754123456'), [dmo.id])
+      self.assertTrue(hw.claim_record(DMORegistration, [dmo.id]))
+      self.assertEqual(index.lookup('phone_number', '+255754123456'), [])
+      self.assertEqual(index.lookup('check_number', '77'), [])
+
+  def test_rolled_back_claim(self):
+    with temp_obj(HealthWorker, name='Jim Johnson') as hw, \
+        temp_obj(DMORegistration, phone_number='0754 123 456') as dmo:
+      index = registry_index.key_index(DMORegistration)
+      try:
+        with transaction.atomic():
+          self.assertEqual(verification.link_records(DMORegistration, [(hw.id, dmo.id)]),
+                           [(hw.id, dmo.id)])
+          raise RuntimeError("rolled back")
+      except RuntimeError:
+        pass
+      self.assertEqual(DMORegistration.objects.get(id=dmo.id).health_worker_id, None)
+      self.assertEqual(index.lookup('phone_number', '+255754123456'), [dmo.id])
+
+class BlockingTest(TestCase):
+  # The names of AutoVerifyTest
+  names = ['Brandon Bickford', 'Brandon Johnson', 'Brandon Bickfords', 'Boniface Boaz Daudi',
+           'J P Morgan', 'J Morgan', '1111 2222']
+  queries = ['Brandon Bickford', 'Jim Johnson', 'Boniface Boniface', 'J P', 'Jo Morgan',
+             'Brandon Bicford', '1111 2222', 'Bickford']
+
+  def setUp(self):
+    registry_index.invalidate()
+    for name in self.names:
+      MCTRegistration.objects.create(name=name)
+
+  def test_same_matches_as_full_search(self):
+    names = registry_index.name_index(MCTRegistration)
+    for query in self.queries:
+      self.assertEqual(blocking.search(MCTRegistration, query), names.search(query))
+    self.assertEqual(blocking.measure_recall(MCTRegistration, self.queries), (5, 5))
+
+  def test_first_letter_misspelling(self):
+    "Tokens similar but for their first letter share a blocking key"
+    registration = MCTRegistration.objects.create(name='Katherine Nwakyusa')
+    names = registry_index.name_index(MCTRegistration)
+    matches = names.search('Catherine Mwakyusa')
+    self.assertEqual([i for i, score in matches], [registration.id])
+    self.assertEqual(blocking.search(MCTRegistration, 'Catherine Mwakyusa'), matches)
+
+  def test_measure_recall_command(self):
+    for name in self.queries:
+      HealthWorker.objects.create(name=name)
+    stdout = sys.stdout
+    sys.stdout = output = StringIO.StringIO()
+    try:
+      call_command("autoverify", measure_recall=len(self.queries))
+    finally:
+      sys.stdout = stdout
+    lines = output.getvalue().splitlines()
+    self.assertTrue("MCTRegistration: 5 of 5 matches (100.0%)" in lines)
+    self.assertTrue("MCTPayroll: 0 of 0 matches (0.0%)" in lines)
+
+class NameSearchTest(TestCase):
+  def test_mct_registration_search(self):
+    with temp_obj(MCTRegistration, name='Brandon Bickford') as mct, \
+        temp_obj(MCTRegistration, name='Jim Johnson') as other:
+      c = Client()
+      response = c.get('/api/1.0/mct-registrations', {'name': 'Bicford Brandon'})
+      self.assertEqual(response.status_code, 200)
+      response_data = json.loads("".join(response.streaming_content))
+      self.assertEqual([h['id'] for h in response_data['health_workers']], [mct.id])
+
+  def test_ranked_pages(self):
+    with temp_obj(MCTRegistration, name='Brandon Bickfords') as near, \
+        temp_obj(MCTRegistration, name='Brandon Bickford') as exact:
+      c = Client()
+      response = c.get('/api/1.0/mct-registrations', {'name': 'Brandon Bickford', 'count': 1})
+      response_data = json.loads("".join(response.streaming_content))
+      self.assertEqual([h['id'] for h in response_data['health_workers']], [exact.id])
+      self.assertEqual(response_data['total'], 2)
+      response = c.get('/api/1.0/mct-registrations', dict(response_data['next'], name='Brandon Bickford'))
+      response_data = json.loads("".join(response.streaming_content))
+      self.assertEqual([h['id'] for h in response_data['health_workers']], [near.id])
+      self.assertEqual(response_data['next'], None)
+
+class CugImportTest(TestCase):
+  def setUp(self):
+    self.job_root = cug.JOB_ROOT
+    self.root = cug.JOB_ROOT = tempfile.mkdtemp()
+
+  def tearDown(self):
+    cug.JOB_ROOT = self.job_root
+    shutil.rmtree(self.root)
+
+  def test_iter_lines(self):
+    chunks = ["phone\r", "\n0768328988\r", "255768328989\n", "768328990"]
+    self.assertEqual(list(cug.iter_lines(chunks)),
+                     ["phone", "0768328988", "255768328989", "768328990"])
+
+  def test_set_closed_user_group(self):
+    with temp_obj(HealthWorker, name='Jim Johnson', vodacom_phone='+255768328988') as hw, \
+        temp_obj(HealthWorker, name='Jim Johnson', vodacom_phone='+255768328989') as other:
+      phones = [cug.normalize_tz_phone(i) for i in ['0768328988', '0768328987']]
+      self.assertEqual(cug.set_closed_user_group(phones, True), 1)
+      self.assertEqual(cug.set_closed_user_group(phones, True), 0)
+      self.assertTrue(HealthWorker.objects.get(id=hw.id).is_closed_user_group)
+      self.assertFalse(HealthWorker.objects.get(id=other.id).is_closed_user_group)
+
+  def test_resume_job(self):
+    "A job left running by a process that died resumes after its last batch"
+    data = "phone\r\n0768328988\r\n0768328989\r\n"
+    with temp_obj(HealthWorker, name='Jim Johnson', vodacom_phone='+255768328988') as first, \
+        temp_obj(HealthWorker, name='Jim Johnson', vodacom_phone='+255768328989') as second:
+      job_id = cug.start_import(SimpleUploadedFile("members.csv", data))
+      job = cug.get_job(job_id)
+      self.assertEqual(job["state"], "queued")
+      job.update(state="running", bytes_read=len("phone\r\n0768328988\r\n"), phones=1)
+      cug._save_job(job)
+      # The import of a locked upload is still running
+      with open(os.path.join(self.root, job_id + ".csv"), "rb") as a_file:
+        fcntl.flock(a_file.fileno(), fcntl.LOCK_EX)
+        self.assertEqual(cug.run_pending(), [])
+      self.assertEqual([i["id"] for i in cug.run_pending()], [job_id])
+      job = cug.get_job(job_id)
+      self.assertEqual(job["state"], "done")
+      self.assertEqual((job["phones"], job["added"], job["bytes_read"]), (2, 1, len(data)))
+      self.assertFalse(HealthWorker.objects.get(id=first.id).is_closed_user_group)
+      self.assertTrue(HealthWorker.objects.get(id=second.id).is_closed_user_group)
+      self.assertEqual(cug.run_pending(), [])
+
+class PaginationTest(TestCase):
+  def test_mct_payroll_pages(self):
+    with temp_obj(MCTPayroll, check_number='1') as p0, \
+        temp_obj(MCTPayroll, check_number='2') as p1, \
+        temp_obj(MCTPayroll, check_number='3') as p2:
+      c = Client()
+      data = json.loads(c.get('/api/1.0/mct-payrolls', {'count': 2}).content)
+      self.assertEqual([i['id'] for i in data['mct_payrolls']], [p0.id, p1.id])
+      self.assertEqual(data['total'], 3)
+      self.assertEqual(data['next'], {'after_id': p1.id, 'count': 2})
+      data = json.loads(c.get('/api/1.0/mct-payrolls', data['next']).content)
+      self.assertEqual([i['id'] for i in data['mct_payrolls']], [p2.id])
+      self.assertEqual(data['next'], None)
+      data = json.loads(c.get('/api/1.0/mct-payrolls', {'offset': 1, 'count': 1, 'total': 'none'}).content)
+      self.assertEqual([i['id'] for i in data['mct_payrolls']], [p1.id])
+      self.assertEqual(data['total'], None)
+
+class QueryCountTest(TestCase):
+  "Serializing a page must cost the same number of queries for any page size"
+  def count_queries(self, path, params):
+    with CaptureQueriesContext(connection) as queries:
+      response = Client().get(path, params)
+      if response.streaming:
+        "".join(response.streaming_content)
+    return len(queries)
+
+  def test_mct_registrations(self):
+    specialty = Specialty.objects.create(title='Surgery')
+    facility = Facility.objects.create(title='Dar Es Salaam Medical Center')
+    for i in range(5):
+      mct = MCTRegistration.objects.create(name='Jim Johnson', facility=facility)
+      mct.specialties.add(specialty)
+    one = self.count_queries('/api/1.0/mct-registrations', {'count': 1, 'total': 'none'})
+    many = self.count_queries('/api/1.0/mct-registrations', {'count': 5, 'total': 'none'})
+    self.assertEqual(one, many)
+
+  def test_mct_payrolls(self):
+    for i in range(5):
+      MCTPayroll.objects.create(check_number=str(i))
+    one = self.count_queries('/api/1.0/mct-payrolls', {'count': 1, 'total': 'none'})
+    many = self.count_queries('/api/1.0/mct-payrolls', {'count': 5, 'total': 'none'})
+    self.assertEqual(one, many)
+
+  def test_region_facilities(self):
+    district = RegionType.objects.create(title=RegionType.DISTRICT)
+    region = Region.objects.create(title='Mbeya')
+    hospital = FacilityType.objects.create(title='Hospital')
+    for i in range(5):
+      kyela = Region.objects.create(title='Kyela %d' % i, type=district, parent_region=region)
+      Facility.objects.create(title='Kyela Hospital %d' % i, type=hospital, region=kyela)
+    path = '/api/1.0/regions/%d/facilities' % region.id
+    one = self.count_queries(path, {'count': 1, 'total': 'none'})
+    many = self.count_queries(path, {'count': 5, 'total': 'none'})
+    self.assertEqual(one, many)
+    # Load the search index outside the counts
+    place_index.facility_index()
+    one = self.count_queries('/api/1.0/facilities/search', {'q': 'Kyela', 'count': 1})
+    many = self.count_queries('/api/1.0/facilities/search', {'q': 'Kyela', 'count': 5})
+    self.assertEqual(one, many)
+
+  def test_region_health_workers(self):
+    region = Region.objects.create(title='Mbeya')
+    specialty = Specialty.objects.create(title='Surgery')
+    for i in range(5):
+      facility = Facility.objects.create(title='Kyela Hospital %d' % i, region=region)
+      hw = HealthWorker.objects.create(name='Jim Johnson', facility=facility)
+      hw.specialties.add(specialty)
+    path = '/api/1.0/regions/%d/health-workers' % region.id
+    one = self.count_queries(path, {'count': 1, 'total': 'none'})
+    many = self.count_queries(path, {'count': 5, 'total': 'none'})
+    self.assertEqual(one, many)
+
+class SpecialtyTreeTest(TestCase):
+  def test_tree(self):
+    doctor = Specialty.objects.create(title='Doctor')
+    surgery = Specialty.objects.create(title='Surgery', parent_specialty=doctor)
+    brain = Specialty.objects.create(title='Brain Surgery', parent_specialty=surgery)
+    self.assertTrue(brain.is_child_of(doctor))
+    self.assertFalse(doctor.is_child_of(brain))
+    self.assertEqual(unicode(brain), u'Doctor -> Surgery -> Brain Surgery')
+    # Saving a specialty drops the cached tree
+    doctor.title = 'Medical Doctor'
+    doctor.save()
+    self.assertEqual(unicode(Specialty.objects.get(id=brain.id)), u'Medical Doctor -> Surgery -> Brain Surgery')
+
+REGIONS_XML = """<CSD xmlns="urn:ihe:iti:csd:2013"><organizationDirectory>
+<organization entityID="2.25.1"><otherID code="12"/><codedType code="2"/>
+<primaryName>Arusha</primaryName><record created="2014-01-01" updated="2014-01-02"/></organization>
+</organizationDirectory></CSD>"""
+
+class CSDClientTest(TestCase):
+  def setUp(self):
+    self.server = csdstub.StubCSDServer({csd.ORGANIZATION_SEARCH: REGIONS_XML}).start()
+    self.client = csd.CSDClient(base_url=self.server.base_url)
+
+  def tearDown(self):
+    self.server.stop()
+
+  def test_run(self):
+    regions = self.client.entries(csd.REGIONS)
+    self.assertEqual([(r["id"], r["title"], r["type"]) for r in regions], [("12", "Arusha", "Region")])
+    self.assertEqual(self.server.requests, [(csd.REGIONS.document, csd.REGIONS.function, csd.REGIONS.params)])
+    self.assertEqual(self.client.metrics.snapshot()[csd.ORGANIZATION_SEARCH]["requests"], 1)
+
+  def test_failure(self):
+    self.assertEqual(self.client.entries(csd.FACILITIES), None)
+    self.assertEqual(self.client.metrics.snapshot()[csd.FACILITY_SEARCH]["failures"], 1)
+
+def regions_xml(regions):
+  "A region search response for (id, title, updated) tuples"
+  return ("""<CSD xmlns="urn:ihe:iti:csd:2013"><organizationDirectory>"""
+          + "".join("""<organization entityID="2.25.%s"><otherID code="%s"/><codedType code="2"/>
+<primaryName>%s</primaryName><record created="2014-01-01" updated="%s"/></organization>"""
+                    % (i, i, title, updated) for i, title, updated in regions)
+          + "</organizationDirectory></CSD>")
+
+class CSDCacheTest(TestCase):
+  def setUp(self):
+    self.regions = [("12", "Arusha", "2014-01-02"), ("13", "Mbeya", "2014-01-02")]
+    self.changed = []
+    # Set to hold responses until the test releases them
+    self.release = threading.Event()
+    self.release.set()
+    self.server = csdstub.StubCSDServer({
+      csd.ORGANIZATION_SEARCH: self.respond,
+      csd.FACILITY_SEARCH: """<CSD xmlns="urn:ihe:iti:csd:2013"><facilityDirectory/></CSD>""",
+      csd.PROVIDER_SEARCH: """<CSD xmlns="urn:ihe:iti:csd:2013"><providerDirectory/></CSD>"""}).start()
+    self.root = tempfile.mkdtemp()
+    self.old_client = csd._client
+    self.old_root = csdcache.CACHE_ROOT
+    csd._client = csd.CSDClient(base_url=self.server.base_url)
+    csdcache.CACHE_ROOT = self.root
+    csdcache.invalidate()
+
+  def tearDown(self):
+    self.release.set()
+    self.wait_for_refresh()
+    csdcache.invalidate()
+    csd._client = self.old_client
+    csdcache.CACHE_ROOT = self.old_root
+    self.server.stop()
+    shutil.rmtree(self.root)
+
+  def respond(self, document, params):
+    self.release.wait(10)
+    if 'record updated=' in params:
+      return regions_xml(self.changed)
+    return regions_xml(self.regions)
+
+  def wait_for_refresh(self):
+    for i in range(100):
+      if not csdcache._refreshing:
+        return
+      time.sleep(0.05)
+
+  def titles(self, entries):
+    return [(i["id"], i["title"]) for i in entries]
+
+  def age(self, query, seconds):
+    "Make the cached entry of query older, in both tiers"
+    key = csdcache._cache_key(query)
+    entry = csdcache._memory.get(key)
+    entry.fetched_at -= seconds
+    entry.loaded_at -= seconds
+    csdcache._write_file(key, entry)
+
+  def test_cold_load(self):
+    self.assertEqual(self.titles(csdcache.get(csd.REGIONS)), [("12", "Arusha"), ("13", "Mbeya")])
+    self.assertEqual(self.titles(csdcache.get(csd.REGIONS)), [("12", "Arusha"), ("13", "Mbeya")])
+    self.assertEqual(len(self.server.requests), 1)
+    # Another process finds it in the file tier
+    csdcache._memory.clear()
+    self.assertEqual(len(csdcache.get(csd.REGIONS)), 2)
+    self.assertEqual(len(self.server.requests), 1)
+
+  def test_stale_while_revalidate(self):
+    csdcache.get(csd.REGIONS)
+    self.age(csd.REGIONS, csdcache.TTL + 1)
+    self.changed = [("13", "Mbeya Mjini", "2014-02-01")]
+    self.release.clear()
+    # Served from the cache while the refresh waits for the CSD service
+    self.assertEqual(self.titles(csdcache.get(csd.REGIONS)), [("12", "Arusha"), ("13", "Mbeya")])
+    self.release.set()
+    self.wait_for_refresh()
+    self.assertEqual(self.titles(csdcache.get(csd.REGIONS)), [("12", "Arusha"), ("13", "Mbeya Mjini")])
+    self.assertTrue('record updated="2014-01-02"' in self.server.requests[-1][2])
+
+  def test_merge(self):
+    entries = [{"id": "1", "v": 1}, {"id": "2", "v": 1}, {"id": "3", "v": 1}]
+    merged = csdcache._merge(entries, [{"id": "2", "v": 2}, {"id": "4", "v": 2}])
+    self.assertEqual([(i["id"], i["v"]) for i in merged], [("1", 1), ("2", 2), ("3", 1), ("4", 2)])
+    # Updates are merged in, a deleted region stays until a full refresh
+    entry = csdcache.refresh(csd.REGIONS)
+    self.regions = [("12", "Arusha", "2014-01-02")]
+    self.changed = [("14", "Iringa", "2014-02-01")]
+    entry = csdcache.refresh(csd.REGIONS, entry)
+    self.assertEqual(self.titles(entry.entries), [("12", "Arusha"), ("13", "Mbeya"), ("14", "Iringa")])
+    entry.loaded_at -= csdcache.FULL_REFRESH + 1
+    entry = csdcache.refresh(csd.REGIONS, entry)
+    self.assertEqual(self.titles(entry.entries), [("12", "Arusha")])
+
+  def test_refresh_command(self):
+    call_command("refresh_csd_cache", full=True)
+    self.assertEqual(len(csdcache.get(csd.REGIONS)), 2)
+    self.assertEqual(csdcache.get(csd.FACILITIES), [])
+    self.assertEqual(len(self.server.requests), 3)
+    del self.server.responses[csd.FACILITY_SEARCH]
+    self.assertRaises(CommandError, call_command, "refresh_csd_cache", invalidate=True)
+    self.assertEqual(csdcache._memory.get(csdcache._cache_key(csd.FACILITIES)), None)
+
+class RegionTreeTest(TestCase):
+  def test_subtree(self):
+    country = Region.objects.create(title="Tanzania")
+    region = Region.objects.create(title="Arusha", parent_region=country)
+    district = Region.objects.create(title="Meru", parent_region=region)
+    self.assertEqual(district.path, "/%d/%d/%d/" % (country.id, region.id, district.id))
+    self.assertEqual(set(country.subtree()), set([country, region, district]))
+    self.assertEqual(district.ancestors(), [country, region])
+
+  def test_subtree_without_path(self):
+    "A row written without save() doesn't have every region in its subtree"
+    country = Region.objects.create(title="Tanzania")
+    region = Region.objects.create(title="Arusha", parent_region=country)
+    district = Region.objects.create(title="Meru", parent_region=region)
+    Region.objects.create(title="Mbeya", parent_region=country)
+    Region.objects.filter(id=region.id).update(path="")
+    region = Region.objects.get(id=region.id)
+    self.assertEqual(region.subtree_path(), "/%d/%d/" % (country.id, region.id))
+    self.assertEqual(set(region.subtree()), set([region, district]))
+    self.assertEqual(list(Region(title="Unsaved").subtree()), [])
+    facility = Facility.objects.create(title="Ngarenanyuki", region=district)
+    Facility.objects.create(title="Ngarenanyuki", region=country)
+    query, matches = place_index.search_facilities("Ngarenanyuki", region=region)
+    self.assertEqual([place.id for place, score in matches], [facility.id])
+
+  def test_move(self):
+    a = Region.objects.create(title="A")
+    b = Region.objects.create(title="B")
+    child = Region.objects.create(title="C", parent_region=a)
+    grandchild = Region.objects.create(title="D", parent_region=child)
+    child.parent_region = b
+    child.save()
+    self.assertEqual(Region.objects.get(id=grandchild.id).path,
+                     "/%d/%d/%d/" % (b.id, child.id, grandchild.id))
+    self.assertEqual(a.subregion_ids(), set())
+    Region.objects.update(path="")
+    Region.rebuild_paths()
+    self.assertEqual(b.subregion_ids(), set([child.id, grandchild.id]))
+
+class BulkLoaderTest(TestCase):
+  def test_create_and_update(self):
+    cadre = Specialty.objects.create(title="Doctor", abbreviation="MD")
+    loader = _bulk.BulkLoader(MCTRegistration, chunk_size=2)
+    for name in ["A", "B", "C"]:
+      loader.create(MCTRegistration(name=name), many={"specialties": [cadre.id]})
+    loader.finish()
+    self.assertEqual(loader.stats.created, 3)
+    self.assertEqual(MCTRegistration.objects.filter(specialties=cadre).count(), 3)
+
+    payroll = MCTPayroll.objects.create(name="Old", check_number="1")
+    loader = _bulk.BulkLoader(MCTPayroll, update_fields=["name", "specialty"])
+    loader.update(MCTPayroll(id=payroll.id, name="New", specialty_id=cadre.id))
+    loader.finish()
+    payroll = MCTPayroll.objects.get(id=payroll.id)
+    self.assertEqual((payroll.name, payroll.specialty_id, payroll.check_number), ("New", cadre.id, "1"))
+
+class DatasetReaderTest(TestCase):
+  def setUp(self):
+    self.root = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.root)
+
+  def test_csv_resume(self):
+    path = os.path.join(self.root, "a.csv")
+    with open(path, "wb") as f:
+      f.write('a,b\r\n1,"x\r\ny"\r2,3\n')
+    reader = _helpers.CSVReader(path, use_mmap=True)
+    rows = iter(reader)
+    self.assertEqual(next(rows), {"a": "1", "b": "x\ny"})
+    resumed = _helpers.CSVReader(path, start=reader.offset)
+    self.assertEqual(list(resumed), [{"a": "2", "b": "3"}])
+
+  def test_checkpoint(self):
+    path = os.path.join(self.root, "a.json")
+    with open(path, "wb") as f:
+      f.write('{"a": 1}\n{"a": 2}\n{"a": 3}\n')
+    checkpoint = _helpers.Checkpoint("a", root=self.root)
+    batches = _helpers.batches(_helpers.LineJSONReader(path), 2, checkpoint)
+    next(batches)
+    next(batches)
+    reader = _helpers.LineJSONReader(path, start=checkpoint.load(path))
+    self.assertEqual(list(reader), [{"a": 3}])
+
+class ProgressImportTest(TestCase):
+  def test_upsert(self):
+    RegistrationStatus.objects.create(msisdn="255700000001", last_state=RegistrationStatus.INTRO)
+    RegistrationAnswer.objects.create(msisdn="255700000001", question=RegistrationStatus.FIRST_NAME,
+                                      answer="Old")
+    def record(msisdn, user):
+      return {"key": "users.+" + msisdn, "value": json.dumps(user)}
+    progress = _redis_import.ProgressImport()
+    progress.import_batch([
+      {"key": "metrics.unique_users", "value": "1"},
+      record("255700000001", {"current_state": "surname", "answers": {"first_name": "Asha"}}),
+      record("255700000002", {"current_state": "first_name", "answers": {"cadre": "1"},
+                              "pages": {"cadre": 2}})])
+    progress.finish()
+    self.assertEqual(RegistrationStatus.objects.get(msisdn="255700000001").last_state,
+                     RegistrationStatus.LAST_NAME)
+    self.assertEqual(RegistrationAnswer.objects.get(msisdn="255700000001").answer, "Asha")
+    answer = RegistrationAnswer.objects.get(msisdn="255700000002")
+    self.assertEqual((answer.question, answer.answer, answer.page), (RegistrationStatus.CADRE, "1", 2))
+    self.assertEqual(progress.statuses.stats.skip_reasons["not a user"], 1)
+
+class DatasetPlanTest(TestCase):
+  def test_plan(self):
+    mct = "0001_import_new_mct_list"
+    payroll = "0002_import_new_payroll"
+    DataSet.objects.create(key=mct, content_hash=dataset.content_hash(mct))
+    DataSet.objects.create(key=payroll, content_hash="0" * 40)
+    actions = dict((name, action) for name, action, _ in dataset.plan())
+    self.assertEqual(actions[mct], dataset.SKIP_UNCHANGED)
+    self.assertEqual(actions[payroll], dataset.SKIP_CHANGED)
+    self.assertEqual(actions["0004_import_dmo_list"], dataset.RUN_NEW)
+    actions = dict((name, action) for name, action, _ in dataset.plan(only=[payroll, mct], force=True))
+    self.assertEqual(actions[payroll], dataset.RUN_FORCED)
+    self.assertEqual(actions[mct], dataset.RUN_FORCED)
+    self.assertEqual(actions["0004_import_dmo_list"], dataset.SKIP_NOT_SELECTED)
+    self.assertEqual(dataset.dependencies("0006_import_redis_backup2", [mct, "0003_import_redis_backup"]),
+                     ["0003_import_redis_backup"])
+
+class SchemaTest(TestCase):
+  def test_validate_reports_every_key(self):
+    input_schema = schema.Dictionary({
+      "name": schema.String(min_length=1, required=True),
+      "email": schema.String(pattern="^.+@.+$"),
+      "birthdate": schema.Date()})
+    data, errors = input_schema.validate({"email": u"nobody", "birthdate": 2013})
+    self.assertEqual(data, None)
+    self.assertEqual([e["key"] for e in errors], ["birthdate", "email", "name"])
+    data, error = input_schema.parse({"name": u" Asha "})
+    self.assertEqual(data, {"name": u"Asha", "email": None, "birthdate": None})
+
+  def test_foreign_keys_in_one_query(self):
+    ids = [Specialty.objects.create(title=t).id for t in ["A", "B", "C"]]
+    input_schema = schema.Dictionary({
+      "specialties": schema.List(schema.ForeignKey(Specialty)),
+      "parent_specialty": schema.ForeignKey(Specialty)})
+    with self.assertNumQueries(1):
+      data, errors = input_schema.validate({"specialties": ids, "parent_specialty": ids[0]})
+    self.assertEqual([s.id for s in data["specialties"]], ids)
+    data, errors = input_schema.validate({"specialties": ids + [0, -1]})
+    self.assertEqual(errors, [{"key": "specialties", "status": schema.ERROR_INVALID_INPUT,
+                               "missing": [-1, 0]}])
+
+  def test_save_lists_errors(self):
+    response = Client().post("/api/1.0/health-workers", data=json.dumps({"email": "nobody"}),
+                             content_type="application/json")
+    response_data = json.loads(response.content)
+    self.assertEqual(response_data["status"], schema.ERROR_INVALID_INPUT)
+    self.assertEqual([e["key"] for e in response_data["errors"]], ["email", "name"])
+
+class LogChannelTest(TestCase):
+  def setUp(self):
+    self.root = tempfile.mkdtemp()
+    self.old_root = sb.logchan.channel_root
+    sb.logchan.close()
+    sb.logchan.channel_root = self.root
+
+  def tearDown(self):
+    sb.logchan.close()
+    sb.logchan.channel_root = self.old_root
+    shutil.rmtree(self.root)
+
+  def test_buffered_write(self):
+    sb.logchan.write("test-channel", phone="+255754000001", change=True, id=1)
+    sb.logchan.write_many("test-channel", [{"phone": "+255754000002", "change": False, "id": 2}])
+    sb.logchan.flush()
+    path = sb.logchan.day_path("test-channel", datetime.date.today())
+    with open(path) as f:
+      entries = [json.loads(line) for line in f]
+    self.assertEqual([e["data"]["id"] for e in entries], [1, 2])
+
+  def test_failed_flush_keeps_lines(self):
+    sb.logchan.write("test-channel", phone="+255754000001", change=True, id=1)
+    # A file where the channel directories should be
+    sb.logchan.channel_root = os.path.join(self.root, "file")
+    open(sb.logchan.channel_root, "w").close()
+    self.assertRaises(OSError, sb.logchan.flush)
+    sb.logchan.channel_root = self.root
+    sb.logchan.flush()
+    with open(sb.logchan.day_path("test-channel", datetime.date.today())) as f:
+      self.assertEqual([json.loads(line)["data"]["id"] for line in f], [1])
+
+  def test_index(self):
+    sb.logchan.write("test-channel", phone="+255754000001", change=True, id=1)
+    sb.logchan.write("test-channel", phone="+255754000002", change=True, id=2)
+    sb.logchan.flush()
+    index = logchan_index.ChannelIndex("test-channel")
+    self.assertEqual(index.update(), 2)
+    sb.logchan.write("test-channel", phone="+255754000001", change=False, id=1)
+    sb.logchan.flush()
+    self.assertEqual(index.update(), 1)
+    entries = index.by_phone("+255754000001", start=datetime.date.today())
+    self.assertEqual([e["data"]["change"] for e in entries], [True, False])
+    self.assertEqual(len(index.by_id(2)), 1)
+    index.close()
+
+class PhraseTrieTest(TestCase):
+  def test_same_as_pattern(self):
+    files = [stopwords.common_phrases_txt, stopwords.facility_common_phrases_txt]
+    pattern = stopwords.get_pattern(files)
+    trie = stopwords.get_trie(files)
+    for q in [u"Hospitali ya Wilaya Mbeya", u"AFYA   POST la Kigoma", u"afya-post na",
+              u"Zahanati", u"Anglikani za.  Askofu CRCT wa Tanga", u"andrew and sand", u""]:
+      self.assertEqual(trie.sub(u" ", q), pattern.sub(u" ", q))
+      self.assertEqual(stopwords.fix_query(q, [trie]), stopwords.fix_query(q, [pattern]))
+
+class FacilitySearchTest(TestCase):
+  def test_search(self):
+    hospital = FacilityType.objects.create(title="Hospital")
+    dispensary = FacilityType.objects.create(title="Dispensary")
+    mbeya = Region.objects.create(title="Mbeya")
+    arusha = Region.objects.create(title="Arusha")
+    referral = Facility.objects.create(title="Mbeya Referral Hospital", region=mbeya, type=hospital)
+    town = Facility.objects.create(title="Mbeya", region=mbeya, type=dispensary,
+                                   alternative_names="Mbeya Town; Mbeya Mjini")
+    Facility.objects.create(title="Mbeya Road", region=arusha, type=dispensary)
+    c = Client()
+    data = json.loads(c.get('/api/1.0/facilities/search', {'q': 'Hospitali ya Mbeya'}).content)
+    self.assertEqual(data['query'], 'Mbeya')
+    self.assertEqual([i['title'] for i in data['facilities']],
+                     ['Mbeya', 'Mbeya Road', 'Mbeya Referral Hospital'])
+    data = json.loads(c.get('/api/1.0/facilities/search', {'q': 'mbeya mjin'}).content)
+    self.assertEqual([i['id'] for i in data['facilities']], [town.id])
+    data = json.loads(c.get('/api/1.0/facilities/search',
+                            {'q': 'Mbeya', 'region': mbeya.id, 'type': hospital.id}).content)
+    self.assertEqual([i['id'] for i in data['facilities']], [referral.id])
+
+  def test_created_facility_keeps_warm_index(self):
+    "Once warm, a user-submitted facility doesn't make the next search reload"
+    Facility.objects.create(title="Mbeya Referral Hospital")
+    place_index._facilities.invalidate()
+    warmed = place_index._warmed
+    place_index._warmed = True
+    try:
+      index = place_index._facilities.get()
+      data = json.loads(Client().post('/api/1.0/facilities', data=json.dumps({'title': 'Kyela Dispensary'}),
+                                      content_type='application/json').content)
+      self.assertTrue(place_index._facilities.get() is index)
+      place_index._facilities.refresh()
+      self.assertEqual([p.id for p, s in place_index._facilities.get().search("Kyela")], [data['id']])
+    finally:
+      place_index._warmed = warmed
+      place_index._facilities.invalidate()
+
+class DistrictSearchTest(TestCase):
+  def test_search(self):
+    district = RegionType.objects.create(title=RegionType.DISTRICT)
+    mbeya = Region.objects.create(title="Mbeya")
+    kyela = Region.objects.create(title="Kyela", parent_region=mbeya, type=district,
+                                  alternative_names="Kyella, Kiela")
+    Region.objects.create(title="Kyela Mjini", parent_region=kyela)
+    c = Client()
+    data = json.loads(c.get('/api/1.0/districts/search', {'q': 'Wilaya ya Kyella'}).content)
+    self.assertEqual(data['query'], 'Kyella')
+    self.assertEqual(data['districts'], [{'id': kyela.id, 'title': 'Kyela', 'score': 1.0,
+                                          'parent_region': {'id': mbeya.id, 'title': 'Mbeya'}}])
+
+  def test_change_keeps_warm_index(self):
+    "Once warm, a change is refreshed in the background, not by the next search"
+    district = RegionType.objects.create(title=RegionType.DISTRICT)
+    Region.objects.create(title="Kyela", type=district)
+    place_index._districts.invalidate()
+    warmed = place_index._warmed
+    place_index._warmed = True
+    try:
+      index = place_index._districts.get()
+      Region.objects.create(title="Mbozi", type=district)
+      self.assertTrue(place_index._districts.get() is index)
+      place_index._districts.refresh()
+      self.assertEqual([p.title for p, s in place_index._districts.get().search("Mbozi")], ["Mbozi"])
+    finally:
+      place_index._warmed = warmed
+      place_index._districts.invalidate()
+
+@override_settings(VUMIGO_SEND_SMSES=True)
+class SmsQueueTest(TestCase):
+  def setUp(self):
+    self.root = tempfile.mkdtemp()
+    self.old_root = sb.smsqueue.QUEUE_ROOT
+    self.old_send = sb.smsqueue.send
+    sb.smsqueue.QUEUE_ROOT = self.root
+    sb.smsqueue.send = self.send
+    self.sent = []
+    self.failing = False
+    self.broken = set()
+    self.dispatcher = sb.smsqueue.Dispatcher(workers=1)
+
+  def tearDown(self):
+    self.dispatcher.close()
+    sb.smsqueue.QUEUE_ROOT = self.old_root
+    sb.smsqueue.send = self.old_send
+    shutil.rmtree(self.root)
+
+  def send(self, job):
+    if self.failing:
+      raise sb.util.SmsSendingError("Failed to send SMS")
+    if job["to_addr"] in self.broken:
+      raise ValueError("No JSON object could be decoded")
+    self.sent.append((job["to_addr"], job["content"]))
+
+  def names(self, directory):
+    return sorted(os.listdir(os.path.join(self.root, directory)))
+
+  def test_send(self):
+    name = sb.smsqueue.enqueue_many([("+255754000001", "a"), ("+255754000002", "b")])
+    self.assertEqual(self.names("new"), [name])
+    self.assertEqual(self.dispatcher.run_once(), 1)
+    self.assertEqual(self.sent, [("+255754000001", "a"), ("+255754000002", "b")])
+    self.assertEqual(self.names("new") + self.names("cur"), [])
+
+  def test_backoff(self):
+    self.assertEqual(sb.smsqueue.backoff(3), sb.smsqueue.BACKOFF_SECONDS * 4)
+    self.assertEqual(sb.smsqueue.backoff(100), sb.smsqueue.MAX_BACKOFF_SECONDS)
+    self.failing = True
+    sb.smsqueue.enqueue("+255754000001", "a")
+    self.dispatcher.run_once()
+    [name] = self.names("new")
+    with open(os.path.join(self.root, "new", name)) as f:
+      self.assertEqual(json.loads(f.readline())["attempts"], 1)
+    self.assertEqual(sb.smsqueue.claim(), [])
+    self.assertEqual(len(sb.smsqueue.claim(now=time.time() + sb.smsqueue.backoff(1) + 1)), 1)
+
+  def test_unexpected_error(self):
+    "A job failing unexpectedly is retried alone, the file's others are sent once"
+    self.broken.add("+255754000001")
+    sb.smsqueue.enqueue_many([("+255754000001", "a"), ("+255754000002", "b")])
+    self.assertEqual(self.dispatcher.run_once(), 1)
+    self.assertEqual(self.sent, [("+255754000002", "b")])
+    self.assertEqual(self.names("cur"), [])
+    [name] = self.names("new")
+    with open(os.path.join(self.root, "new", name)) as f:
+      self.assertEqual([json.loads(line)["to_addr"] for line in f], ["+255754000001"])
+
+  def test_failed_after_max_attempts(self):
+    self.failing = True
+    sb.smsqueue.enqueue("+255754000001", "a")
+    for i in range(sb.smsqueue.MAX_ATTEMPTS):
+      [path] = sb.smsqueue.claim(now=time.time() + sb.smsqueue.MAX_BACKOFF_SECONDS + 1)
+      self.dispatcher.process_file(path)
+    self.assertEqual(self.names("new") + self.names("cur"), [])
+    self.assertEqual(len(self.names("failed")), 1)
+    self.assertEqual(self.dispatcher.failed, 1)
+
+  def test_recover(self):
+    name = sb.smsqueue.enqueue("+255754000001", "a")
+    # A job that waited in new/ longer than STALE_SECONDS
+    long_ago = time.time() - 2 * sb.smsqueue.STALE_SECONDS
+    os.utime(os.path.join(self.root, "new", name), (long_ago, long_ago))
+    [path] = sb.smsqueue.claim()
+    self.assertEqual(sb.smsqueue.recover(), [])
+    os.utime(path, (long_ago, long_ago))
+    self.assertEqual(sb.smsqueue.recover(), [name])
+    self.assertEqual(self.names("new"), [name])
+    self.assertFalse(self.dispatcher.process_file(path))
+
 @contextlib.contextmanager
 def temp_obj(django_type, **attrs):
   o = django_type()
@@ -6,9 +6,13 @@ urlpatterns = patterns('',
   url('^specialties', 'sb.healthworker.views.on_specialty'),
   url('^mct-registrations', 'sb.healthworker.views.on_mct_registration_index'),
   url('^mct-payrolls', 'sb.healthworker.views.on_mct_payroll_index'),
+  url(r'^facilities/search$', 'sb.healthworker.views.on_facility_search'),
   url('^facilities', 'sb.healthworker.views.on_facility'),
   url('^health-workers', 'sb.healthworker.views.on_health_worker'),
   url('^facility-types', 'sb.healthworker.views.on_facility_type_index'),
   url('^region-types', 'sb.healthworker.views.on_region_type_index'),
+  url(r'^regions/(?P<region_id>\d+)/facilities$', 'sb.healthworker.views.on_region_facility_index'),
+  url(r'^regions/(?P<region_id>\d+)/health-workers$', 'sb.healthworker.views.on_region_health_worker_index'),
+  url(r'^districts/search$', 'sb.healthworker.views.on_district_search'),
   url('^regions', 'sb.healthworker.views.on_region_index'))
 
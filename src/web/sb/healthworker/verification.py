@@ -0,0 +1,224 @@
+# Copyright 2013 Switchboard, Inc
+"""Set-based auto verification of health workers
+
+HealthWorker.auto_verify checks one worker at a time and issues a query per
+check and data source.  This module runs the same checks for a whole batch of
+workers: numbers and names are looked up in the in-memory registry indexes
+(see sb.healthworker.registry_index) and the winning matches are written back
+with a few bulk UPDATE statements.
+
+Stages run in the same order as auto_verify, and within a stage every data
+source links at most one unclaimed record to each worker, lowest worker id
+first.  Because a stage is resolved for the whole batch before the next one
+starts, a record wanted by one worker's payroll number and another worker's
+name goes to the payroll number match, whatever the worker ids.
+"""
+
+import collections
+
+from django.db import transaction
+from django.db.models import Case, IntegerField, Value, When
+
+from sb.healthworker import blocking
+from sb.healthworker import models
+from sb.healthworker import registry_index
+
+BATCH_SIZE = 1000
+UPDATE_CHUNK_SIZE = 500
+
+class Stage(object):
+  """A verification check run against a list of registry tables
+
+  worker_field and record_field are compared for equality.  similar_field
+  names a HealthWorker field that must also be similar to the record name.
+  """
+  def __init__(self, name, state, sources, worker_field=None,
+               record_field=None, similar_field=None, alpha_only=False):
+    self.name = name
+    self.state = state
+    self.sources = sources
+    self.worker_field = worker_field
+    self.record_field = record_field
+    self.similar_field = similar_field
+    self.alpha_only = alpha_only
+
+  def eligible(self, worker):
+    "Is the worker (a dict of HealthWorker values) checked by this stage?"
+    if self.worker_field and not worker[self.worker_field]:
+      return False
+    if self.similar_field:
+      value = worker[self.similar_field]
+      if not value:
+        return False
+      # Ignore numeric names
+      if self.alpha_only and not all([part.isalpha() for part in value.split()]):
+        return False
+    return True
+
+STAGES = [
+  Stage("payroll", models.HealthWorker.MCT_PAYROLL_VERIFIED,
+        [models.MCTPayroll, models.DMORegistration, models.NGORegistration],
+        worker_field="mct_payroll_num", record_field="check_number"),
+  Stage("registration", models.HealthWorker.MCT_REGISTRATION_VERIFIED,
+        [models.MCTRegistration, models.DMORegistration, models.NGORegistration],
+        worker_field="mct_registration_num", record_field="registration_number",
+        similar_field="surname"),
+  Stage("phone", models.HealthWorker.PHONE_NUMBER_VERIFIED,
+        [models.DMORegistration, models.NGORegistration],
+        worker_field="vodacom_phone", record_field="phone_number"),
+  Stage("name", models.HealthWorker.NAME_VERIFIED,
+        [models.MCTPayroll, models.MCTRegistration, models.DMORegistration,
+         models.NGORegistration],
+        similar_field="name", alpha_only=True),
+]
+
+_worker_fields = ["id", "name", "surname", "vodacom_phone",
+                  "mct_payroll_num", "mct_registration_num"]
+
+class Report(object):
+  "Counts of workers checked and verified by each stage"
+  def __init__(self):
+    self.checked = 0
+    self.verified = collections.OrderedDict((s.name, 0) for s in STAGES)
+    self.linked = collections.OrderedDict(
+      ((s.name, cls.__name__), 0) for s in STAGES for cls in s.sources)
+
+  def lines(self):
+    yield "Checked: %d" % self.checked
+    for stage, count in self.verified.items():
+      yield "Verified by %s: %d" % (stage, count)
+      for (stage0, source), linked in self.linked.items():
+        if stage0 == stage:
+          yield "  %s records linked: %d" % (source, linked)
+
+def key_pairs(stage, cls, workers):
+  """Find (worker id, record id) pairs whose numbers match
+
+  Numbers are looked up in the registry index, the same way
+  HealthWorker.auto_verify does.
+  """
+  index = registry_index.key_index(cls)
+  pairs = []
+  for worker in workers:
+    for record_id in index.lookup(stage.record_field, worker[stage.worker_field]):
+      pairs.append((worker["id"], record_id))
+  return pairs
+
+def similar_pairs(stage, cls, workers, pairs):
+  "Keep the pairs whose record name is similar to the worker's"
+  index = registry_index.name_index(cls)
+  values = dict((w["id"], w[stage.similar_field]) for w in workers)
+  return [(worker_id, record_id) for worker_id, record_id in pairs
+          if index.score(record_id, values[worker_id]) is not None]
+
+def name_pairs(stage, cls, workers):
+  """Find (worker id, record id) pairs with similar names
+
+  Only the candidates of the blocking stage are scored.  Each worker's
+  records are ordered best match first.
+  """
+  pairs = []
+  for worker in workers:
+    matches = blocking.search(cls, worker[stage.similar_field])
+    pairs.extend((worker["id"], record_id) for record_id, score in matches)
+  return pairs
+
+def candidate_pairs(stage, cls, workers):
+  """Find (worker id, record id) pairs for unclaimed records of cls
+
+  workers must be ordered by id; pairs are ordered by worker id and then
+  by preference.
+  """
+  if stage.record_field is None:
+    return name_pairs(stage, cls, workers)
+  pairs = key_pairs(stage, cls, workers)
+  if stage.similar_field:
+    pairs = similar_pairs(stage, cls, workers, pairs)
+  return pairs
+
+def assign(pairs):
+  """Pick at most one record per worker and one worker per record
+
+  pairs must be ordered by worker id so that lower ids win, as they do when
+  auto_verify runs over workers in id order.
+  """
+  links = []
+  linked_workers = set()
+  taken_records = set()
+  for worker_id, record_id in pairs:
+    if worker_id in linked_workers or record_id in taken_records:
+      continue
+    linked_workers.add(worker_id)
+    taken_records.add(record_id)
+    links.append((worker_id, record_id))
+  return links
+
+def _chunks(items, size):
+  for i in range(0, len(items), size):
+    yield items[i:i + size]
+
+def link_records(cls, links):
+  """Set health_worker on each (worker id, record id) link
+
+  The indexes may be stale, so a record claimed since they were loaded is
+  left to its worker.  Returns the links written.
+  """
+  written = []
+  for chunk in _chunks(links, UPDATE_CHUNK_SIZE):
+    records = cls.objects.filter(id__in=[r for _, r in chunk], health_worker__isnull=True)
+    unclaimed = set(records.select_for_update().values_list("id", flat=True))
+    chunk = [(w, r) for w, r in chunk if r in unclaimed]
+    if not chunk:
+      continue
+    whens = [When(id=record_id, then=Value(worker_id))
+             for worker_id, record_id in chunk]
+    records.filter(id__in=[r for _, r in chunk]).update(
+      health_worker_id=Case(*whens, output_field=IntegerField()))
+    written.extend(chunk)
+  registry_index.claimed_on_commit(cls, [r for _, r in written])
+  return written
+
+def set_verification_state(worker_ids, state):
+  worker_ids = sorted(worker_ids)
+  for chunk in _chunks(worker_ids, UPDATE_CHUNK_SIZE):
+    models.HealthWorker.objects.filter(id__in=chunk).update(verification_state=state)
+
+def verify_batch(workers, report):
+  """Run every stage for a batch of unverified workers
+
+  workers is a list of dicts with the fields in _worker_fields.
+  """
+  pending = collections.OrderedDict((w["id"], w) for w in workers)
+  report.checked += len(pending)
+  for stage in STAGES:
+    eligible = [w for w in pending.values() if stage.eligible(w)]
+    if not eligible:
+      continue
+    verified = set()
+    for cls in stage.sources:
+      links = link_records(cls, assign(candidate_pairs(stage, cls, eligible)))
+      report.linked[(stage.name, cls.__name__)] += len(links)
+      verified.update(worker_id for worker_id, _ in links)
+    set_verification_state(verified, stage.state)
+    report.verified[stage.name] += len(verified)
+    for worker_id in verified:
+      del pending[worker_id]
+
+def verify_unverified(batch_size=BATCH_SIZE, report=None):
+  """Auto verify every unverified health worker, a batch at a time
+
+  Returns a Report
+  """
+  if report is None:
+    report = Report()
+  last_id = 0
+  while True:
+    workers = models.HealthWorker.objects
+    workers = workers.filter(verification_state=models.HealthWorker.UNVERIFIED,
+                             id__gt=last_id)
+    workers = list(workers.order_by("id").values(*_worker_fields)[:batch_size])
+    if not workers:
+      return report
+    with transaction.atomic():
+      verify_batch(workers, report)
+    last_id = workers[-1]["id"]
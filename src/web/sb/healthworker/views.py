@@ -1,15 +1,8 @@
 # Copyright 2012 Switchboard, Inc
-import csv
-import datetime
 import json
 import logging
-import re
 import sys
-import os
 import time
-import types
-import StringIO
-import requests
 from xml.etree import ElementTree as ET
 
 from django.core import serializers
@@ -21,21 +14,26 @@ from django.views.decorators.csrf import csrf_exempt
 from django.contrib.staticfiles.templatetags.staticfiles import static
 
 from sb import http
+from sb.healthworker import csd
+from sb.healthworker import csdcache
+from sb.healthworker import cug as cug_import
 from sb.healthworker import models
+from sb.healthworker import pagination
+from sb.healthworker import place_index
+from sb.healthworker import registry_index
+from sb.healthworker import schema
+from sb.healthworker import serializers
 from sb.healthworker import stopwords
 import sb.util
 import sb.html
+import sb.testing
 
 _log = logging.getLogger('sb.healthworker.views')
 
 OK = 0
-ERROR_INVALID_INPUT = -1
+ERROR_INVALID_INPUT = schema.ERROR_INVALID_INPUT
 ERROR_INVALID_PATTERN = -2
 
-BASE_URL = 'http://46.51.196.92:8984/CSD/csr/'
-BASE_URL_SUFFIX = '/careServicesRequest/'
-
-
 def _log_request_json(function):
   def new_function(request):
     json = getattr(request, 'JSON', None)
@@ -45,26 +43,6 @@ def _log_request_json(function):
     return response
   return new_function
 
-def csd_query(query_file, csd_document, csd_function):
-    full_url = BASE_URL + csd_document + BASE_URL_SUFFIX + csd_function
-    request_file = query_file
-    file_set = {'file': (request_file, open(request_file, 'rb'), 'text/xml', {'Expires': '0'})}
-    r = requests.post(full_url, files=file_set)
-    if r.status_code == 200:
-      return r.content
-    else:
-      return False
-
-
-def is_none(element, attribute=''):
-  if element is None:
-    return "null"
-  else:
-    if attribute == '':
-      return element.text
-    else:
-      return element.get(attribute)
-  
 def _specialty_to_dictionary(specialty):
   "Convert a Specialty to a dictionary suitable for JSON encoding"
   return {"created_at": specialty.created_at,
@@ -81,11 +59,8 @@ def _specialty_to_dictionary(specialty):
 
 def on_specialty_index(request):
   """Get a list of specialties"""
-  specialties = models.Specialty.objects.all()
-
-  # Filter out user submitted specialties:
-  specialties = [i for i in specialties if not i.is_user_submitted]
-  specialties.sort(key=lambda i: ((sys.maxint - i.priority), i.title))
+  # Without user submitted specialties, by priority and title:
+  specialties = models.specialty_tree.get().listed
   return http.to_json_response({
     "status": OK,
     "specialties": map(_specialty_to_dictionary, specialties)})
@@ -94,102 +69,60 @@ def on_mct_payroll_index(request):
   """Get a list of ministry of tanzania payroll entries"""
   mct_payroll_entries = models.MCTPayroll.objects
   check = sb.util.safe(lambda: request.GET["check"])
-  offset = sb.util.safe(lambda: int(request.GET["offset"])) or 0
-  count = sb.util.safe(lambda: int(request.GET["count"])) or 100
   if check:
     mct_payroll_entries = mct_payroll_entries.filter(check_number=check)
+  mct_payroll_entries = serializers.MCT_PAYROLL.query_set(mct_payroll_entries.all())
   name = request.GET.get("name")
   if name is not None:
-    mct_payroll_entries = include_similar(mct_payroll_entries, "name", name)
-
-  mct_payroll_entries = mct_payroll_entries.all()
-  mct_payroll_entries = list(mct_payroll_entries)
-  total = len(mct_payroll_entries)
-  mct_payroll_entries = mct_payroll_entries[offset:count]
+    ids = similar_ids(mct_payroll_entries, "name", name)
+    page = pagination.paginate_ranked(mct_payroll_entries, ids, request)
+  else:
+    page = pagination.paginate(mct_payroll_entries, request)
   return http.to_json_response({
     "status": OK,
-    "total": total,
-    "mct_payrolls": [{
-        "id": i.id,
-        "name": i.name,
-        "birthdate": i.birthdate,
-        "designation": i.designation,
-        "district": i.district,
-        "specialty_id": i.specialty_id,
-        "last_name": i.last_name,
-        "region_id": i.region_id,
-        "health_worker_id": i.health_worker_id,
-        "facility_id": i.facility_id,
-        "check_number": i.check_number}
-      for i in mct_payroll_entries]})
+    "total": page.total,
+    "next": page.next,
+    "mct_payrolls": list(serializers.MCT_PAYROLL.serialize(page.rows))})
 
 def on_mct_registration_index(request):
   "Get information about a health worker"
   health_workers = models.MCTRegistration.objects
   num = request.GET.get("registration")
-  count = sb.util.safe(lambda:int(request.GET["count"])) or 100
-  offset = sb.util.safe(lambda:int(request.GET["offset"])) or 0
   if num:
     health_workers = health_workers.filter(registration_number=num)
 
+  health_workers = serializers.MCT_REGISTRATION.query_set(health_workers.all())
   name = request.GET.get("name")
   if name is not None:
-    health_workers = include_similar(health_workers, "name", name)
-
-  health_workers = list(health_workers.all())
-  total = len(health_workers)
-
-  health_worker_dicts = []
-  for h in health_workers[offset:count]:
-    health_worker_dicts.append({
-      "address": h.address,
-      "birthdate": h.birthdate,
-      "cadre": h.cadre,
-      "category": h.category,
-      "country": h.country,
-      "created_at": h.created_at,
-      "current_employer": h.current_employer,
-      "dates_of_registration_full": h.dates_of_registration_full,
-      "dates_of_registration_provisional": h.dates_of_registration_provisional,
-      "dates_of_registration_temporary": h.dates_of_registration_temporary,
-      "email": h.email,
-      "employer_during_internship": h.employer_during_internship,
-      "facility": h.facility.id if h.facility else None,
-      "file_number": h.file_number,
-      "id": h.id,
-      "name": h.name,
-      "qualification_final": h.qualification_final,
-      "qualification_provisional": h.qualification_provisional,
-      "qualification_specialization_1": h.qualification_specialization_1,
-      "qualification_specialization_2": h.qualification_specialization_2,
-      "registration_number": h.registration_number,
-      "registration_type": h.registration_type,
-      "specialties": [i.id for i in h.specialties.all()],
-      "specialty": h.specialty,
-      "specialty_duration": h.specialty_duration,
-      "updated_at": h.updated_at})
+    ids = similar_ids(health_workers, "name", name)
+    page = pagination.paginate_ranked(health_workers, ids, request)
+  else:
+    page = pagination.paginate(health_workers, request)
   response = {
       "status": OK,
-      "total": total,
-      "health_workers": health_worker_dicts}
-  return http.to_json_response(response)
-
-def _region_to_dictionary(region):
-  if region is None:
-    return None
-  else:
-    return {
-        "title": region.title,
-        "type": region.type.title if region.type is not None else None,
-        "id": region.id,
-        "parent_region_id": region.parent_region_id,
-        "created_at": region.created_at,
-        "updated_at": region.updated_at}
-
-def include_similar(query_set, field, value, algorithm='trigram', distance=0.5):
-  where = ["is_similar(%%s, %s, '%s', %.2f)" % (field, algorithm, distance)]
-  where_params = [value]
-  return query_set.extra(where=where, params=where_params)
+      "total": page.total,
+      "next": page.next,
+      "health_workers": serializers.MCT_REGISTRATION.serialize(page.rows)}
+  return http.to_json_stream_response(response)
+
+# Most name matches a search returns
+MAX_SIMILAR = 1000
+
+def similar_ids(query_set, field, value, algorithm=None, distance=None):
+  """The ids of the rows of a registry query set whose field is similar to value
+
+  Best match first, at most MAX_SIMILAR.  Only the rows of a filtered query
+  set, which are few (a check or registration number), are scored.  The
+  algorithm and distance default to the settings NAME_MATCH_ALGORITHM and
+  NAME_MATCH_THRESHOLD.
+  """
+  index = registry_index.name_index(query_set.model, field)
+  candidates = None
+  if query_set.query.where:
+    candidates = list(query_set.values_list("id", flat=True))
+  matches = index.search(value, algorithm=algorithm, threshold=distance,
+                         limit=MAX_SIMILAR, candidates=candidates)
+  return [i for i, score in matches]
 
 def on_region_type_index(request):
   return http.to_json_response({
@@ -201,72 +134,47 @@ def on_region_type_index(request):
        "id": r.id} for r in models.RegionType.objects.all()
     ]})
 
-region_types = {
-  "1": "Country",
-  "2": "Region",
-  "3": "District",
-  "4": "Division",
-  "5": "Village",
-  "6": "Ward",
-}
-
 def on_region_index(request):
-  csd_document = 'CSD-HNP'
-  csd_function = 'urn:ihe:iti:csd:2014:stored-function:organization-search'
-  write_file = os.system("rm /tmp/csd_query_region.xml; touch /tmp/csd_query_region.xml")
-  write_file = open('/tmp/csd_query_region.xml', 'r+')  
-  query_string = '<csd:requestParams xmlns:csd="urn:ihe:iti:csd:2013"><csd:codedType codingScheme="2.25.220237170085002235066132143088055219024007198012" /></csd:requestParams>'
-  
-  #region_filters = code="2" codingScheme="2.25.220237170085002235066132143088055219024007198012"
-  #district_filters code="3" codingScheme="2.25.220237170085002235066132143088055219024007198012"
-  #region_id.text = ""
-  write_file.write(query_string)
-  write_file.close()
-  query_file = ('/tmp/csd_query_region.xml')    
-  return_text = csd_query(query_file, csd_document, csd_function)
-  if return_text == False:
+  regions = csdcache.get(csd.REGIONS)
+  if regions is None:
     response = {
       "status": "FAILED"
       }
   else:
-    print(return_text)
-    return_text = ET.fromstring(return_text)
-    regions = [
-      {
-        'parent_region_id':is_none(region.find('{urn:ihe:iti:csd:2013}parent'), 'entityID'),
-        'title':is_none(region.find('{urn:ihe:iti:csd:2013}primaryName'), ),
-        'created_at':is_none(region.find('{urn:ihe:iti:csd:2013}record'), 'created'),
-        "updated_at":is_none(region.find('{urn:ihe:iti:csd:2013}record'), 'updated'),
-        "type":region_types[region.find('{urn:ihe:iti:csd:2013}codedType').get('code')],
-        'id':is_none(region.find('{urn:ihe:iti:csd:2013}otherID'), 'code')} for region in return_text.iter('{urn:ihe:iti:csd:2013}organization')]                
     response = {
       "status": OK,
       "regions": regions}
-  return http.to_json_response(response)
+  return http.to_json_stream_response(response)
 
-def _facility_to_dictionary(facility):
-  region = None
-  r = facility.region
-  if r is not None:
-    region = {
-      "title": r.title,
-      "id": r.id,
-      "parent_region_id": r.parent_region_id,
-      "type_id": r.type_id}
-  return {
-      "id": facility.id,
-      "title": facility.title,
-      "address": facility.address,
-      "type": facility.type.title if facility.type else None,
-      "place_type": facility.place_type,
-      "serial_number": facility.serial_number,
-      "owner": facility.owner,
-      "ownership_type": facility.ownership_type,
-      "phone": facility.phone,
-      "region_id": facility.region_id,
-      "region": region,
-      "created_at": facility.created_at,
-      "updated_at": facility.updated_at}
+def _region_or_none(region_id):
+  return sb.util.safe(lambda: models.Region.objects.get(id=int(region_id)))
+
+def on_region_facility_index(request, region_id):
+  "Get the facilities in a region and the regions under it"
+  region = _region_or_none(region_id)
+  if region is None:
+    return http.not_found()
+  facilities = models.Facility.objects.filter(region__path__startswith=region.subtree_path())
+  page = pagination.paginate(serializers.FACILITY.query_set(facilities), request)
+  return http.to_json_stream_response({
+    "status": OK,
+    "total": page.total,
+    "next": page.next,
+    "facilities": serializers.FACILITY.serialize(page.rows)})
+
+def on_region_health_worker_index(request, region_id):
+  "Get the health workers at facilities in a region and the regions under it"
+  region = _region_or_none(region_id)
+  if region is None:
+    return http.not_found()
+  health_workers = models.HealthWorker.objects.filter(
+    facility__region__path__startswith=region.subtree_path())
+  page = pagination.paginate(serializers.HEALTH_WORKER.query_set(health_workers), request)
+  return http.to_json_stream_response({
+    "status": OK,
+    "total": page.total,
+    "next": page.next,
+    "health_workers": serializers.HEALTH_WORKER.serialize(page.rows)})
 
 def retDistrictID(ETObject, with_name=False):
   district = ETObject.find('{urn:ihe:iti:csd:2013}organizations/{urn:ihe:iti:csd:2013}organization')
@@ -278,185 +186,130 @@ def retDistrictID(ETObject, with_name=False):
     else:
       return district.get('entityID')
 
-blank = '''<CSD xmlns="urn:ihe:iti:csd:2013" xmlns:csd="urn:ihe:iti:csd:2013">
-  <organizationDirectory/>
-  <serviceDirectory/>
-  <facilityDirectory/>
-  <providerDirectory/>
-</CSD>'''
-
-def returnRegion(districtID, csd_document='CSD-HNP'):
+def returnRegion(districtID, csd_document=csd.DEFAULT_DOCUMENT):
   if districtID == 'None':
     return 'None'
   else:
-    csd_document = csd_document
-    csd_function = 'urn:ihe:iti:csd:2014:stored-function:organization-search'    
-    write_file = os.system("touch /tmp/csd_query.xml")
-    write_file = open('/tmp/csd_query.xml', 'r+')
     requestParams = ET.Element('csd:requestParams', xmlns="urn:ihe:iti:csd:2013")
     region_id = ET.SubElement(requestParams, 'csd:id', entityID=districtID)
     region_id.text = districtID
-    string = ET.tostring(requestParams)
-    write_file.write(string.replace("xmlns", "xmlns:csd"))
-    query_file = ('/tmp/csd_query.xml')
-    return_text = csd_query(query_file, csd_document, csd_function)
-    
-    if return_text == False:
+    params = ET.tostring(requestParams).replace("xmlns", "xmlns:csd")
+    return_text = csd.client().post(csd_document, csd.ORGANIZATION_SEARCH, params)
+
+    if return_text is None:
       return None
     else:
-      if len(return_text) == len(blank):
-        return returnRegion(districtID, 'CSD-HNP')
-      else:        
-        return_text = ET.fromstring(return_text)
-        region = return_text.find('{urn:ihe:iti:csd:2013}organizationDirectory/{urn:ihe:iti:csd:2013}organization')          
-        return {'id':region.get('entityID'), 'title':region.find('{urn:ihe:iti:csd:2013}primaryName').text}
+      return_text = ET.fromstring(return_text)
+      region = return_text.find('{urn:ihe:iti:csd:2013}organizationDirectory/{urn:ihe:iti:csd:2013}organization')
+      if region is None:
+        # Not in this document, try the default one
+        if csd_document != csd.DEFAULT_DOCUMENT:
+          return returnRegion(districtID, csd.DEFAULT_DOCUMENT)
+        return None
+      return {'id':region.get('entityID'), 'title':region.find('{urn:ihe:iti:csd:2013}primaryName').text}
 
 def on_facility_index(request):
-  csd_document = 'CSD-HNP'
-  csd_function = 'urn:ihe:iti:csd:2014:stored-function:facility-search'
-  write_file = os.system("rm /tmp/csd_query_facility.xml; touch /tmp/csd_query_facility.xml")
-  write_file = open('/tmp/csd_query_facility.xml', 'r+')  
-  query_string = '<csd:requestParams xmlns:csd="urn:ihe:iti:csd:2013"><csd:facility><csd:codedType codingScheme="2.25.065073125158126083079071176122160207089182210156" /></csd:facility></csd:requestParams>'
-  
-  write_file.write(query_string)
-  write_file.close()
-  query_file = ('/tmp/csd_query_facility.xml')    
-  return_text = csd_query(query_file, csd_document, csd_function)
-  if return_text == False:
+  facilities = csdcache.get(csd.FACILITIES)
+  if facilities is None:
     response = {
       "status": "FAILED"
       }
   else:
-    return_text = ET.fromstring(return_text)
-    facilities = [
-      {
-        'parent_facility_id':is_none(facility.find('{urn:ihe:iti:csd:2013}parent'), 'entityID'),
-        'title':is_none(facility.find('{urn:ihe:iti:csd:2013}primaryName')),                
-        'created_at':is_none(facility.find('{urn:ihe:iti:csd:2013}record'), 'created'),
-        "updated_at":is_none(facility.find('{urn:ihe:iti:csd:2013}record'), 'updated'),
-        #"owner":is_none(facility.find('{urn:ihe:iti:csd:2013}record'), 'updated'),
-        #"region_id":is_none(facility.find('{urn:ihe:iti:csd:2013}record'), 'updated'),
-        #"ownership_type":is_none(facility.find('{urn:ihe:iti:csd:2013}record'), 'updated'),
-        "serial_number":is_none(facility.find('{urn:ihe:iti:csd:2013}otherID[@assigningAuthorityName="HNP:facility:serial_number"]'), 'code'),
-        #"type":facility_types[is_none(facility.find('{urn:ihe:iti:csd:2013}codedType'), 'code')],
-        'id':is_none(facility.find('{urn:ihe:iti:csd:2013}otherID[@assigningAuthorityName="HNP:facility:id"]'), 'code')} for facility in return_text.iter('{urn:ihe:iti:csd:2013}facility')]    
     response = {
       "status": OK,
       "facilities": facilities}
-  return http.to_json_response(response)
-
-_address_pat = re.compile(u"^.{1,255}$")
-_email_pat = re.compile(u"^.+@.+$")
-_name_pat = re.compile(u"^.{1,255}$")
-
-def string_parser(pattern=None, required=False, min_length=None, max_length=None, strip=True):
-  def parser(value):
-    if value is None:
-      if required:
-        return None, ERROR_INVALID_INPUT
-      else:
-        return value, None
-    if not isinstance(value, unicode):
-      return None, ERROR_INVALID_INPUT
-    if strip:
-      value = value.strip()
-    if pattern is not None:
-      pat = re.compile(pattern) if isinstance(pattern, types.StringTypes) else pattern
-      if not pat.match(value):
-        return None, ERROR_INVALID_INPUT
-    if min_length is not None and len(value) < min_length:
-      return None, ERROR_INVALID_INPUT
-    if max_length is not None and len(value) > max_length:
-      return None, ERROR_INVALID_INPUT
-    return value, None
-  return parser
-
-def dictionary_parser(key_to_parser):
-  def parser(data):
-    if not data:
-      return None, {"status": ERROR_INVALID_INPUT, "key": None}
-    if not isinstance(data, dict):
-      return None, {"status": ERROR_INVALID_INPUT, "key": None}
-    result = {}
-    for key, parser in key_to_parser.items():
-      v = data.get(key)
-      v, status = parser(v)
-      if status:
-        return None, {"key": key, "status": status}
-      result[key] = v
-    return result, None
-  return parser
-
-def list_parser(parser, required=None):
-  def parser0(values):
-    if not isinstance(values, (list, tuple, type(None))):
-      return None, ERROR_INVALID_INPUT
-    if not values:
-      if not required:
-        return [], None
-      else:
-        return None, ERROR_INVALID_INPUT
-    result = []
-    for v in values:
-      parsed, status = parser(v)
-      if status:
-        return None, status
-      else:
-        result.append(parsed)
-    return result, None
-  return parser0
-
-def foreign_key_parser(model_class, required=None):
-  def parser(value):
-    if value is None:
-      if required:
-        return None, ERROR_INVALID_INPUT
-      else:
-        return None, None
-    try:
-      return model_class.objects.get(id=value), None
-    except model_class.DoesNotExist:
-      return None, ERROR_INVALID_INPUT
-  return parser
-
-def date_parser(required=None):
-  def parser(value):
-    if not isinstance(value, (dict, type(None))):
-      return None, ERROR_INVALID_INPUT
-    if not value:
-      if required:
-        return None, ERROR_INVALID_INPUT
-      else:
-        return None, None
-    result = sb.util.safe(lambda: datetime.date(value["year"], value["month"], value["day"]))
-    return result, None
-  return parser
+  return http.to_json_stream_response(response)
+
+def on_facility_search(request):
+  """Rank the facilities whose names match the query parameter q
+
+  Optional parameters: region, a region id whose subtree to search; type,
+  facility type ids (repeatable); count, the number of matches.
+  """
+  q = request.GET.get("q", u"").strip()
+  type_ids = None
+  if request.GET.getlist("type"):
+    type_ids = set(sb.util.safe(lambda: int(i)) for i in request.GET.getlist("type"))
+  if not q or None in (type_ids or ()):
+    return http.to_json_response({"status": ERROR_INVALID_INPUT})
+  region = None
+  if request.GET.get("region"):
+    region = _region_or_none(request.GET["region"])
+    if region is None:
+      return http.not_found()
+  count = sb.util.safe(lambda: int(request.GET["count"])) or place_index.DEFAULT_COUNT
+  count = max(1, min(count, place_index.MAX_COUNT))
+
+  query, matches = place_index.search_facilities(q, region, type_ids, count)
+  scores = dict((place.id, score) for place, score in matches)
+  facilities = serializers.FACILITY.query_set(models.Facility.objects).in_bulk(list(scores))
+  rows = [facilities[place.id] for place, score in matches if place.id in facilities]
+  results = []
+  for row, facility in zip(rows, serializers.FACILITY.serialize(rows)):
+    facility["score"] = scores[row.id]
+    results.append(facility)
+  return http.to_json_response({
+    "status": OK,
+    "query": query,
+    "facilities": results})
+
+def on_district_search(request):
+  """Rank the districts whose names match the query parameter q
+
+  Answered from memory (see place_index.warm), with each district's parent
+  region.  Optional parameter: count, the number of matches.
+  """
+  q = request.GET.get("q", u"").strip()
+  if not q:
+    return http.to_json_response({"status": ERROR_INVALID_INPUT})
+  count = sb.util.safe(lambda: int(request.GET["count"])) or place_index.DEFAULT_COUNT
+  count = max(1, min(count, place_index.MAX_COUNT))
+  query, matches = place_index.search_districts(q, count)
+  return http.to_json_response({
+    "status": OK,
+    "query": query,
+    "districts": [
+      {"id": place.id,
+       "title": place.title,
+       "parent_region": place.parent,
+       "score": score} for place, score in matches]})
+
+def _cached_specialties():
+  return models.specialty_tree.get().by_id
+
+_health_worker_input = schema.Dictionary({
+  "address": schema.String(pattern="^.{0,255}$", required=False),
+  "birthdate": schema.Date(required=False),
+  "country": schema.String(min_length=2, max_length=3, required=False),
+  "email": schema.String(pattern="^.+@.+$", required=False),
+  "facility": schema.ForeignKey(models.Facility, required=False),
+  "language": schema.String(max_length=16, required=False),
+  "name": schema.String(min_length=1, required=True),
+  "specialties": schema.List(schema.ForeignKey(models.Specialty, required=False,
+                                                cached=_cached_specialties)),
+  "vodacom_phone": schema.String(required=False, max_length=255),
+  "surname": schema.String(required=False, max_length=255),
+  "mct_registration_number": schema.String(required=False, max_length=255),
+  "mct_payroll_number": schema.String(required=False, max_length=255),
+  "other_phone": schema.String(required=False, max_length=255)})
 
 def parse_healthworker_input(data):
-  parser = dictionary_parser({
-    "address": string_parser(pattern="^.{0,255}$", required=False),
-    "birthdate": date_parser(required=False),
-    "country": string_parser(min_length=2, max_length=3, required=False),
-    "email": string_parser(pattern="^.+@.+$", required=False),
-    "facility": foreign_key_parser(models.Facility, required=False),
-    "language": string_parser(max_length=16, required=False),
-    "name": string_parser(min_length=1, required=True),
-    "specialties": list_parser(foreign_key_parser(models.Specialty, required=False)),
-    "vodacom_phone": string_parser(required=False, max_length=255),
-    "surname": string_parser(required=False, max_length=255),
-    "mct_registration_number": string_parser(required=False, max_length=255),
-    "mct_payroll_number": string_parser(required=False, max_length=255),
-    "other_phone": string_parser(required=False, max_length=255)})
-  return parser(data)
+  return _health_worker_input.parse(data)
+
+def _input_error_response(errors):
+  "The response to input that failed validation, listing every invalid key"
+  return http.to_json_response({"status": errors[0]["status"],
+                                "key": errors[0]["key"],
+                                "errors": errors})
 
 def on_health_workers_save(request):
   if not request.is_json:
     return http.to_json_response({
       "status": ERROR_INVALID_INPUT,
       "message": "expecting JSON input"})
-  data, error = parse_healthworker_input(request.JSON)
-  if error:
-    return http.to_json_response({"status": error["status"], "key": error.get("key")})
+  data, errors = _health_worker_input.validate(request.JSON)
+  if errors:
+    return _input_error_response(errors)
 
   with transaction.atomic():
     health_worker = None
@@ -474,9 +327,9 @@ def on_health_workers_save(request):
     health_worker.country = data["country"]
     health_worker.email = data["email"]
     health_worker.facility = data["facility"]
-    for i in data["specialties"]:
+    if data["specialties"]:
       health_worker.save()
-      health_worker.specialties.add(i)
+      health_worker.specialties.add(*data["specialties"])
     health_worker.other_phone = data["other_phone"]
     health_worker.language = data["language"]
     health_worker.mct_registration_num = data["mct_registration_number"]
@@ -490,41 +343,12 @@ def on_health_workers_save(request):
 
 def on_health_workers_index(request):
   """Get an index of health care workers"""
-  csd_document = 'CSD-HNP'
-  csd_function = 'urn:ihe:iti:csd:2014:stored-function:provider-search'
-  write_file = os.system("rm /tmp/csd_query_provider.xml; touch /tmp/csd_query_provider.xml")
-  write_file = open('/tmp/csd_query_provider.xml', 'r+')  
-  query_string = '<csd:requestParams xmlns:csd="urn:ihe:iti:csd:2013"><csd:provider><csd:id entityID="2.25.065073125158126083079071176122160207089182210156">2.25.065073125158126083079071176122160207089182210156</csd:id></csd:provider></csd:requestParams>'
-  
-  write_file.write(query_string)
-  write_file.close()
-  query_file = ('/tmp/csd_query_provider.xml')    
-  return_text = csd_query(query_file, csd_document, csd_function)
-  if return_text == False:
+  health_workers = csdcache.get(csd.PROVIDERS)
+  if health_workers is None:
     response = {
       "status":0
       }
   else:
-    return_text = ET.fromstring(return_text)
-    health_workers = [
-      {
-        "name":is_none(healthworker.find("{urn:ihe:iti:csd:2013}demographic/{urn:ihe:iti:csd:2013}name/{urn:ihe:iti:csd:2013}commonName")),
-        "id":is_none(healthworker.find('{urn:ihe:iti:csd:2013}otherID[@assigningAuthorityName="HNP:health_worker_id"]', "code")),        
-      "language":"",
-      "vodacom_phone":"",
-      "created_at":is_none(healthworker.find('{urn:ihe:iti:csd:2013}record'), 'created'),
-      "updated_at":is_none(healthworker.find('{urn:ihe:iti:csd:2013}record'), 'updated'),
-        "birthdate":"",
-      "email":"",
-      "mct_payroll_num":is_none(healthworker.find('{urn:ihe:iti:csd:2013}otherID[@assigningAuthorityName="HNP:MCT:payroll:check_number"]', "code")),
-      "mct_registration_num":is_none(healthworker.find('{urn:ihe:iti:csd:2013}credential/{urn:ihe:iti:csd:2013}number')),
-      "verification_state":"",
-      "other_phone":"",
-      "address":"",
-        "specialties":[],
-      "country":"TZ",      
-      } for healthworker in return_text.iter('{urn:ihe:iti:csd:2013}provider')
-    ]
     response = {
       "status": 0,
       "health_workers":health_workers
@@ -563,9 +387,9 @@ def on_specialty_create(request):
     return http.to_json_response({
       "status": ERROR_INVALID_INPUT,
       "message": "expecting JSON input"})
-  data, error = parse_specialty_input(request.JSON)
-  if error:
-    return http.to_json_response({"status": error["status"], "key": error.get("key")})
+  data, errors = _specialty_input.validate(request.JSON)
+  if errors:
+    return _input_error_response(errors)
 
   with transaction.atomic():
     if list(models.Specialty.objects.filter(title=data["title"], parent_specialty=data["parent_specialty"]).all()):
@@ -578,12 +402,14 @@ def on_specialty_create(request):
     specialty.save()
     return http.to_json_response({"status": OK, "id": specialty.id})
 
+_specialty_input = schema.Dictionary({
+  "title": schema.String(pattern="^.{1,255}$", required=False),
+  "msisdn": schema.String(pattern="^.{1,255}$", required=False),
+  "parent_specialty": schema.ForeignKey(models.Specialty, required=False,
+                                         cached=_cached_specialties)})
+
 def parse_specialty_input(data):
-  parser = dictionary_parser({
-    "title": string_parser(pattern="^.{1,255}$", required=False),
-    "msisdn": string_parser(pattern="^.{1,255}$", required=False),
-    "parent_specialty": foreign_key_parser(models.Specialty, required=False)})
-  return parser(data)
+  return _specialty_input.parse(data)
 
 @csrf_exempt
 def on_facility(request):
@@ -592,23 +418,24 @@ def on_facility(request):
   else:
     return on_facility_create(request)
 
+_facility_input = schema.Dictionary({
+  "title": schema.String(pattern="^.{1,255}$", required=True),
+  "address": schema.String(pattern="^.{1,1000}$", required=False),
+  "msisdn": schema.String(pattern="^.{1,255}$", required=False),
+  "type": schema.ForeignKey(models.FacilityType, required=False),
+  "region": schema.ForeignKey(models.Region, required=False)})
+
 def parse_facility_input(data):
-  parser = dictionary_parser({
-    "title": string_parser(pattern="^.{1,255}$", required=True),
-    "address": string_parser(pattern="^.{1,1000}$", required=False),
-    "msisdn": string_parser(pattern="^.{1,255}$", required=False),
-    "type": foreign_key_parser(models.FacilityType, required=False),
-    "region": foreign_key_parser(models.Region, required=False)})
-  return parser(data)
+  return _facility_input.parse(data)
 
 def on_facility_create(request):
   if not request.is_json:
     return http.to_json_response({
       "status": ERROR_INVALID_INPUT,
       "message": "expecting JSON input"})
-  data, error = parse_facility_input(request.JSON)
-  if error:
-    return http.to_json_response({"status": error["status"], "key": error.get("key")})
+  data, errors = _facility_input.validate(request.JSON)
+  if errors:
+    return _input_error_response(errors)
   with transaction.atomic():
     facility = models.Facility()
     facility.title = data["title"]
@@ -622,38 +449,19 @@ def on_facility_create(request):
 class UploadForm(forms.Form):
   members = forms.FileField()
 
-def normalize_tz_phone(phone_number):
-  if phone_number.startswith('255'):
-    return '+' + phone_number
-  elif phone_number.startswith('07'):
-    return '+255' + phone_number[1:]
-  elif phone_number.startswith('7'):
-    return '+255' + phone_number
-  else:
-    return phone_number
-
 def cug(request):
+  job_id = None
   if request.method == "POST":
     form = UploadForm(request.POST, request.FILES)
     if form.is_valid():
-      members_file = request.FILES["members"]
-      members_file_bytes = members_file.read()
-      if '\n' not in members_file_bytes:
-        members_file_bytes = members_file_bytes.replace('\r', '\r\n')
-      if '\r' not in members_file_bytes:
-        members_file_bytes = members_file_bytes.replace('\n', '\r\n')
-      member_buf = StringIO.StringIO(members_file_bytes)
-      entries = csv.DictReader(member_buf)
-      phone_numbers = []
-      for entry in entries:
-        if "phone" in entry:
-          phone = entry["phone"]
-          phone = normalize_tz_phone(phone)
-          if phone:
-            phone_numbers.append(phone)      
-      hws = models.HealthWorker.objects.filter(vodacom_phone__in=phone_numbers)
-      for hw in hws:
-        hw.set_closed_user_group(True)
+      job_id = cug_import.start_import(request.FILES["members"],
+                                       background=not sb.testing.is_testing())
   else:
     form = UploadForm()
-  return render(request, "cug.html", {'form':form})
+  return render(request, "cug.html", {'form':form, 'job_id':job_id})
+
+def on_cug_job(request, job_id):
+  job = cug_import.get_job(job_id)
+  if job is None:
+    return http.not_found()
+  return http.to_json_response(job)
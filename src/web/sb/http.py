@@ -1,6 +1,7 @@
 import json
 import datetime
 import time
+import types
 
 from django import http
 
@@ -35,6 +36,73 @@ def to_json_response(data, status=200):
                       status=status,
                       content_type="application/json")
 
+# Responses are sent in chunks of about this many bytes
+JSON_CHUNK_SIZE = 64 * 1024
+
+def _iter_json_parts(data, encoder):
+  if isinstance(data, dict):
+    yield "{"
+    for i, (key, value) in enumerate(data.iteritems()):
+      yield "," if i else ""
+      yield encoder.encode(key)
+      yield encoder.key_separator
+      for part in _iter_json_parts(value, encoder):
+        yield part
+    yield "}"
+  elif isinstance(data, (types.GeneratorType, StreamList)):
+    yield "["
+    for i, item in enumerate(data):
+      yield "," if i else ""
+      yield encoder.encode(item)
+    yield "]"
+  else:
+    for part in encoder.iterencode(data):
+      yield part
+
+def iter_json(data, separators=(",", ":"), chunk_size=JSON_CHUNK_SIZE):
+  """Encode 'data' as JSON in chunks of about chunk_size bytes
+
+  Dictionaries are encoded key by key, and generators and StreamList values
+  are encoded as lists one item at a time, so a large list is never held in
+  memory as a whole.  The items of a streamed list are encoded whole.
+  """
+  encoder = json.JSONEncoder(default=_to_json_default, separators=separators)
+  buf = []
+  size = 0
+  for part in _iter_json_parts(data, encoder):
+    buf.append(part)
+    size += len(part)
+    if size >= chunk_size:
+      yield "".join(buf)
+      buf = []
+      size = 0
+  if buf:
+    yield "".join(buf)
+
+class StreamList(object):
+  "An iterable to stream as a JSON list, see iter_json"
+  def __init__(self, iterable):
+    self.iterable = iterable
+
+  def __iter__(self):
+    return iter(self.iterable)
+
+def to_json_stream_response(data, status=200):
+  """Convert 'data' to a streaming JSON response.
+
+  Like to_json_response, but the response is compact and encoded as it is
+  sent, see iter_json.
+
+  Arguments:
+  data --- any, a value that json.dumps can marshal, where lists may be
+  generators or StreamList values
+
+  Returns
+  django.http.StreamingHttpResponse
+  """
+  return http.StreamingHttpResponse(iter_json(data),
+                                    status=status,
+                                    content_type="application/json")
 
 def not_found():
   "Return a not-found response"
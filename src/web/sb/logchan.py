@@ -1,35 +1,233 @@
+# Copyright 2013 Switchboard, Inc
+"""Append-only JSON-lines event channels
+
+Each channel is a directory under $SB_CHANNEL_ROOT holding a file per day,
+<channel>/<channel>-YYYYMMDD.json, with one {"time", "channel", "data"}
+object per line.
+
+Entries are buffered per channel and appended when a channel's buffer holds
+$SB_CHANNEL_FLUSH_BYTES, when its oldest entry is $SB_CHANNEL_FLUSH_SECONDS
+old (checked by a background thread), on flush(), and at exit.  Each channel
+keeps its day's file open.  A flush is a single write to a file opened with
+O_APPEND, under an exclusive flock, so several processes can append to the
+same channel without interleaving lines.
+
+With $SB_CHANNEL_GZIP set, day files more than a day old are compressed to
+<channel>-YYYYMMDD.json.gz when a channel rolls over to a new day.
+"""
+
+import atexit
 import datetime
 import errno
+import fcntl
+import gzip
 import json
+import logging
 import os
 import os.path
 import re
+import shutil
+import threading
 import time
 
+_log = logging.getLogger("sb.logchan")
+
 SB_CHANNEL_ROOT = "SB_CHANNEL_ROOT"
 
 channel_root = os.environ.get(SB_CHANNEL_ROOT, "")
+FLUSH_BYTES = int(os.environ.get("SB_CHANNEL_FLUSH_BYTES", 64 * 1024))
+FLUSH_SECONDS = float(os.environ.get("SB_CHANNEL_FLUSH_SECONDS", 1))
+GZIP = bool(os.environ.get("SB_CHANNEL_GZIP"))
 
 channel_pat = re.compile('^[a-zA-Z0-9-_]+$')
+day_file_pat = re.compile(r'^(?P<channel>[a-zA-Z0-9-_]+)-(?P<day>\d{8})[.]json(?P<gz>[.]gz)?$')
 
-def write(channel_name, **args):
-  ts = time.time()
-  if not channel_pat.match(channel_name):
-    raise ValueError("unexpected channel name")
-  today = datetime.date.today()
-  chan_dir = os.path.join(channel_root, channel_name)
+def channel_dir(channel_name):
+  return os.path.join(channel_root, channel_name)
+
+def day_path(channel_name, day):
+  return os.path.join(channel_dir(channel_name), day.strftime(channel_name + '-%Y%m%d.json'))
+
+def _makedirs(path):
   try:
-    os.makedirs(chan_dir)
+    os.makedirs(path)
   except OSError, err:
     if err.errno != errno.EEXIST:
       raise
 
-  path = today.strftime(channel_name + '-%Y%m%d.json')
-  path = os.path.join(chan_dir, path)
-  data = {
-    "time": time.time(),
-    "channel": channel_name,
-    "data": args}
-  buf = json.dumps(data)
-  with open(path, "a") as a_file:
-    a_file.write(buf + "\n")
+def _append(fd, data):
+  "Append data to fd with one write, holding an exclusive lock"
+  fcntl.flock(fd, fcntl.LOCK_EX)
+  try:
+    while data:
+      written = os.write(fd, data)
+      data = data[written:]
+  finally:
+    fcntl.flock(fd, fcntl.LOCK_UN)
+
+def compress_day(path):
+  "Replace a completed day file with a .gz, unless another process did"
+  fd = os.open(path, os.O_RDONLY)
+  try:
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    if not os.path.exists(path):
+      return
+    tmp_path = "%s.%d.gz.tmp" % (path, os.getpid())
+    with os.fdopen(os.dup(fd), "rb") as source:
+      with gzip.open(tmp_path, "wb") as target:
+        shutil.copyfileobj(source, target)
+    os.rename(tmp_path, path + ".gz")
+    os.remove(path)
+  finally:
+    os.close(fd)
+
+def compress_completed_days(channel_name, today=None):
+  "Compress the day files of a channel more than a day old"
+  if today is None:
+    today = datetime.date.today()
+  oldest_open = (today - datetime.timedelta(days=1)).strftime("%Y%m%d")
+  try:
+    names = os.listdir(channel_dir(channel_name))
+  except OSError, err:
+    if err.errno != errno.ENOENT:
+      raise
+    return
+  for name in sorted(names):
+    match = day_file_pat.match(name)
+    if (match and not match.group("gz") and match.group("channel") == channel_name
+        and match.group("day") < oldest_open):
+      try:
+        compress_day(os.path.join(channel_dir(channel_name), name))
+      except OSError, err:
+        # Another process compressed it first
+        if err.errno != errno.ENOENT:
+          raise
+
+class ChannelWriter(object):
+  "Buffers a channel's lines and appends them to its day files"
+  def __init__(self, channel_name):
+    self.channel_name = channel_name
+    self._lock = threading.Lock()
+    # day -> lines
+    self._pending = {}
+    self._pending_bytes = 0
+    self._oldest = None
+    self._day = None
+    self._fd = None
+
+  def write(self, entries):
+    ts = time.time()
+    day = datetime.date.fromtimestamp(ts)
+    lines = [json.dumps({"time": ts, "channel": self.channel_name, "data": args}) + "\n"
+             for args in entries]
+    with self._lock:
+      self._pending.setdefault(day, []).extend(lines)
+      self._pending_bytes += sum(len(line) for line in lines)
+      if self._oldest is None:
+        self._oldest = ts
+      if self._pending_bytes >= FLUSH_BYTES:
+        self._flush()
+
+  def is_due(self, now):
+    return self._oldest is not None and now - self._oldest >= FLUSH_SECONDS
+
+  def flush(self):
+    with self._lock:
+      self._flush()
+
+  def _flush(self):
+    "Append the pending lines, keeping the days not written if a write fails"
+    for day in sorted(self._pending):
+      data = "".join(self._pending[day])
+      _append(self._open(day), data)
+      del self._pending[day]
+      self._pending_bytes -= len(data)
+    self._oldest = None
+
+  def _open(self, day):
+    if day != self._day:
+      rolled_over = self._day is not None
+      self._close()
+      _makedirs(channel_dir(self.channel_name))
+      self._fd = os.open(day_path(self.channel_name, day),
+                         os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+      self._day = day
+      if rolled_over and GZIP:
+        compress_completed_days(self.channel_name, day)
+    return self._fd
+
+  def _close(self):
+    if self._fd is not None:
+      os.close(self._fd)
+      self._fd = None
+      self._day = None
+
+  def close(self):
+    with self._lock:
+      self._flush()
+      self._close()
+
+_writers = {}
+_writers_lock = threading.Lock()
+_flusher = None
+# The process that owns _writers and _flusher
+_pid = os.getpid()
+
+def _flush_due():
+  while True:
+    time.sleep(FLUSH_SECONDS)
+    now = time.time()
+    for writer in _writers.values():
+      if writer.is_due(now):
+        try:
+          writer.flush()
+        except Exception:
+          # The lines stay buffered, and are tried again next time
+          _log.exception("failed to flush channel %s", writer.channel_name)
+
+def _forget_parent_writers():
+  "In a forked child, leave the parent's buffers and files to the parent"
+  global _flusher, _pid
+  if os.getpid() != _pid:
+    with _writers_lock:
+      _writers.clear()
+      _flusher = None
+      _pid = os.getpid()
+
+def _writer(channel_name):
+  global _flusher
+  _forget_parent_writers()
+  writer = _writers.get(channel_name)
+  if writer is not None:
+    return writer
+  with _writers_lock:
+    if channel_name not in _writers:
+      _writers[channel_name] = ChannelWriter(channel_name)
+    if _flusher is None:
+      _flusher = threading.Thread(target=_flush_due, name="logchan-flush")
+      _flusher.daemon = True
+      _flusher.start()
+    return _writers[channel_name]
+
+def flush():
+  "Append the buffered entries of every channel"
+  _forget_parent_writers()
+  for writer in _writers.values():
+    writer.flush()
+
+def close():
+  "Flush every channel and close its file"
+  _forget_parent_writers()
+  for writer in _writers.values():
+    writer.close()
+
+atexit.register(close)
+
+def write(channel_name, **args):
+  write_many(channel_name, [args])
+
+def write_many(channel_name, entries):
+  "Buffer a batch of entries (dicts) for a channel"
+  if not channel_pat.match(channel_name):
+    raise ValueError("unexpected channel name")
+  _writer(channel_name).write(entries)
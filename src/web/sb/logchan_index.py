@@ -0,0 +1,176 @@
+# Copyright 2013 Switchboard, Inc
+"""An index of the entries of a sb.logchan channel
+
+The day files of a channel are read once, as they grow, into a SQLite
+database in the channel's directory (<channel>.index.sqlite3) with an
+entry's time, its data's "phone" and "id", and its data, indexed by phone,
+id and time:
+
+  index = ChannelIndex("closed-user-group-change")
+  index.update()
+  for entry in index.by_phone("+255754000001"):
+    print entry["time"], entry["data"]["change"]
+
+update() reads each day file from where the last update stopped, and
+carries on in the .json.gz of a day that was compressed in the meantime.
+"""
+
+import datetime
+import gzip
+import json
+import os
+import os.path
+import sqlite3
+import time
+
+from sb import logchan
+
+_schema = """
+create table if not exists days (
+  day text primary key,
+  name text not null,
+  -- bytes of the uncompressed file indexed so far
+  offset integer not null);
+create table if not exists entries (
+  time real not null,
+  phone text,
+  worker_id integer,
+  data text not null);
+create index if not exists entries_phone on entries (phone, time);
+create index if not exists entries_worker_id on entries (worker_id, time);
+create index if not exists entries_time on entries (time);
+"""
+
+def day_files(channel_name):
+  "Get (YYYYMMDD, path) for the day files of a channel, oldest first"
+  try:
+    names = os.listdir(logchan.channel_dir(channel_name))
+  except OSError:
+    return []
+  days = {}
+  for name in names:
+    match = logchan.day_file_pat.match(name)
+    if match and match.group("channel") == channel_name:
+      # A day being compressed has both files, the .json is complete
+      if match.group("day") not in days or not match.group("gz"):
+        days[match.group("day")] = os.path.join(logchan.channel_dir(channel_name), name)
+  return sorted(days.items())
+
+def _open_day(path):
+  if path.endswith(".gz"):
+    return gzip.open(path, "rb")
+  return open(path, "rb")
+
+def iter_entries(path, offset=0):
+  """Generate (end offset, entry) for the complete lines of a day file
+
+  Offsets count uncompressed bytes.  A last line without its newline is
+  still being written and is left for the next read.
+  """
+  with _open_day(path) as f:
+    if offset:
+      f.seek(offset)
+    for line in f:
+      if not line.endswith("\n"):
+        return
+      offset += len(line)
+      if line.strip():
+        yield offset, json.loads(line)
+
+def _to_timestamp(value):
+  "A time, date or datetime as seconds since the epoch"
+  if value is None or isinstance(value, (int, long, float)):
+    return value
+  if not isinstance(value, datetime.datetime):
+    value = datetime.datetime.combine(value, datetime.time())
+  return time.mktime(value.timetuple())
+
+class ChannelIndex(object):
+  def __init__(self, channel_name, path=None):
+    self.channel_name = channel_name
+    self.path = path or os.path.join(logchan.channel_dir(channel_name),
+                                     channel_name + ".index.sqlite3")
+    self._db = None
+
+  def _connect(self):
+    if self._db is None:
+      logchan._makedirs(os.path.dirname(self.path) or ".")
+      # Transactions are begun explicitly, see update()
+      self._db = sqlite3.connect(self.path, isolation_level=None)
+      self._db.executescript(_schema)
+    return self._db
+
+  def close(self):
+    if self._db is not None:
+      self._db.close()
+      self._db = None
+
+  def rebuild(self):
+    "Drop the index and read every day file again"
+    return self.update(rebuild=True)
+
+  def update(self, rebuild=False):
+    """Index the entries written since the last update, returns their number
+
+    The update holds the database's write lock, so concurrent updates don't
+    index an entry twice.
+    """
+    db = self._connect()
+    db.execute("begin immediate")
+    try:
+      if rebuild:
+        db.execute("delete from entries")
+        db.execute("delete from days")
+      added = self._update(db)
+      db.execute("commit")
+    except:
+      db.execute("rollback")
+      raise
+    return added
+
+  def _update(self, db):
+    offsets = dict(db.execute("select day, offset from days"))
+    added = 0
+    for day, path in day_files(self.channel_name):
+      offset = offsets.get(day, 0)
+      rows = []
+      for offset, entry in iter_entries(path, offset):
+        data = entry.get("data") or {}
+        rows.append((entry["time"], data.get("phone"), data.get("id"),
+                     json.dumps(data, separators=(",", ":"))))
+      if not rows and day in offsets:
+        continue
+      db.executemany("insert into entries (time, phone, worker_id, data) values (?, ?, ?, ?)",
+                     rows)
+      db.execute("insert or replace into days (day, name, offset) values (?, ?, ?)",
+                 (day, os.path.basename(path), offset))
+      added += len(rows)
+    return added
+
+  def _query(self, where, params, start, end):
+    clauses = [where] if where else []
+    start, end = _to_timestamp(start), _to_timestamp(end)
+    if start is not None:
+      clauses.append("time >= ?")
+      params.append(start)
+    if end is not None:
+      clauses.append("time < ?")
+      params.append(end)
+    sql = "select time, data from entries"
+    if clauses:
+      sql += " where " + " and ".join(clauses)
+    sql += " order by time"
+    return [{"time": t, "channel": self.channel_name, "data": json.loads(data)}
+            for t, data in self._connect().execute(sql, params)]
+
+  def by_phone(self, phone, start=None, end=None):
+    "The entries about a phone number, from start up to end"
+    return self._query("phone = ?", [phone], start, end)
+
+  def by_id(self, worker_id, start=None, end=None):
+    "The entries about a health worker id, from start up to end"
+    return self._query("worker_id = ?", [worker_id], start, end)
+
+  def between(self, start=None, end=None):
+    "The entries from start up to end"
+    return self._query(None, [], start, end)
@@ -178,3 +178,51 @@ VUMIGO_CONVERSATION_ID = os.environ.get('VUMIGO_CONVERSATION_ID')
 VUMIGO_CONVERSATION_TOKEN = os.environ.get('VUMIGO_CONVERSATION_TOKEN')
 VUMIGO_ACCOUNT_ID = os.environ.get('VUMIGO_ACCOUNT_ID')
 VUMIGO_SEND_SMSES = bool(VUMIGO_API_URL)
+
+# Registry matching
+
+# Seconds before the in-memory registry indexes are reloaded from the database
+REGISTRY_INDEX_TTL = int(os.environ.get('REGISTRY_INDEX_TTL', 300))
+# Fuzzy name matching: 'trigram', 'bigram' or 'levenshtein'
+NAME_MATCH_ALGORITHM = os.environ.get('NAME_MATCH_ALGORITHM', 'trigram')
+NAME_MATCH_THRESHOLD = float(os.environ.get('NAME_MATCH_THRESHOLD', 0.5))
+# Blocking keys used to pick name verification candidates: 'soundex_digits',
+# 'soundex', 'prefix' (see sb.healthworker.blocking)
+NAME_BLOCKING_KEYS = ('soundex_digits', 'prefix')
+# Fuzzy facility and district search, see sb.healthworker.place_index
+PLACE_SEARCH_ALGORITHM = os.environ.get('PLACE_SEARCH_ALGORITHM', 'trigram')
+PLACE_SEARCH_THRESHOLD = float(os.environ.get('PLACE_SEARCH_THRESHOLD', 0.5))
+
+# Outgoing SMS queue, see sb.smsqueue
+SMS_QUEUE_ROOT = os.environ.get('SMS_QUEUE_ROOT', 'sms-queue')
+SMS_WORKERS = int(os.environ.get('SMS_WORKERS', 4))
+SMS_MAX_ATTEMPTS = 5
+SMS_CLAIM_BATCH = int(os.environ.get('SMS_CLAIM_BATCH', 10))
+
+# Progress files and spooled uploads of /cug imports, imported by the
+# process_cug_jobs command (see sb.healthworker.cug)
+CUG_JOB_ROOT = os.environ.get('CUG_JOB_ROOT', 'cug-jobs')
+
+# CSD directory cache, see sb.healthworker.csdcache.  Set CSD_CACHE_ROOT to
+# share cached results between the processes of a host.
+CSD_CACHE_TTL = int(os.environ.get('CSD_CACHE_TTL', 300))
+CSD_CACHE_FULL_REFRESH = int(os.environ.get('CSD_CACHE_FULL_REFRESH', 24 * 3600))
+CSD_CACHE_ROOT = os.environ.get('CSD_CACHE_ROOT') or None
+
+# CSD service client, see sb.healthworker.csd
+CSD_BASE_URL = os.environ.get('CSD_BASE_URL', 'http://46.51.196.92:8984/CSD/csr/')
+CSD_CONNECT_TIMEOUT = float(os.environ.get('CSD_CONNECT_TIMEOUT', 5))
+CSD_READ_TIMEOUT = float(os.environ.get('CSD_READ_TIMEOUT', 60))
+CSD_POOL_SIZE = int(os.environ.get('CSD_POOL_SIZE', 10))
+
+# Seconds before cached reference tables (see sb.healthworker.refcache) are
+# reloaded to pick up changes made by other processes
+REFERENCE_CACHE_TTL = int(os.environ.get('REFERENCE_CACHE_TTL', 300))
+
+# Rows written per bulk insert or update by the dataset importers
+DATASET_CHUNK_SIZE = int(os.environ.get('DATASET_CHUNK_SIZE', 1000))
+# Directory where interrupted dataset imports record how far they got, so a
+# rerun resumes there (see sb.healthworker.datasets._helpers)
+DATASET_CHECKPOINT_ROOT = os.environ.get('DATASET_CHECKPOINT_ROOT') or None
+# Dataset imports run at once by import_all_datasets
+DATASET_JOBS = int(os.environ.get('DATASET_JOBS', 4))
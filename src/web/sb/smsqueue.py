@@ -0,0 +1,246 @@
+# Copyright 2013 Switchboard, Inc
+"""Queued SMS dispatch through Vumi Go
+
+Request handlers enqueue messages and return immediately; the
+process_sms_queue management command sends them with a pool of worker
+threads that reuse keep-alive connections, retrying failures with
+exponential backoff.
+
+The queue is a spool directory (settings.SMS_QUEUE_ROOT) laid out like a
+maildir:
+
+  tmp/ --- job files being written
+  new/ --- job files waiting to be sent, named so that they sort by due time
+  cur/ --- job files claimed by a sender
+  failed/ --- job files that ran out of attempts
+
+A job file holds one JSON encoded message per line.  Files are written to
+tmp/ and renamed into new/, and claimed by renaming them into cur/, so
+several web and sender processes can share a queue.  Delivery is at least
+once: files left in cur/ by a sender that died are put back on the queue.
+"""
+
+import errno
+import json
+import logging
+import os
+import os.path
+import threading
+import time
+import uuid
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+import requests
+import requests.adapters
+
+import sb.util
+
+_log = logging.getLogger("sb.smsqueue")
+
+QUEUE_ROOT = getattr(settings, "SMS_QUEUE_ROOT", "sms-queue")
+WORKERS = getattr(settings, "SMS_WORKERS", 4)
+MAX_ATTEMPTS = getattr(settings, "SMS_MAX_ATTEMPTS", 5)
+# Retry n waits BACKOFF_SECONDS * 2 ** (n - 1), at most MAX_BACKOFF_SECONDS
+BACKOFF_SECONDS = getattr(settings, "SMS_BACKOFF_SECONDS", 30)
+MAX_BACKOFF_SECONDS = getattr(settings, "SMS_MAX_BACKOFF_SECONDS", 3600)
+REQUEST_TIMEOUT = getattr(settings, "SMS_REQUEST_TIMEOUT", 30)
+# Claimed files older than this are assumed abandoned
+STALE_SECONDS = getattr(settings, "SMS_STALE_SECONDS", 3600)
+# Job files claimed at a time, so that each is sent well within STALE_SECONDS
+CLAIM_BATCH = getattr(settings, "SMS_CLAIM_BATCH", 10)
+
+def _dir(name):
+  path = os.path.join(QUEUE_ROOT, name)
+  try:
+    os.makedirs(path)
+  except OSError, err:
+    if err.errno != errno.EEXIST:
+      raise
+  return path
+
+def _write_job_file(jobs, not_before, directory="new"):
+  name = "%015d.%d.%s.json" % (int(not_before * 1000), os.getpid(), uuid.uuid4().hex)
+  tmp_path = os.path.join(_dir("tmp"), name)
+  with open(tmp_path, "w") as a_file:
+    for job in jobs:
+      a_file.write(json.dumps(job) + "\n")
+    a_file.flush()
+    os.fsync(a_file.fileno())
+  os.rename(tmp_path, os.path.join(_dir(directory), name))
+  return name
+
+def _due_time(name):
+  return int(name.split(".", 1)[0]) / 1000.0
+
+def enqueue_many(messages):
+  """Queue a batch of (to_addr, content) messages in one job file
+
+  Returns the job file name, or None if SMS sending is disabled.
+  """
+  if not settings.VUMIGO_SEND_SMSES:
+    return None
+  jobs = [{"to_addr": to_addr, "content": content, "attempts": 0}
+          for to_addr, content in messages]
+  if not jobs:
+    return None
+  return _write_job_file(jobs, time.time())
+
+def enqueue(to_addr, content):
+  "Queue an SMS"
+  return enqueue_many([(to_addr, content)])
+
+def claim(limit=None, now=None):
+  "Move due job files from new/ to cur/ and return their paths"
+  now = now or time.time()
+  new_dir = _dir("new")
+  cur_dir = _dir("cur")
+  claimed = []
+  for name in sorted(os.listdir(new_dir)):
+    if _due_time(name) > now or (limit is not None and len(claimed) >= limit):
+      break
+    path = os.path.join(cur_dir, name)
+    try:
+      os.rename(os.path.join(new_dir, name), path)
+      # A rename keeps the time the file was written, recover() needs the
+      # time it was claimed
+      os.utime(path, None)
+    except OSError, err:
+      # Another sender claimed it
+      if err.errno != errno.ENOENT:
+        raise
+      continue
+    claimed.append(path)
+  return claimed
+
+def recover(now=None):
+  "Put job files abandoned in cur/ back on the queue, returns their names"
+  now = now or time.time()
+  cur_dir = _dir("cur")
+  new_dir = _dir("new")
+  recovered = []
+  for name in os.listdir(cur_dir):
+    path = os.path.join(cur_dir, name)
+    try:
+      if now - os.path.getmtime(path) > STALE_SECONDS:
+        os.rename(path, os.path.join(new_dir, name))
+        recovered.append(name)
+    except OSError, err:
+      if err.errno != errno.ENOENT:
+        raise
+  return recovered
+
+def backoff(attempts):
+  "Seconds to wait before retrying a job that has failed attempts times"
+  return min(BACKOFF_SECONDS * 2 ** (attempts - 1), MAX_BACKOFF_SECONDS)
+
+_local = threading.local()
+
+def _session():
+  "A keep-alive session for the current sender thread"
+  session = getattr(_local, "session", None)
+  if session is None:
+    session = requests.Session()
+    session.mount("http://", requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=1))
+    session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=1))
+    session.auth = (settings.VUMIGO_ACCOUNT_ID, settings.VUMIGO_CONVERSATION_TOKEN)
+    session.headers["Content-Type"] = "application/json"
+    _local.session = session
+  return session
+
+def send(job):
+  """Send one job, raising sb.util.SmsSendingError on failure
+
+  Makes the same PUT as sb.util.send_vumigo_sms over a pooled connection.
+  Any 200 response is a success, whatever its body.
+  """
+  data = json.dumps({"content": job["content"], "to_addr": job["to_addr"]})
+  try:
+    response = _session().put(sb.util.vumigo_messages_url(), data=data,
+                              timeout=REQUEST_TIMEOUT)
+  except requests.RequestException, err:
+    raise sb.util.SmsSendingError("Failed to send SMS: %s" % (err, ))
+  if response.status_code != 200:
+    raise sb.util.SmsSendingError("Failed to send SMS, response code: %d,"
+                                  " data: %r" % (response.status_code, response.content))
+
+def _try_send(job):
+  try:
+    send(job)
+    return None
+  except sb.util.SmsSendingError, err:
+    _log.warning("%s (to %s, attempt %d)", err, job["to_addr"], job["attempts"] + 1)
+    return job
+  except Exception:
+    # Retry it rather than stop sending the file's other jobs
+    _log.exception("Failed to send SMS (to %s, attempt %d)",
+                   job.get("to_addr"), job["attempts"] + 1)
+    return job
+
+class Dispatcher(object):
+  "Sends queued jobs with a bounded pool of sender threads"
+  def __init__(self, workers=WORKERS):
+    self.pool = ThreadPool(workers)
+    self.sent = 0
+    self.retried = 0
+    self.failed = 0
+
+  def process_file(self, path):
+    """Send the jobs of a claimed file, requeueing the ones that fail
+
+    Returns False if the file is gone, claimed by another sender.
+    """
+    try:
+      with open(path, "r") as a_file:
+        jobs = [json.loads(line) for line in a_file if line.strip()]
+    except IOError, err:
+      if err.errno != errno.ENOENT:
+        raise
+      return False
+    failures = [job for job in self.pool.map(_try_send, jobs) if job is not None]
+    self.sent += len(jobs) - len(failures)
+    retries = []
+    dead = []
+    for job in failures:
+      job["attempts"] += 1
+      if job["attempts"] >= MAX_ATTEMPTS:
+        dead.append(job)
+      else:
+        retries.append(job)
+    # Jobs with the same attempt count share a retry time
+    by_attempts = {}
+    for job in retries:
+      by_attempts.setdefault(job["attempts"], []).append(job)
+    for attempts, jobs in by_attempts.items():
+      _write_job_file(jobs, time.time() + backoff(attempts))
+    if dead:
+      _write_job_file(dead, time.time(), directory="failed")
+    self.retried += len(retries)
+    self.failed += len(dead)
+    try:
+      os.remove(path)
+    except OSError, err:
+      if err.errno != errno.ENOENT:
+        raise
+    return True
+
+  def run_once(self):
+    "Send every due job, returns the number of job files processed"
+    recover()
+    count = 0
+    while True:
+      paths = claim(limit=CLAIM_BATCH)
+      if not paths:
+        return count
+      for path in paths:
+        self.process_file(path)
+      count += len(paths)
+
+  def run_forever(self, poll_seconds=1.0):
+    while True:
+      if not self.run_once():
+        time.sleep(poll_seconds)
+
+  def close(self):
+    self.pool.close()
+    self.pool.join()
@@ -9,6 +9,7 @@ urlpatterns = patterns('',
   # main routes
   url(r'^$', 'sb.views.home', name='home'),
   url(r'^cug$', 'sb.healthworker.views.cug', name='home'),
+  url(r'^cug/jobs/(?P<job_id>[0-9a-f]+)$', 'sb.healthworker.views.on_cug_job'),
   url(r'^api/1.0/', include('sb.healthworker.urls')),
 
   # admin docs
@@ -29,15 +29,19 @@ class SmsSendingError(Exception):
   """Raised when SMS sending fails."""
 
 
+def vumigo_messages_url():
+  "The Vumi Go URL messages are PUT to"
+  if settings.VUMIGO_API_URL is None:
+    raise ValueError("Can't send SMS, VUMIGO_API_URL not configured")
+  return "%s/%s/messages.json" % (settings.VUMIGO_API_URL,
+                                  settings.VUMIGO_CONVERSATION_ID)
+
 def send_vumigo_sms(to_addr, content):
   if not settings.VUMIGO_SEND_SMSES:
     return
-  if settings.VUMIGO_API_URL is None:
-    raise ValueError("Can't send SMS, VUMIGO_API_URL not configured")
+  url = vumigo_messages_url()
   username = settings.VUMIGO_ACCOUNT_ID
   password = settings.VUMIGO_CONVERSATION_TOKEN
-  url = "%s/%s/messages.json" % (settings.VUMIGO_API_URL,
-                                 settings.VUMIGO_CONVERSATION_ID)
   request = urllib2.Request(url)
   basic_auth = base64.standard_b64encode('%s:%s' % (username, password))
   request.add_header("Authorization", "Basic %s" % basic_auth)
@@ -23,6 +23,10 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "sb.settings")
 from django.core.wsgi import get_wsgi_application
 application = get_wsgi_application()
 
+# Load the facility and district search indexes before the first request
+from sb.healthworker import place_index
+place_index.warm()
+
 # Apply WSGI middleware here.
 # from helloworld.wsgi import HelloWorldApplication
 # application = HelloWorldApplication(application)